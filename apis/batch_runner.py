@@ -0,0 +1,424 @@
+import anyio
+import argparse
+import asyncio
+import inspect
+import json
+import math
+import os
+import statistics
+import sys
+import time
+
+from pathlib import Path
+
+from pydantic import ValidationError
+from tclogger import logger
+
+from constants.models import PRO_MODELS
+from apis.chat_items import ChatCompletionsPostItem, parse_batch_line
+from messagers.message_composer import MessageComposer
+from messagers.token_checker import TokenChecker
+from networks.connection_pools import CONNECTION_POOLS
+from networks.exceptions import ModelLoadingException
+from networks.huggingchat_streamer import HuggingchatStreamer
+from networks.huggingface_streamer import AsyncHuggingfaceStreamer
+from networks.openai_streamer import OpenaiStreamer
+from networks.request_deadline import RequestDeadline
+
+
+def get_percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(math.ceil(len(values) * percent / 100) - 1, len(values) - 1)
+    return values[max(index, 0)]
+
+
+class BatchCheckpoint:
+    """
+    Output JSONL of a batch run, which is also its checkpoint.
+
+    Each finished item is appended as one line, so an interrupted run resumes
+    by skipping custom IDs which are already in the output.
+    Partial last line of a killed run is truncated before appending.
+    With `retry_errors`, failed items run again, and their former error lines
+    are dropped from the output on close, so each custom ID has one record.
+    """
+
+    def __init__(self, path: str, retry_errors: bool = False, sync_interval: int = 100):
+        self.path = Path(path)
+        self.retry_errors = retry_errors
+        self.sync_interval = sync_interval
+        self.finished_ids = set()
+        # custom IDs of error lines loaded for retry, superseded by newer lines
+        self.retried_ids = set()
+        self.unsynced_count = 0
+        self.file = None
+
+    def load(self):
+        if not self.path.exists():
+            return
+        with open(self.path, "rb+") as rf:
+            content = rf.read()
+            if content and not content.endswith(b"\n"):
+                rf.truncate(content.rfind(b"\n") + 1)
+                content = content[: content.rfind(b"\n") + 1]
+        for line in content.decode("utf-8").splitlines():
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if self.retry_errors and result.get("error"):
+                self.retried_ids.add(result.get("custom_id"))
+                continue
+            self.finished_ids.add(result.get("custom_id"))
+
+    def is_finished(self, custom_id: str) -> bool:
+        return custom_id in self.finished_ids
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def write(self, result: dict):
+        self.file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.finished_ids.add(result["custom_id"])
+        self.unsynced_count += 1
+        if self.unsynced_count >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced_count = 0
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+            if self.retried_ids:
+                self.drop_superseded_lines()
+
+    @staticmethod
+    def get_custom_id(line: str):
+        try:
+            return json.loads(line).get("custom_id")
+        except ValueError:
+            return None
+
+    def drop_superseded_lines(self):
+        # keep only the last line of each retried custom ID, then swap in atomically
+        last_line_numbers = {}
+        with open(self.path, "r", encoding="utf-8") as rf:
+            for line_number, line in enumerate(rf):
+                custom_id = self.get_custom_id(line)
+                if custom_id in self.retried_ids:
+                    last_line_numbers[custom_id] = line_number
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(self.path, "r", encoding="utf-8") as rf:
+            with open(temp_path, "w", encoding="utf-8") as wf:
+                for line_number, line in enumerate(rf):
+                    custom_id = self.get_custom_id(line)
+                    if last_line_numbers.get(custom_id, line_number) == line_number:
+                        wf.write(line)
+                wf.flush()
+                os.fsync(wf.fileno())
+        os.replace(temp_path, self.path)
+        self.retried_ids = set()
+
+
+class BatchStats:
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.ok_count = 0
+        self.error_count = 0
+        self.skipped_count = 0
+        self.ttfts = []
+        self.token_rates = []
+        self.completion_tokens = 0
+
+    def add(self, result: dict):
+        if result.get("error"):
+            self.error_count += 1
+            return
+        self.ok_count += 1
+        metrics = result["metrics"]
+        self.completion_tokens += metrics["completion_tokens"]
+        if metrics["ttft"] is not None:
+            self.ttfts.append(metrics["ttft"])
+        if metrics["tokens_per_second"]:
+            self.token_rates.append(metrics["tokens_per_second"])
+
+    def log(self):
+        elapsed_time = max(time.monotonic() - self.start_time, 1e-6)
+        finished_count = self.ok_count + self.error_count
+        logger.note(
+            f"> Batch finished: {self.ok_count} ok, {self.error_count} errors, "
+            f"{self.skipped_count} skipped (resumed), in {elapsed_time:.1f}s"
+        )
+        logger.mesg(
+            f"  * throughput: {finished_count / elapsed_time:.2f} req/s, "
+            f"{self.completion_tokens / elapsed_time:.1f} tokens/s"
+        )
+        if self.ttfts:
+            logger.mesg(
+                f"  * ttft: mean {statistics.mean(self.ttfts):.2f}s, "
+                f"p50 {get_percentile(self.ttfts, 50):.2f}s, "
+                f"p90 {get_percentile(self.ttfts, 90):.2f}s, "
+                f"p99 {get_percentile(self.ttfts, 99):.2f}s"
+            )
+        if self.token_rates:
+            logger.mesg(
+                f"  * token rate per stream: "
+                f"mean {statistics.mean(self.token_rates):.1f} tokens/s, "
+                f"p50 {get_percentile(self.token_rates, 50):.1f} tokens/s"
+            )
+
+
+class BatchRunner:
+    """
+    Run chat requests of a JSONL file with the streamers directly,
+    by `concurrency` workers, and write results to an output JSONL.
+
+    Input lines are same as `/v1/batch`: `{"custom_id": ..., "body": {...}}`,
+    or flat chat requests, and lines without `custom_id` are named by line index.
+    """
+
+    def __init__(
+        self,
+        input_path: str,
+        output_path: str,
+        concurrency: int = 8,
+        api_key: str = None,
+        timeout: float = None,
+        retry_errors: bool = False,
+    ):
+        self.input_path = Path(input_path)
+        self.concurrency = concurrency
+        self.api_key = api_key
+        self.timeout = timeout
+        self.checkpoint = BatchCheckpoint(output_path, retry_errors=retry_errors)
+        self.stats = BatchStats()
+
+    def iter_items(self):
+        # (index, line) of unfinished items, read lazily for large files
+        with open(self.input_path, "r", encoding="utf-8") as rf:
+            for index, line in enumerate(rf):
+                if not line.strip():
+                    continue
+                try:
+                    custom_id, _ = parse_batch_line(line, index)
+                except ValueError:
+                    custom_id = f"request-{index}"
+                if self.checkpoint.is_finished(custom_id):
+                    self.stats.skipped_count += 1
+                    continue
+                yield index, line
+
+    def count_tokens(self, model: str, content: str) -> int:
+        try:
+            return TokenChecker(model=model).encode_content(content)
+        except Exception:
+            return math.ceil(len(content) / 4)
+
+    async def request_upstream(self, item, deadline: RequestDeadline):
+        # returns (streamer, stream_response)
+        if item.model == "gpt-3.5-turbo":
+            streamer = OpenaiStreamer(deadline=deadline)
+            stream_response = await anyio.to_thread.run_sync(
+                streamer.chat_response, item.messages
+            )
+        elif item.model in PRO_MODELS:
+            streamer = HuggingchatStreamer(model=item.model, deadline=deadline)
+            stream_response = await anyio.to_thread.run_sync(
+                streamer.chat_response, item.messages
+            )
+        else:
+            streamer = AsyncHuggingfaceStreamer(model=item.model, deadline=deadline)
+            composer = MessageComposer(model=item.model)
+            composer.merge(messages=item.messages)
+            try:
+                stream_response = await streamer.chat_response(
+                    prompt=composer.merged_str,
+                    messages=item.messages,
+                    temperature=item.temperature,
+                    top_p=item.top_p,
+                    max_new_tokens=item.max_tokens,
+                    api_key=self.api_key,
+                    use_cache=item.use_cache,
+                    hedge=item.hedge,
+                )
+            except ModelLoadingException as e:
+                stream_response = await streamer.retry_loading(e)
+        return streamer, stream_response
+
+    async def iter_deltas(self, streamer, stream_response):
+        deltas = streamer.chat_return_deltas(stream_response)
+        if inspect.isasyncgen(deltas):
+            async for delta in deltas:
+                yield delta
+            return
+        try:
+            while True:
+                delta = await anyio.to_thread.run_sync(
+                    next, deltas, None, abandon_on_cancel=True
+                )
+                if delta is None:
+                    break
+                yield delta
+        finally:
+            streamer.close_response(stream_response)
+
+    async def run_item(self, index: int, line: str) -> dict:
+        result = {"id": f"batch_req_{index}", "custom_id": f"request-{index}"}
+        start_time = time.monotonic()
+        try:
+            result["custom_id"], body = parse_batch_line(line, index)
+            item = ChatCompletionsPostItem(**body)
+        except (ValueError, ValidationError) as e:
+            result["error"] = {"code": 400, "message": f"Invalid request: {e}"}
+            return result
+        try:
+            deadline = RequestDeadline.from_request(self.timeout)
+            streamer, stream_response = await self.request_upstream(item, deadline)
+            status_code = getattr(stream_response, "status_code", 200)
+            if status_code != 200:
+                closed = streamer.close_response(stream_response)
+                if inspect.isawaitable(closed):
+                    await closed
+                result["error"] = {
+                    "code": status_code,
+                    "message": f"Upstream error: {status_code}",
+                }
+                return result
+
+            # stream is read to the end, so that the response is closed by streamer
+            ttft, contents = None, []
+            async for content, content_type in self.iter_deltas(
+                streamer, stream_response
+            ):
+                if content_type != "Completions":
+                    continue
+                if content and ttft is None:
+                    ttft = time.monotonic() - start_time
+                contents.append(content)
+        except Exception as e:
+            status_code = getattr(e, "status_code", 500)
+            message = getattr(e, "detail", None) or str(e)
+            result["error"] = {"code": status_code, "message": message}
+            return result
+
+        latency = time.monotonic() - start_time
+        content = "".join(contents).strip()
+        # counting could load tokenizer, so keep it off the event loop
+        completion_tokens = await asyncio.to_thread(
+            self.count_tokens, streamer.model, content
+        )
+        stream_time = latency - (ttft or latency)
+        tokens_per_second = completion_tokens / stream_time if stream_time > 0 else 0
+        body = streamer.message_outputer.default_data.copy()
+        body["choices"] = [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }
+        ]
+        result["response"] = {"status_code": 200, "body": body}
+        result["metrics"] = {
+            "ttft": round(ttft, 4) if ttft is not None else None,
+            "latency": round(latency, 4),
+            "completion_tokens": completion_tokens,
+            "tokens_per_second": round(tokens_per_second, 2),
+        }
+        return result
+
+    async def work(self, items):
+        # workers share the lazy iterator of items
+        for index, line in items:
+            result = await self.run_item(index, line)
+            self.checkpoint.write(result)
+            self.stats.add(result)
+            finished_count = self.stats.ok_count + self.stats.error_count
+            if finished_count % 100 == 0:
+                logger.note(f"> Finished {finished_count} items")
+
+    async def run(self):
+        self.checkpoint.load()
+        self.checkpoint.open()
+        logger.note(
+            f"> Run batch: {self.input_path}, "
+            f"{len(self.checkpoint.finished_ids)} items finished before"
+        )
+        items = self.iter_items()
+        try:
+            await asyncio.gather(*[self.work(items) for _ in range(self.concurrency)])
+        finally:
+            self.checkpoint.close()
+            self.stats.log()
+            await CONNECTION_POOLS.aclose()
+
+
+class ArgParser(argparse.ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super(ArgParser, self).__init__(*args, **kwargs)
+
+        self.add_argument("input", type=str, help="Input JSONL of chat requests")
+        self.add_argument(
+            "-o",
+            "--output",
+            type=str,
+            default=None,
+            help="Output JSONL of results, also the checkpoint to resume from",
+        )
+        self.add_argument(
+            "-c",
+            "--concurrency",
+            type=int,
+            default=8,
+            help="Number of requests in flight",
+        )
+        self.add_argument(
+            "-k",
+            "--api-key",
+            type=str,
+            default=None,
+            help="HF token for HF inference requests",
+        )
+        self.add_argument(
+            "-t",
+            "--timeout",
+            type=float,
+            default=None,
+            help="Deadline of each request in seconds",
+        )
+        self.add_argument(
+            "-r",
+            "--retry-errors",
+            default=False,
+            action="store_true",
+            help="Run failed items of the output again",
+        )
+
+        self.args = self.parse_args(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    args = ArgParser().args
+    input_path = Path(args.input)
+    output_path = args.output or input_path.with_suffix(".results.jsonl")
+    runner = BatchRunner(
+        input_path,
+        output_path,
+        concurrency=args.concurrency,
+        api_key=args.api_key,
+        timeout=args.timeout,
+        retry_errors=args.retry_errors,
+    )
+    try:
+        asyncio.run(runner.run())
+    except KeyboardInterrupt:
+        logger.warn("× Batch interrupted, run again to resume")
+
+    # python -m apis.batch_runner requests.jsonl -o results.jsonl -c 16
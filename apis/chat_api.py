@@ -1,29 +1,71 @@
+import anyio
 import argparse
+import asyncio
+import inspect
+import json
 import markdown2
 import os
 import sys
+import tempfile
 import uvicorn
 
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Union
 
-from fastapi import FastAPI, Depends, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Depends, Header, HTTPException, Request, Response
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+from pydantic import ValidationError
 from sse_starlette.sse import EventSourceResponse, ServerSentEvent
 from tclogger import logger
 
+from apis.chat_items import ChatCompletionsPostItem, parse_batch_line
 from constants.models import AVAILABLE_MODELS_DICTS, PRO_MODELS
 from constants.envs import CONFIG, SECRETS
-from networks.exceptions import HfApiException, INVALID_API_KEY_ERROR
+from networks.exceptions import (
+    HfApiException,
+    ModelLoadingException,
+    INVALID_API_KEY_ERROR,
+)
+from networks.metrics import METRICS
 
 from messagers.message_composer import MessageComposer
+from messagers.stream_coalescer import StreamCoalescer
+from messagers.token_checker import TokenChecker
+from messagers.tokenizer_registry import TOKENIZERS
 from mocks.stream_chat_mocker import stream_chat_mock
 
-from networks.huggingface_streamer import HuggingfaceStreamer
+from networks.connection_pools import CONNECTION_POOLS
+from networks.fair_scheduler import FAIR_SCHEDULER
+from networks.admission_control import ADMISSION_CONTROL
+from networks.circuit_breaker import CIRCUIT_BREAKERS
+from networks.completion_cache import COMPLETION_CACHE, CachedStreamer
+from networks.completion_cache import CompletionRecorder, get_completion_key
+from networks.completion_store import COMPLETION_STORE
+from networks.huggingchat_session_pool import HUGGINGCHAT_SESSION_POOL
+from networks.hf_token_pool import HF_TOKEN_POOL
+from networks.huggingface_streamer import AsyncHuggingfaceStreamer
+from networks.model_loading_scheduler import MODEL_LOADING_SCHEDULER
+from networks.openai_requirements_pool import OPENAI_REQUIREMENTS_POOL
 from networks.huggingchat_streamer import HuggingchatStreamer
 from networks.openai_streamer import OpenaiStreamer
+from networks.request_deadline import RequestDeadline
+from networks.single_flight import SINGLE_FLIGHT, FlightStreamer
+from networks.token_rate_limiter import TOKEN_RATE_LIMITER
+
+
+def is_response_ok(stream_response) -> bool:
+    return getattr(stream_response, "status_code", 200) == 200
+
+
+def get_backend_name(model: str) -> str:
+    if model == "gpt-3.5-turbo":
+        return "openai"
+    if model in PRO_MODELS:
+        return "hf_chat"
+    return "hf_inference"
 
 
 class ChatAPIApp:
@@ -33,12 +75,34 @@ class ChatAPIApp:
             title=CONFIG["app_name"],
             swagger_ui_parameters={"defaultModelsExpandDepth": -1},
             version=CONFIG["version"],
+            lifespan=self.lifespan,
         )
         self.setup_routes()
 
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        if (CONFIG["tokenizers"] or {}).get("preload"):
+            TOKENIZERS.preload_in_background()
+        HUGGINGCHAT_SESSION_POOL.start()
+        COMPLETION_STORE.start()
+        yield
+        HUGGINGCHAT_SESSION_POOL.stop()
+        COMPLETION_STORE.stop()
+        OPENAI_REQUIREMENTS_POOL.stop()
+        await CONNECTION_POOLS.aclose()
+
     def get_available_models(self):
         return {"object": "list", "data": AVAILABLE_MODELS_DICTS}
 
+    def get_metrics(self):
+        return METRICS.snapshot()
+
+    def get_circuit_breakers(self):
+        return CIRCUIT_BREAKERS.get_status()
+
+    def get_hf_tokens(self):
+        return HF_TOKEN_POOL.get_status()
+
     def extract_api_key(
         credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer()),
     ):
@@ -63,78 +127,486 @@ class ChatAPIApp:
 
         raise INVALID_API_KEY_ERROR
 
-    class ChatCompletionsPostItem(BaseModel):
-        model: str = Field(
-            default="nous-mixtral-8x7b",
-            description="(str) `nous-mixtral-8x7b`",
-        )
-        messages: list = Field(
-            default=[{"role": "user", "content": "Hello, who are you?"}],
-            description="(list) Messages",
-        )
-        temperature: Union[float, None] = Field(
-            default=0.5,
-            description="(float) Temperature",
-        )
-        top_p: Union[float, None] = Field(
-            default=0.95,
-            description="(float) top p",
-        )
-        max_tokens: Union[int, None] = Field(
-            default=-1,
-            description="(int) Max tokens",
-        )
-        use_cache: bool = Field(
-            default=False,
-            description="(bool) Use cache",
-        )
-        stream: bool = Field(
-            default=True,
-            description="(bool) Stream",
-        )
-
-    def chat_completions(
-        self, item: ChatCompletionsPostItem, api_key: str = Depends(extract_api_key)
-    ):
+    async def guard_stream(self, streamer, stream_response, outputs, admission=None):
+        # when client disconnects, the generator is cancelled,
+        # so the upstream response is closed at once to free the connection and worker
         try:
-            api_key = self.auth_api_key(api_key)
-
-            if item.model == "gpt-3.5-turbo":
-                streamer = OpenaiStreamer()
-                stream_response = streamer.chat_response(messages=item.messages)
-            elif item.model in PRO_MODELS:
-                streamer = HuggingchatStreamer(model=item.model)
-                stream_response = streamer.chat_response(
-                    messages=item.messages,
-                )
+            if inspect.isasyncgen(outputs):
+                async for output in outputs:
+                    yield output
             else:
-                streamer = HuggingfaceStreamer(model=item.model)
-                composer = MessageComposer(model=item.model)
-                composer.merge(messages=item.messages)
-                stream_response = streamer.chat_response(
+                # worker thread blocked in reading is abandoned on cancel,
+                # and exits once the upstream response is closed
+                while True:
+                    output = await anyio.to_thread.run_sync(
+                        next, outputs, None, abandon_on_cancel=True
+                    )
+                    if output is None:
+                        break
+                    yield output
+        except (anyio.get_cancelled_exc_class(), GeneratorExit):
+            METRICS.inc("abandoned_streams", model=streamer.model)
+            logger.warn(f"× Stream abandoned by client: {streamer.model}")
+            raise
+        finally:
+            # response could be got later, e.g., after waiting for model loading
+            if stream_response is None:
+                stream_response = getattr(streamer, "stream_response", None)
+            if stream_response is not None:
+                with anyio.CancelScope(shield=True):
+                    closed = streamer.close_response(stream_response)
+                    if inspect.isawaitable(closed):
+                        await closed
+            if admission:
+                admission.release()
+
+    async def request_upstream(self, item, composer, api_key, deadline):
+        # returns (streamer, stream_response, loading_error)
+        if item.model == "gpt-3.5-turbo":
+            streamer = OpenaiStreamer(deadline=deadline)
+            stream_response = await run_in_threadpool(
+                streamer.chat_response, messages=item.messages
+            )
+        elif item.model in PRO_MODELS:
+            streamer = HuggingchatStreamer(model=item.model, deadline=deadline)
+            stream_response = await run_in_threadpool(
+                streamer.chat_response, messages=item.messages
+            )
+        else:
+            streamer = AsyncHuggingfaceStreamer(model=item.model, deadline=deadline)
+            try:
+                stream_response = await streamer.chat_response(
                     prompt=composer.merged_str,
+                    messages=item.messages,
                     temperature=item.temperature,
                     top_p=item.top_p,
                     max_new_tokens=item.max_tokens,
                     api_key=api_key,
                     use_cache=item.use_cache,
+                    hedge=item.hedge,
                 )
+            except ModelLoadingException as e:
+                if not MODEL_LOADING_SCHEDULER.enabled:
+                    raise
+                return streamer, None, e
+        return streamer, stream_response, None
+
+    async def reserve_tokens(self, api_key, item):
+        # prompt tokens are reserved before the request is admitted
+        if not TOKEN_RATE_LIMITER.is_limited(api_key, item.model):
+            return None
+        # checker loads tokenizer of cold models, so keep it off the event loop
+        def count_tokens():
+            return TokenChecker(model=item.model, messages=item.messages).count_tokens()
+
+        prompt_tokens = await asyncio.to_thread(count_tokens)
+        return TOKEN_RATE_LIMITER.reserve(api_key, item.model, prompt_tokens)
+
+    def lead_flight(
+        self,
+        flight,
+        streamer,
+        stream_response,
+        recorder=None,
+        loading_error=None,
+        meter=None,
+    ):
+        # upstream stream is shared with followers, also while the model is loading
+        if stream_response is not None and not is_response_ok(stream_response):
+            SINGLE_FLIGHT.fail(
+                flight,
+                HfApiException(
+                    status_code=stream_response.status_code,
+                    detail="Upstream of the shared request failed",
+                ),
+            )
+            return streamer, stream_response, recorder, meter
+        # shared stream is not cut by the deadline of leader, but each reader is
+        deadline, streamer.deadline = streamer.deadline, RequestDeadline()
+        if stream_response is None:
+            deltas = self.get_deltas_after_loading(
+                streamer, loading_error, recorder, meter
+            )
+        else:
+            deltas = self.get_stream_deltas(streamer, stream_response, recorder, meter)
+        SINGLE_FLIGHT.start(flight, streamer, stream_response, deltas)
+        # deltas are recorded and metered by the flight
+        return FlightStreamer(flight, deadline=deadline), flight, None, None
+
+    async def get_deltas_after_loading(
+        self, streamer, error: ModelLoadingException, recorder=None, meter=None
+    ):
+        # model loading is waited once by the flight, for leader and followers
+        stream_response = await streamer.retry_loading(error)
+        if not is_response_ok(stream_response):
+            raise HfApiException(
+                status_code=stream_response.status_code,
+                detail="Upstream of the shared request failed",
+            )
+        async for delta in self.get_stream_deltas(
+            streamer, stream_response, recorder, meter
+        ):
+            yield delta
+
+    async def follow_flight(self, flight, deadline):
+        streamer = FlightStreamer(flight, deadline=deadline)
+        try:
+            await flight.wait_started(deadline.remaining())
+        except BaseException:
+            streamer.close_response(flight)
+            raise
+        logger.success(f"> Follow in-flight request: {flight.model}")
+        return streamer, flight
+
+    def get_stream_deltas(self, streamer, stream_response, recorder=None, meter=None):
+        # deltas of upstream are recorded for completion cache,
+        # and metered for token rate limit, before coalesced
+        deltas = streamer.chat_return_deltas(stream_response)
+        is_async = inspect.isasyncgen(deltas)
+        if meter is not None:
+            deltas = meter.ameter(deltas) if is_async else meter.meter(deltas)
+        if recorder is not None:
+            deltas = recorder.arecord(deltas) if is_async else recorder.record(deltas)
+        return deltas
+
+    def get_stream_outputs(
+        self, streamer, stream_response, coalescer=None, recorder=None, meter=None
+    ):
+        is_wrapped = recorder is not None or meter is not None
+        if not is_wrapped or not is_response_ok(stream_response):
+            return streamer.chat_return_generator(stream_response, coalescer=coalescer)
+        outputer = streamer.message_outputer
+        deltas = self.get_stream_deltas(streamer, stream_response, recorder, meter)
+        if inspect.isasyncgen(deltas):
+            return outputer.aoutput_deltas(deltas, coalescer=coalescer)
+        return outputer.output_deltas(deltas, coalescer=coalescer)
+
+    async def stream_after_loading(
+        self,
+        streamer,
+        error: ModelLoadingException,
+        coalescer=None,
+        recorder=None,
+        meter=None,
+    ):
+        # client connection is kept alive by pings of `EventSourceResponse`
+        try:
+            stream_response = await streamer.retry_loading(error)
+        except Exception as e:
+            # response headers are sent, so report the error in the stream
+            logger.warn(f"× Model loading failed: {e}")
+            error = {
+                "code": getattr(e, "status_code", 500),
+                "message": getattr(e, "detail", str(e)),
+            }
+            yield ServerSentEvent(data=json.dumps({"error": error}))
+            return
+        async for output in self.get_stream_outputs(
+            streamer, stream_response, coalescer, recorder, meter
+        ):
+            yield output
+
+    def get_batch_parallelism(self) -> dict:
+        # parallelism of a batch, per backend of streamers
+        configs = CONFIG["batch"] or {}
+        parallelism = configs.get("parallelism") or {}
+        return {
+            backend: max(int(parallelism.get(backend, 4)), 1)
+            for backend in ["hf_inference", "hf_chat", "openai"]
+        }
+
+    async def run_batch_item(
+        self, index, line, semaphores, api_key, x_priority
+    ) -> dict:
+        result = {"id": f"batch_req_{index}", "custom_id": None}
+        try:
+            result["custom_id"], body = parse_batch_line(line, index)
+            item = ChatCompletionsPostItem(**body)
+        except (ValueError, ValidationError) as e:
+            # `json.JSONDecodeError` is also a `ValueError`
+            METRICS.inc("batch_items", backend="unknown", status="invalid")
+            result["error"] = {"code": 400, "message": f"Invalid request: {e}"}
+            return result
+        item.stream = False
+        backend = get_backend_name(item.model)
+        async with semaphores[backend]:
+            try:
+                # parallelism of batch is bounded by its semaphores, so items
+                # neither wait in, nor starve the per-key admission of the caller
+                data_response = await self.create_chat_completion(
+                    item, api_key=api_key, x_priority=x_priority, limit_key=False
+                )
+                result["response"] = {"status_code": 200, "body": data_response}
+                METRICS.inc("batch_items", backend=backend, status="ok")
+            except HTTPException as e:
+                METRICS.inc("batch_items", backend=backend, status="error")
+                result["error"] = {"code": e.status_code, "message": e.detail}
+        return result
+
+    async def spool_batch_lines(self, request: Request, max_items: int):
+        # non-empty lines of body are spooled to a temporary file, read lazily later
+        spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        items_count = 0
+
+        def add_line(line: bytes):
+            nonlocal items_count
+            if not line.strip():
+                return
+            items_count += 1
+            if items_count > max_items:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Too many batch items: > {max_items}",
+                )
+            spool.write(line.rstrip(b"\r") + b"\n")
+
+        try:
+            buffer = b""
+            async for chunk in request.stream():
+                *lines, buffer = (buffer + chunk).split(b"\n")
+                for line in lines:
+                    add_line(line)
+            add_line(buffer)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool, items_count
+
+    async def batch_completions(
+        self,
+        request: Request,
+        api_key: str = Depends(extract_api_key),
+        x_priority: Union[str, None] = Header(
+            default=None,
+            description="(str) `interactive` or `bulk`, default by API key, or `bulk`",
+        ),
+    ):
+        # JSONL of chat requests, each line is `{"custom_id": ..., "body": {...}}`,
+        # and results are streamed back as JSONL, in order of completion
+        try:
+            self.auth_api_key(api_key)
+        except HfApiException as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        max_items = int((CONFIG["batch"] or {}).get("max_items", 50000))
+        # body is read before streaming, as the response also listens on `receive`
+        spool, items_count = await self.spool_batch_lines(request, max_items)
+        parallelism = self.get_batch_parallelism()
+        semaphores = {
+            backend: asyncio.Semaphore(value) for backend, value in parallelism.items()
+        }
+        workers_count = sum(parallelism.values())
+        logger.note(f"> Batch of {items_count} requests")
+
+        async def put_items(items: asyncio.Queue):
+            for index, line in enumerate(spool):
+                await items.put((index, line.decode("utf-8")))
+            for _ in range(workers_count):
+                await items.put(None)
+
+        async def work(items: asyncio.Queue, results: asyncio.Queue):
+            while (item := await items.get()) is not None:
+                index, line = item
+                await results.put(
+                    await self.run_batch_item(
+                        index, line, semaphores, api_key, x_priority
+                    )
+                )
+            await results.put(None)
+
+        async def run_batch():
+            # bounded queues, so items are read and run only as results are sent
+            items = asyncio.Queue(maxsize=workers_count)
+            results = asyncio.Queue(maxsize=workers_count)
+            tasks = [asyncio.create_task(put_items(items))] + [
+                asyncio.create_task(work(items, results))
+                for _ in range(workers_count)
+            ]
+            try:
+                running_count = workers_count
+                while running_count:
+                    result = await results.get()
+                    if result is None:
+                        running_count -= 1
+                        continue
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+            finally:
+                # client disconnected, so pending items are not sent upstream
+                for task in tasks:
+                    task.cancel()
+                spool.close()
+
+        return StreamingResponse(run_batch(), media_type="application/x-ndjson")
+
+    async def chat_completions(
+        self,
+        item: ChatCompletionsPostItem,
+        response: Response,
+        api_key: str = Depends(extract_api_key),
+        x_request_timeout: Union[float, None] = Header(
+            default=None,
+            description="(float) Deadline of whole request in seconds, including the stream",
+        ),
+        x_priority: Union[str, None] = Header(
+            default=None,
+            description="(str) `interactive` or `bulk`, default by API key, or by `stream`",
+        ),
+    ):
+        data_response = await self.create_chat_completion(
+            item,
+            api_key=api_key,
+            x_request_timeout=x_request_timeout,
+            x_priority=x_priority,
+        )
+        if not item.stream:
+            response.headers.update(TOKEN_RATE_LIMITER.get_headers(api_key, item.model))
+        return data_response
+
+    async def create_chat_completion(
+        self,
+        item: ChatCompletionsPostItem,
+        api_key: str = None,
+        x_request_timeout: float = None,
+        x_priority: str = None,
+        limit_key: bool = True,
+    ):
+        # HF inference streams natively on the event loop,
+        # while HuggingChat and OpenAI requesters still run in the threadpool
+        deadline = RequestDeadline.from_request(x_request_timeout)
+        # streams and shared flights release the admission once they end
+        admission, is_admission_handed_over = None, False
+        try:
+            request_api_key = api_key
+            api_key = self.auth_api_key(api_key)
+
+            composer = MessageComposer(model=item.model)
+            composer.merge(messages=item.messages)
+            request_key = get_completion_key(
+                item.model,
+                composer.merged_str,
+                item.temperature,
+                item.top_p,
+                item.max_tokens,
+            )
+            completion, recorder, flight, meter = None, None, None, None
+            is_cacheable = COMPLETION_CACHE.is_cacheable(
+                item.temperature, item.completion_cache
+            )
+            if is_cacheable:
+                completion = await COMPLETION_CACHE.aget(
+                    request_key, model=item.model
+                )
+            if not completion and SINGLE_FLIGHT.is_enabled(
+                item.temperature, item.single_flight
+            ):
+                flight, is_leader = SINGLE_FLIGHT.join(request_key, item.model)
+
+            loading_error = None
+            if completion:
+                streamer = CachedStreamer(completion, COMPLETION_CACHE.replay_interval)
+                stream_response = completion
+            elif flight and not is_leader:
+                streamer, stream_response = await self.follow_flight(flight, deadline)
+            else:
+                try:
+                    meter = await self.reserve_tokens(request_api_key, item)
+                    admission = await ADMISSION_CONTROL.admit(
+                        request_api_key,
+                        item.model,
+                        get_backend_name(item.model),
+                        priority=FAIR_SCHEDULER.get_priority(
+                            request_api_key, item.stream, x_priority
+                        ),
+                        deadline=deadline,
+                        limit_key=limit_key,
+                    )
+                    streamer, stream_response, loading_error = (
+                        await self.request_upstream(item, composer, api_key, deadline)
+                    )
+                except BaseException as e:
+                    if flight:
+                        SINGLE_FLIGHT.fail(flight, e)
+                    if meter:
+                        # e.g., rejected by admission, or failed before upstream
+                        meter.cancel()
+                    raise
+                if is_cacheable:
+                    recorder = CompletionRecorder(
+                        COMPLETION_CACHE,
+                        request_key,
+                        model=streamer.model,
+                        owned_by=streamer.message_outputer.owned_by,
+                        streamer=streamer,
+                    )
+                if flight:
+                    streamer, stream_response, recorder, meter = self.lead_flight(
+                        flight,
+                        streamer,
+                        stream_response,
+                        recorder,
+                        loading_error,
+                        meter,
+                    )
+                if isinstance(streamer, FlightStreamer):
+                    # shared upstream holds the admission until the flight ends,
+                    # rather than the client of leader, which could disconnect early
+                    flight.task.add_done_callback(
+                        lambda _, admission=admission: admission.release()
+                    )
+                    admission = None
+
+            coalescer = StreamCoalescer(
+                max_delay_ms=item.coalesce_ms, max_bytes=item.coalesce_bytes
+            )
+            if item.stream and stream_response is None:
+                outputs = self.stream_after_loading(
+                    streamer, loading_error, coalescer, recorder, meter
+                )
+            elif item.stream:
+                outputs = self.get_stream_outputs(
+                    streamer, stream_response, coalescer, recorder, meter
+                )
+            elif stream_response is None:
+                stream_response = await streamer.retry_loading(loading_error)
 
             if item.stream:
+                is_admission_handed_over = True
                 event_source_response = EventSourceResponse(
-                    streamer.chat_return_generator(stream_response),
+                    self.guard_stream(streamer, stream_response, outputs, admission),
                     media_type="text/event-stream",
+                    headers=TOKEN_RATE_LIMITER.get_headers(request_api_key, item.model),
                     ping=2000,
                     ping_message_factory=lambda: ServerSentEvent(**{"comment": ""}),
                 )
                 return event_source_response
+            elif isinstance(
+                streamer, (AsyncHuggingfaceStreamer, CachedStreamer, FlightStreamer)
+            ):
+                data_response = await streamer.chat_return_dict(stream_response)
             else:
-                data_response = streamer.chat_return_dict(stream_response)
-                return data_response
+                data_response = await run_in_threadpool(
+                    streamer.chat_return_dict, stream_response
+                )
+            if recorder and is_response_ok(stream_response):
+                recorder.record_dict(data_response)
+            if meter and is_response_ok(stream_response):
+                await asyncio.to_thread(meter.settle_dict, data_response)
+            return data_response
         except HfApiException as e:
-            raise HTTPException(status_code=e.status_code, detail=e.detail)
+            raise HTTPException(
+                status_code=e.status_code, detail=e.detail, headers=e.headers
+            )
         except Exception as e:
+            # upstream timeouts which are caused by the deadline
+            if deadline.is_expired():
+                METRICS.inc("deadline_exceeded", stage="setup")
+                raise HTTPException(
+                    status_code=504, detail=f"Request deadline exceeded: {e}"
+                )
             raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            if admission and not is_admission_handed_over:
+                admission.release()
 
     def get_readme(self):
         readme_path = Path(__file__).parents[1] / "README.md"
@@ -163,6 +635,27 @@ class ChatAPIApp:
                 summary="Chat completions in conversation session",
                 include_in_schema=include_in_schema,
             )(self.chat_completions)
+        for prefix in ["", "/v1"]:
+            self.app.post(
+                prefix + "/batch",
+                summary="Batch chat completions in JSONL",
+                include_in_schema=prefix == "/v1",
+            )(self.batch_completions)
+        self.app.get(
+            "/metrics",
+            summary="Metrics of HF LLM API",
+            include_in_schema=False,
+        )(self.get_metrics)
+        self.app.get(
+            "/circuit_breakers",
+            summary="States of circuit breakers of models and backends",
+            include_in_schema=False,
+        )(self.get_circuit_breakers)
+        self.app.get(
+            "/hf_tokens",
+            summary="Usage and rate limit states of HF tokens in pool",
+            include_in_schema=False,
+        )(self.get_hf_tokens)
         self.app.get(
             "/readme",
             summary="README of HF LLM API",
@@ -0,0 +1,69 @@
+import json
+
+from typing import Union
+
+from pydantic import BaseModel, Field
+
+
+class ChatCompletionsPostItem(BaseModel):
+    model: str = Field(
+        default="nous-mixtral-8x7b",
+        description="(str) `nous-mixtral-8x7b`",
+    )
+    messages: list = Field(
+        default=[{"role": "user", "content": "Hello, who are you?"}],
+        description="(list) Messages",
+    )
+    temperature: Union[float, None] = Field(
+        default=0.5,
+        description="(float) Temperature",
+    )
+    top_p: Union[float, None] = Field(
+        default=0.95,
+        description="(float) top p",
+    )
+    max_tokens: Union[int, None] = Field(
+        default=-1,
+        description="(int) Max tokens",
+    )
+    use_cache: bool = Field(
+        default=False,
+        description="(bool) Use cache",
+    )
+    stream: bool = Field(
+        default=True,
+        description="(bool) Stream",
+    )
+    coalesce_ms: Union[int, None] = Field(
+        default=0,
+        description="(int) Merge stream deltas into one event until N ms have passed (0 to disable)",
+    )
+    coalesce_bytes: Union[int, None] = Field(
+        default=0,
+        description="(int) Merge stream deltas into one event until N bytes are buffered (0 to disable)",
+    )
+    hedge: Union[bool, None] = Field(
+        default=None,
+        description="(bool) Send a hedge request if first token is slow (HF inference only, default by config)",
+    )
+    single_flight: Union[bool, None] = Field(
+        default=None,
+        description="(bool) Share the upstream stream of identical in-flight requests (default by config, only for temperature near 0 unless true, never if disabled by config)",
+    )
+    completion_cache: Union[bool, None] = Field(
+        default=None,
+        description="(bool) Serve identical requests from server-side completion cache (default by config, only for temperature near 0 unless true)",
+    )
+
+
+def parse_batch_line(line: str, index: int) -> tuple[str, dict]:
+    # returns (custom_id, body), line is in OpenAI batch format, or a flat request
+    data = json.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError("Batch line is not a JSON object")
+    custom_id = str(data.get("custom_id", f"request-{index}"))
+    if isinstance(data.get("body"), dict):
+        body = data["body"]
+    else:
+        body = {key: value for key, value in data.items() if key != "custom_id"}
+    return custom_id, body
@@ -1,9 +1,8 @@
 import re
 from pprint import pprint
 
-from transformers import AutoTokenizer
-
 from constants.models import AVAILABLE_MODELS, MODEL_MAP
+from messagers.template_engine import CHAT_TEMPLATES
 from tclogger import logger
 
 
@@ -19,31 +18,36 @@ class MessageComposer:
         self.answer_roles = ["assistant", "bot", "answer", "model"]
         self.default_role = "user"
 
-    def concat_messages_by_role(self, messages):
-        def is_same_role(role1, role2):
-            if (
-                (role1 == role2)
-                or (role1 in self.inst_roles and role2 in self.inst_roles)
-                or (role1 in self.answer_roles and role2 in self.answer_roles)
-            ):
-                return True
-            else:
-                return False
+    def get_concat_role(self, role):
+        if role in self.inst_roles:
+            return "inst"
+        elif role in self.answer_roles:
+            return "answer"
+        else:
+            return None
 
-        concat_messages = []
+    def concat_messages_by_role(self, messages):
+        # Single pass: contents of consecutive messages with the same role
+        # are collected, and joined only once at the end.
+        # Unknown roles always start a new "inst" message.
+        # The caller's messages are never mutated.
+        concat_roles = []
+        concat_contents = []
         for message in messages:
-            role = message["role"]
-            content = message["content"]
-            if concat_messages and is_same_role(role, concat_messages[-1]["role"]):
-                concat_messages[-1]["content"] += "\n" + content
+            concat_role = self.get_concat_role(message["role"])
+            if concat_role and concat_roles and concat_role == concat_roles[-1]:
+                concat_contents[-1].append(message["content"])
             else:
-                if role in self.inst_roles:
-                    message["role"] = "inst"
-                elif role in self.answer_roles:
-                    message["role"] = "answer"
-                else:
-                    message["role"] = "inst"
-                concat_messages.append(message)
+                concat_roles.append(concat_role or "inst")
+                concat_contents.append([message["content"]])
+
+        concat_messages = [
+            {
+                "role": role,
+                "content": contents[0] if len(contents) == 1 else "\n".join(contents),
+            }
+            for role, contents in zip(concat_roles, concat_contents)
+        ]
         return concat_messages
 
     def merge(self, messages) -> str:
@@ -53,6 +57,7 @@ class MessageComposer:
         #   - https://huggingface.co/NousResearch/Nous-Hermes-2-Mixtral-8x7B-DPO#prompt-format
         #   - https://huggingface.co/openchat/openchat-3.5-0106
         #   - https://huggingface.co/google/gemma-7b-it#chat-template
+        #   - https://huggingface.co/01-ai/Yi-1.5-34B-Chat
 
         # Mistral and Mixtral:
         #   <s> [INST] Instruction [/INST] Model answer </s> [INST] Follow-up instruction [/INST]
@@ -72,97 +77,19 @@ class MessageComposer:
         # How does the brain work?<end_of_turn>
         # <start_of_turn>model
 
-        self.messages = messages
-        self.merged_str = ""
+        # Yi-1.5:
+        #   <|im_start|>user
+        #   Hello, who are you?<|im_end|>
+        #   <|im_start|>assistant
 
-        # https://huggingface.co/mistralai/Mixtral-8x7B-Instruct-v0.1#instruction-format
-        if self.model in ["mixtral-8x7b", "mistral-7b"]:
-            self.messages = self.concat_messages_by_role(messages)
-            self.cached_str = ""
-            for message in self.messages:
-                role = message["role"]
-                content = message["content"]
-                if role in self.inst_roles:
-                    self.cached_str = f"[INST] {content} [/INST]"
-                elif role in self.answer_roles:
-                    self.merged_str += f"<s> {self.cached_str} {content} </s>\n"
-                    self.cached_str = ""
-                else:
-                    self.cached_str = f"[INST] {content} [/INST]"
-            if self.cached_str:
-                self.merged_str += f"{self.cached_str}"
-        # https://huggingface.co/NousResearch/Nous-Hermes-2-Mixtral-8x7B-DPO#prompt-format
-        elif self.model in ["nous-mixtral-8x7b"]:
-            self.merged_str_list = []
-            for message in self.messages:
-                role = message["role"]
-                content = message["content"]
-                if role not in ["system", "user", "assistant"]:
-                    role = self.default_role
-                message_line = f"<|im_start|>{role}\n{content}<|im_end|>"
-                self.merged_str_list.append(message_line)
-            self.merged_str_list.append("<|im_start|>assistant")
-            self.merged_str = "\n".join(self.merged_str_list)
-        # https://huggingface.co/openchat/openchat-3.5-0106
-        elif self.model in ["openchat-3.5"]:
-            self.messages = self.concat_messages_by_role(messages)
-            self.merged_str_list = []
-            self.end_of_turn = "<|end_of_turn|>"
-            for message in self.messages:
-                role = message["role"]
-                content = message["content"]
-                if role in self.inst_roles:
-                    self.merged_str_list.append(
-                        f"GPT4 Correct User:\n{content}{self.end_of_turn}"
-                    )
-                elif role in self.answer_roles:
-                    self.merged_str_list.append(
-                        f"GPT4 Correct Assistant:\n{content}{self.end_of_turn}"
-                    )
-                else:
-                    self.merged_str_list.append(
-                        f"GPT4 Correct User: {content}{self.end_of_turn}"
-                    )
-            self.merged_str_list.append(f"GPT4 Correct Assistant:\n")
-            self.merged_str = "\n".join(self.merged_str_list)
-        # https://huggingface.co/google/gemma-1.1-7b-it#chat-template
-        elif self.model in ["gemma-7b"]:
+        # All templates are precompiled from `configs/chat_templates.json`,
+        # so no tokenizer is needed to render them
+        self.template = CHAT_TEMPLATES.get(self.model)
+        if self.template.concat_roles:
             self.messages = self.concat_messages_by_role(messages)
-            self.merged_str_list = []
-            self.end_of_turn = "<end_of_turn>"
-            self.start_of_turn = "<start_of_turn>"
-            for message in self.messages:
-                role = message["role"]
-                content = message["content"]
-                if role in self.inst_roles:
-                    self.merged_str_list.append(
-                        f"{self.start_of_turn}user\n{content}{self.end_of_turn}"
-                    )
-                elif role in self.answer_roles:
-                    self.merged_str_list.append(
-                        f"{self.start_of_turn}model\n{content}{self.end_of_turn}"
-                    )
-                else:
-                    self.merged_str_list.append(
-                        f"{self.start_of_turn}user\n{content}{self.end_of_turn}"
-                    )
-            self.merged_str_list.append(f"{self.start_of_turn}model\n")
-            self.merged_str = "<bos>" + "\n".join(self.merged_str_list)
-        # https://huggingface.co/NousResearch/Nous-Hermes-2-Mixtral-8x7B-DPO#prompt-format
-        # https://huggingface.co/openchat/openchat-3.5-0106
-        # https://huggingface.co/01-ai/Yi-1.5-34B-Chat
-        elif self.model in ["openchat-3.5", "command-r-plus", "gemma-7b", "yi-1.5-34b"]:
-            # https://discuss.huggingface.co/t/error-with-new-tokenizers-urgent/2847/5
-            tokenizer = AutoTokenizer.from_pretrained(
-                self.model_fullname, use_fast=False
-            )
-            self.merged_str = tokenizer.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=True
-            )
         else:
-            self.merged_str = "\n\n".join(
-                [f"{message['role']}: {message['content']}" for message in messages]
-            )
+            self.messages = messages
+        self.merged_str = self.template.render(self.messages)
 
         return self.merged_str
 
@@ -172,10 +99,8 @@ class MessageComposer:
         system_prompt_list = []
         user_and_assistant_messages = []
         for message in messages:
-            role = message["role"]
-            content = message["content"]
-            if role in self.system_roles:
-                system_prompt_list.append(content)
+            if message["role"] in self.system_roles:
+                system_prompt_list.append(message["content"])
             else:
                 user_and_assistant_messages.append(message)
         system_prompt = "\n".join(system_prompt_list)
@@ -183,17 +108,17 @@ class MessageComposer:
         input_prompt_list = []
         input_messages = self.concat_messages_by_role(user_and_assistant_messages)
         for message in input_messages:
-            role = message["role"]
-            content = message["content"]
-            if role in self.answer_roles:
-                role_content_str = f"`assistant`:\n{content}"
+            if input_prompt_list:
+                input_prompt_list.append("\n\n")
+            if message["role"] in self.answer_roles:
+                input_prompt_list.append("`assistant`:\n")
             else:
-                role_content_str = f"`user`:\n{content}"
-            input_prompt_list.append(role_content_str)
-        input_prompt = "\n\n".join(input_prompt_list)
+                input_prompt_list.append("`user`:\n")
+            input_prompt_list.append(message["content"])
 
         if append_assistant:
-            input_prompt += "\n\n`assistant`:"
+            input_prompt_list.append("\n\n`assistant`:")
+        input_prompt = "".join(input_prompt_list)
 
         return system_prompt, input_prompt
 
@@ -1,5 +1,32 @@
 import json
 
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+
+
+CONTENT_PLACEHOLDER = "__CONTENT_PLACEHOLDER__"
+
+
+@lru_cache(maxsize=None)
+def get_chunk_templates(owned_by: str, model: str):
+    """
+    Pre-serialize the constant parts of chunks of a model:
+    * "Role", "Finished" and unknown chunks are constant strings
+    * "Completions" chunks are (prefix, suffix) around the escaped content
+    """
+    outputer = OpenaiStreamOutputer.__new__(OpenaiStreamOutputer)
+    outputer.init_default_data(owned_by=owned_by, model=model)
+    build = outputer.build_data
+
+    completions_str = json.dumps(build(CONTENT_PLACEHOLDER, "Completions"))
+    prefix, suffix = completions_str.split(json.dumps(CONTENT_PLACEHOLDER))
+    return {
+        "Role": json.dumps(build(None, "Role")),
+        "Finished": json.dumps(build(None, "Finished")),
+        "Unknown": json.dumps(build(None, "Unknown")),
+        "Completions": (prefix, suffix),
+    }
+
 
 class OpenaiStreamOutputer:
     """
@@ -8,6 +35,14 @@ class OpenaiStreamOutputer:
     """
 
     def __init__(self, owned_by="huggingface", model="nous-mixtral-8x7b"):
+        self.init_default_data(owned_by=owned_by, model=model)
+        self.chunk_templates = get_chunk_templates(owned_by, model)
+        self.completions_prefix, self.completions_suffix = self.chunk_templates[
+            "Completions"
+        ]
+
+    def init_default_data(self, owned_by="huggingface", model="nous-mixtral-8x7b"):
+        self.owned_by = owned_by
         self.default_data = {
             "created": 1700000000,
             "id": f"chatcmpl-{owned_by}",
@@ -21,7 +56,7 @@ class OpenaiStreamOutputer:
         data_str = f"{json.dumps(data)}"
         return data_str
 
-    def output(self, content=None, content_type="Completions") -> str:
+    def build_data(self, content=None, content_type="Completions") -> dict:
         data = self.default_data.copy()
         if content_type == "Role":
             data["choices"] = [
@@ -62,4 +97,34 @@ class OpenaiStreamOutputer:
                     "finish_reason": None,
                 }
             ]
-        return self.data_to_string(data, content_type)
+        return data
+
+    def output(self, content=None, content_type="Completions") -> str:
+        # Called once per token, so only the content is escaped and spliced
+        # into pre-serialized chunks, which is byte-identical to `json.dumps()`
+        if content_type in ["Completions", "SuggestedResponses"]:
+            if type(content) is str:
+                content_str = encode_basestring_ascii(content)
+            else:
+                content_str = json.dumps(content)
+            return self.completions_prefix + content_str + self.completions_suffix
+        elif content_type in ["InternalSearchQuery", "InternalSearchResult"]:
+            return self.data_to_string(self.build_data(content, content_type))
+        elif content_type in ["Role", "Finished"]:
+            return self.chunk_templates[content_type]
+        else:
+            return self.chunk_templates["Unknown"]
+
+    def output_deltas(self, deltas, coalescer=None):
+        # deltas: iterable of (content, content_type)
+        if coalescer and coalescer.is_enabled():
+            deltas = coalescer.coalesce(deltas)
+        for content, content_type in deltas:
+            yield self.output(content=content, content_type=content_type)
+
+    async def aoutput_deltas(self, deltas, coalescer=None):
+        # deltas: async iterable of (content, content_type)
+        if coalescer and coalescer.is_enabled():
+            deltas = coalescer.acoalesce(deltas)
+        async for content, content_type in deltas:
+            yield self.output(content=content, content_type=content_type)
@@ -0,0 +1,94 @@
+import anyio
+import asyncio
+import time
+
+
+class StreamCoalescer:
+    """
+    Merge consecutive "Completions" deltas into fewer SSE events.
+
+    Buffered deltas are flushed once `max_delay_ms` have passed since the last
+    event, or `max_bytes` of content are buffered, whichever comes first.
+    The first token and any non-"Completions" delta (e.g., "Finished")
+    are never held back, and flush the buffer before them.
+    In async streams, the buffer is also flushed when `max_delay_ms` have passed
+    without new deltas, so a stalled upstream does not hold buffered tokens.
+    """
+
+    def __init__(self, max_delay_ms: int = 0, max_bytes: int = 0):
+        self.max_delay = (max_delay_ms or 0) / 1000
+        self.max_bytes = max_bytes or 0
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.last_emit_time = None
+
+    def is_enabled(self):
+        return self.max_delay > 0 or self.max_bytes > 0
+
+    def flush(self) -> list[tuple]:
+        if not self.buffer:
+            return []
+        content = "".join(self.buffer)
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.last_emit_time = time.monotonic()
+        return [(content, "Completions")]
+
+    def get_remaining_delay(self) -> float:
+        # None if nothing is held back by delay
+        if not self.buffer or not self.max_delay:
+            return None
+        return max(self.last_emit_time + self.max_delay - time.monotonic(), 0)
+
+    def add(self, content: str, content_type: str = "Completions") -> list[tuple]:
+        if content_type != "Completions":
+            return self.flush() + [(content, content_type)]
+
+        now = time.monotonic()
+        if self.last_emit_time is None:
+            self.last_emit_time = now
+            return [(content, content_type)]
+
+        self.buffer.append(content)
+        self.buffer_bytes += len(content.encode("utf-8"))
+        if (self.max_bytes and self.buffer_bytes >= self.max_bytes) or (
+            self.max_delay and now - self.last_emit_time >= self.max_delay
+        ):
+            return self.flush()
+        return []
+
+    def coalesce(self, deltas):
+        for content, content_type in deltas:
+            yield from self.add(content, content_type)
+        yield from self.flush()
+
+    async def acoalesce(self, deltas):
+        # next delta is waited no longer than the remaining delay,
+        # and is not cancelled on timeout, as that would break the upstream stream
+        deltas = aiter(deltas)
+        next_task = None
+        try:
+            while True:
+                if next_task is None:
+                    next_task = asyncio.ensure_future(anext(deltas))
+                done, _ = await asyncio.wait(
+                    {next_task}, timeout=self.get_remaining_delay()
+                )
+                if not done:
+                    for delta in self.flush():
+                        yield delta
+                    continue
+                task, next_task = next_task, None
+                try:
+                    content, content_type = task.result()
+                except StopAsyncIteration:
+                    break
+                for delta in self.add(content, content_type):
+                    yield delta
+            for delta in self.flush():
+                yield delta
+        finally:
+            if next_task is not None:
+                next_task.cancel()
+                with anyio.CancelScope(shield=True):
+                    await asyncio.wait({next_task})
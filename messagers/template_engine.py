@@ -0,0 +1,129 @@
+import json
+import string
+import threading
+
+from pathlib import Path
+
+from tclogger import logger
+
+
+templates_path = Path(__file__).parents[1] / "configs" / "chat_templates.json"
+
+
+def compile_pattern(pattern: str):
+    # "<|im_start|>user\n{content}<|im_end|>"
+    #   -> (("<|im_start|>user\n", "content"), ("<|im_end|>", None))
+    if pattern is None:
+        return None
+    return tuple(
+        (literal, field) for literal, field, _, _ in string.Formatter().parse(pattern)
+    )
+
+
+def extend_parts(parts: list, pieces: tuple, values: dict):
+    for literal, field in pieces:
+        if literal:
+            parts.append(literal)
+        if field is not None:
+            parts.append(values[field])
+
+
+class ChatTemplate:
+    """
+    Chat template of a model, compiled from `configs/chat_templates.json`.
+
+    * `turns`: each message is rendered by the pattern of its role,
+        and joined with `separator`, followed by the `generation` prompt
+    * `pairs`: each instruction is held until its answer arrives,
+        then both are rendered by the `pair` pattern (Mistral and Mixtral)
+
+    `render()` only collects string pieces, and joins them once at the end.
+    """
+
+    def __init__(self, model: str, spec: dict):
+        self.model = model
+        self.spec = spec
+        self.style = spec.get("style", "turns")
+        self.concat_roles = spec.get("concat_roles", False)
+        self.bos = spec.get("bos", "")
+        self.separator = spec.get("separator", "")
+        self.generation = spec.get("generation")
+        self.leading_system = compile_pattern(spec.get("leading_system"))
+        self.role_patterns = {
+            role: compile_pattern(pattern)
+            for role, pattern in spec.get("roles", {}).items()
+        }
+        self.inst_pattern = compile_pattern(spec.get("inst"))
+        self.pair_pattern = compile_pattern(spec.get("pair"))
+        if self.style == "pairs":
+            self.render = self.render_pairs
+        else:
+            self.render = self.render_turns
+
+    def render_turns(self, messages: list[dict]) -> str:
+        parts = [self.bos]
+        if self.leading_system and messages and messages[0]["role"] == "system":
+            extend_parts(parts, self.leading_system, messages[0])
+
+        default_pattern = self.role_patterns.get("*")
+        is_first_turn = True
+        for message in messages:
+            pattern = self.role_patterns.get(message["role"], default_pattern)
+            if pattern is None:
+                continue
+            if not is_first_turn:
+                parts.append(self.separator)
+            extend_parts(parts, pattern, message)
+            is_first_turn = False
+
+        if self.generation is not None:
+            if not is_first_turn:
+                parts.append(self.separator)
+            parts.append(self.generation)
+        return "".join(parts)
+
+    def render_pairs(self, messages: list[dict]) -> str:
+        # expects messages concatenated by role, i.e., roles are "inst" or "answer"
+        parts = [self.bos]
+        inst_parts = []
+        for message in messages:
+            if message["role"] == "answer":
+                values = {"inst": "".join(inst_parts), "content": message["content"]}
+                extend_parts(parts, self.pair_pattern, values)
+                inst_parts = []
+            else:
+                inst_parts = []
+                extend_parts(inst_parts, self.inst_pattern, message)
+        parts.extend(inst_parts)
+        return "".join(parts)
+
+
+class ChatTemplateEngine:
+    def __init__(self, templates_path: Path = templates_path):
+        self.templates_path = templates_path
+        self.specs = None
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def load_specs(self):
+        with open(self.templates_path, "r", encoding="utf-8") as rf:
+            self.specs = json.load(rf)
+
+    def get(self, model: str) -> ChatTemplate:
+        template = self.templates.get(model)
+        if template is not None:
+            return template
+        with self.lock:
+            if model not in self.templates:
+                if self.specs is None:
+                    self.load_specs()
+                if model in self.specs:
+                    spec = self.specs[model]
+                else:
+                    logger.warn(f"No chat template for [{model}], use default")
+                    spec = self.specs["default"]
+                self.templates[model] = ChatTemplate(model, spec)
+        return self.templates[model]
+
+
+CHAT_TEMPLATES = ChatTemplateEngine()
@@ -1,12 +1,61 @@
+import hashlib
+import threading
+
+from collections import OrderedDict
+
 from tclogger import logger
-from transformers import AutoTokenizer
 
+from constants.envs import CONFIG
 from constants.models import MODEL_MAP, TOKEN_LIMIT_MAP, TOKEN_RESERVED
+from messagers.message_composer import MessageComposer
+from messagers.tokenizer_registry import TOKENIZERS
+
+
+class TokenCountCache:
+    """
+    LRU cache of token counts, keyed by model and the hash of message content.
+
+    Chat clients resend the whole history on each turn,
+    so only the newest messages are actually encoded.
+    """
+
+    def __init__(self, max_size: int = None):
+        if max_size is None:
+            max_size = (CONFIG["tokenizers"] or {}).get("count_cache_size", 65536)
+        self.max_size = int(max_size)
+        self.counts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_key(self, model: str, content: str):
+        content_hash = hashlib.blake2b(
+            content.encode("utf-8", errors="surrogatepass"), digest_size=16
+        ).digest()
+        return (model, content_hash)
+
+    def get_or_count(self, model: str, content: str, count_func) -> int:
+        key = self.get_key(model, content)
+        with self.lock:
+            if key in self.counts:
+                self.counts.move_to_end(key)
+                return self.counts[key]
+        token_count = count_func(content)
+        with self.lock:
+            self.counts[key] = token_count
+            while len(self.counts) > self.max_size:
+                self.counts.popitem(last=False)
+        return token_count
+
+
+TOKEN_COUNT_CACHE = TokenCountCache()
 
 
 class TokenChecker:
-    def __init__(self, input_str: str, model: str):
+    # (model) -> {"prompt": int, "message": int}
+    template_overheads = {}
+
+    def __init__(self, input_str: str = None, model: str = None, messages=None):
         self.input_str = input_str
+        self.messages = messages
 
         if model in MODEL_MAP.keys():
             self.model = model
@@ -14,24 +63,63 @@ class TokenChecker:
             self.model = "nous-mixtral-8x7b"
 
         self.model_fullname = MODEL_MAP[self.model]
+        self.tokenizer = TOKENIZERS.get(self.model)
+        self.token_count = None
 
-        # As some models are gated, we need to fetch tokenizers from alternatives
-        GATED_MODEL_MAP = {
-            "llama3-70b": "NousResearch/Meta-Llama-3-70B",
-            "gemma-7b": "unsloth/gemma-7b",
-            "mistral-7b": "dfurman/Mistral-7B-Instruct-v0.2",
-            "mixtral-8x7b": "dfurman/Mixtral-8x7B-Instruct-v0.1",
-        }
-        if self.model in GATED_MODEL_MAP.keys():
-            self.tokenizer = AutoTokenizer.from_pretrained(GATED_MODEL_MAP[self.model])
-        else:
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_fullname)
+    def encode_content(self, content: str) -> int:
+        return len(self.tokenizer.encode(content, add_special_tokens=False))
 
-    def count_tokens(self):
-        token_count = len(self.tokenizer.encode(self.input_str))
-        logger.note(f"Prompt Token Count: {token_count}")
+    def count_content_tokens(self, content: str) -> int:
+        return TOKEN_COUNT_CACHE.get_or_count(
+            self.model, content, self.encode_content
+        )
+
+    def get_template_overhead(self):
+        # Measure once per model how many tokens the chat template adds:
+        #   * `prompt`: bos, generation prompt, ...
+        #   * `message`: role headers and end-of-turn tokens of each message
+        if self.model in self.template_overheads:
+            return self.template_overheads[self.model]
+
+        probe = "Hello"
+        probe_count = self.encode_content(probe)
+        composer = MessageComposer(model=self.model)
+        one_turn = composer.merge([{"role": "user", "content": probe}])
+        three_turns = composer.merge(
+            [
+                {"role": "user", "content": probe},
+                {"role": "assistant", "content": probe},
+                {"role": "user", "content": probe},
+            ]
+        )
+        one_turn_overhead = len(self.tokenizer.encode(one_turn)) - probe_count
+        three_turns_overhead = len(self.tokenizer.encode(three_turns)) - 3 * probe_count
+        message_overhead = max(-(-(three_turns_overhead - one_turn_overhead) // 2), 0)
+        prompt_overhead = max(one_turn_overhead - message_overhead, 0)
+
+        overhead = {"prompt": prompt_overhead, "message": message_overhead}
+        self.template_overheads[self.model] = overhead
+        return overhead
+
+    def count_messages_tokens(self, messages: list[dict]) -> int:
+        # The sum of per-message counts is an estimate of the merged prompt,
+        # as tokens may merge across message boundaries in rare cases
+        overhead = self.get_template_overhead()
+        token_count = overhead["prompt"]
+        for message in messages:
+            token_count += overhead["message"]
+            token_count += self.count_content_tokens(message["content"])
         return token_count
 
+    def count_tokens(self):
+        if self.token_count is None:
+            if self.messages is not None:
+                self.token_count = self.count_messages_tokens(self.messages)
+            else:
+                self.token_count = len(self.tokenizer.encode(self.input_str))
+            logger.note(f"Prompt Token Count: {self.token_count}")
+        return self.token_count
+
     def get_token_limit(self):
         return TOKEN_LIMIT_MAP[self.model]
 
@@ -0,0 +1,117 @@
+import threading
+
+from collections import OrderedDict
+
+from tclogger import logger
+from transformers import AutoTokenizer
+
+from constants.envs import CONFIG
+from constants.models import AVAILABLE_MODELS, GATED_MODEL_MAP, MODEL_MAP
+
+
+class TokenizerRegistry:
+    """
+    Process-wide tokenizers shared by TokenChecker and MessageComposer.
+
+    Tokenizers are keyed by (repo_id, use_fast), loaded at most once,
+    and evicted in least-recently-used order when the estimated memory
+    exceeds `memory_budget_mb`.
+    """
+
+    def __init__(self, memory_budget_mb: float = None):
+        if memory_budget_mb is None:
+            memory_budget_mb = (CONFIG["tokenizers"] or {}).get("memory_budget_mb")
+        if memory_budget_mb:
+            self.memory_budget = int(float(memory_budget_mb) * 1024 * 1024)
+        else:
+            self.memory_budget = None
+        self.tokenizers = OrderedDict()
+        self.tokenizer_sizes = {}
+        self.memory_usage = 0
+        self.lock = threading.Lock()
+        self.loading_locks = {}
+
+    def get_repo_id(self, model: str):
+        if model not in MODEL_MAP.keys():
+            model = "nous-mixtral-8x7b"
+        return GATED_MODEL_MAP.get(model, MODEL_MAP[model])
+
+    def estimate_tokenizer_size(self, tokenizer):
+        # the serialized json of fast tokenizers is a good proxy of their memory
+        backend_tokenizer = getattr(tokenizer, "backend_tokenizer", None)
+        if backend_tokenizer is not None:
+            try:
+                return len(backend_tokenizer.to_str())
+            except Exception:
+                pass
+        return len(tokenizer) * 128
+
+    def evict(self):
+        # always keep the most recently used tokenizer, even if over budget
+        while (
+            self.memory_budget
+            and self.memory_usage > self.memory_budget
+            and len(self.tokenizers) > 1
+        ):
+            key, _ = self.tokenizers.popitem(last=False)
+            self.memory_usage -= self.tokenizer_sizes.pop(key)
+            logger.note(f"> Evict tokenizer: {key[0]}")
+
+    def get(self, model: str, repo_id: str = None, use_fast: bool = True):
+        if not repo_id:
+            repo_id = self.get_repo_id(model)
+        key = (repo_id, use_fast)
+
+        with self.lock:
+            if key in self.tokenizers:
+                self.tokenizers.move_to_end(key)
+                return self.tokenizers[key]
+            loading_lock = self.loading_locks.setdefault(key, threading.Lock())
+
+        # load outside the registry lock, so that other models are not blocked,
+        # while concurrent requests of the same model wait for a single load
+        with loading_lock:
+            with self.lock:
+                if key in self.tokenizers:
+                    self.tokenizers.move_to_end(key)
+                    return self.tokenizers[key]
+
+            logger.note(f"> Load tokenizer: {repo_id}")
+            tokenizer = AutoTokenizer.from_pretrained(repo_id, use_fast=use_fast)
+            tokenizer_size = self.estimate_tokenizer_size(tokenizer)
+
+            with self.lock:
+                self.tokenizers[key] = tokenizer
+                self.tokenizer_sizes[key] = tokenizer_size
+                self.memory_usage += tokenizer_size
+                self.loading_locks.pop(key, None)
+                self.evict()
+        return tokenizer
+
+    def preload(self, models: list[str] = None):
+        if models is None:
+            models = AVAILABLE_MODELS
+        repo_ids = []
+        for model in models:
+            repo_id = self.get_repo_id(model)
+            if repo_id in repo_ids:
+                continue
+            repo_ids.append(repo_id)
+            try:
+                self.get(model, repo_id=repo_id)
+            except Exception as e:
+                logger.warn(f"× Failed to preload tokenizer of [{model}]: {e}")
+
+    def preload_in_background(self, models: list[str] = None):
+        thread = threading.Thread(target=self.preload, args=(models,), daemon=True)
+        thread.start()
+        return thread
+
+
+TOKENIZERS = TokenizerRegistry()
+
+
+if __name__ == "__main__":
+    TOKENIZERS.preload()
+    logger.success(f"Memory usage: {TOKENIZERS.memory_usage/1024/1024:.2f} MB")
+    # python -m messagers.tokenizer_registry
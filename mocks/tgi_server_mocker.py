@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import json
+import sys
+
+import uvicorn
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+
+def create_tgi_mock_app(
+    ttft: float = 0.1, token_interval: float = 0.02, tokens_count: int = 10
+):
+    """
+    Mock of TGI server, which streams tokens by `POST /generate_stream`,
+    in the same format as TGI and HF inference API.
+    """
+    app = FastAPI()
+    app.state.requests_count = 0
+
+    async def stream_tokens(tokens_count: int):
+        await asyncio.sleep(ttft)
+        for i in range(tokens_count):
+            data = {
+                "token": {"id": i, "text": f" W{i+1}", "logprob": 0, "special": False},
+                "generated_text": None,
+                "details": None,
+            }
+            yield f"data:{json.dumps(data)}\n\n"
+            await asyncio.sleep(token_interval)
+        data = {
+            "token": {"id": 2, "text": "</s>", "logprob": 0, "special": True},
+            "generated_text": "",
+            "details": None,
+        }
+        yield f"data:{json.dumps(data)}\n\n"
+
+    @app.post("/generate_stream")
+    async def generate_stream(body: dict):
+        app.state.requests_count += 1
+        max_new_tokens = body.get("parameters", {}).get("max_new_tokens")
+        return StreamingResponse(
+            stream_tokens(min(tokens_count, max_new_tokens or tokens_count)),
+            media_type="text/event-stream",
+        )
+
+    return app
+
+
+class ArgParser(argparse.ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super(ArgParser, self).__init__(*args, **kwargs)
+        self.add_argument("-s", "--host", type=str, default="127.0.0.1")
+        self.add_argument("-p", "--port", type=int, default=8081)
+        self.add_argument("-t", "--ttft", type=float, default=0.1)
+        self.add_argument("-i", "--token-interval", type=float, default=0.02)
+        self.args = self.parse_args(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    args = ArgParser().args
+    app = create_tgi_mock_app(ttft=args.ttft, token_interval=args.token_interval)
+    uvicorn.run(app, host=args.host, port=args.port)
+
+    # python -m mocks.tgi_server_mocker -p 8081 -t 0.1
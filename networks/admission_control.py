@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import math
+import time
+
+from collections import deque
+
+from fastapi import status
+
+from constants.envs import CONFIG
+from networks.exceptions import HfApiException
+from networks.fair_scheduler import FAIR_SCHEDULER, INTERACTIVE, SchedulerTicket
+from networks.metrics import METRICS
+from networks.request_deadline import RequestDeadline
+
+
+class ConcurrencyLimiter:
+    """
+    At most `limit` requests at once, and others wait in a bounded FIFO queue.
+
+    Requests are rejected at once if `max_queue` requests are waiting,
+    or after waiting `max_wait` seconds. Released slots are handed over
+    to the head of the queue, so later arrivals never overtake waiters.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        max_queue: int = 64,
+        max_wait: float = 30,
+    ):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active_count = 0
+        self.waiters = deque()
+        # rolling average of how long a slot is held, for `Retry-After`
+        self.ewma_hold_time = 1.0
+
+    def get_retry_after(self) -> int:
+        retry_after = self.ewma_hold_time * (len(self.waiters) + 1) / self.limit
+        return max(math.ceil(retry_after), 1)
+
+    def reject(self, reason: str) -> HfApiException:
+        METRICS.inc("admission_rejections", limiter=self.name, reason=reason)
+        return HfApiException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Too many concurrent requests ({reason}): {self.name}",
+            headers={"Retry-After": str(self.get_retry_after())},
+        )
+
+    async def acquire(self, timeout: float = None):
+        if self.active_count < self.limit and not self.waiters:
+            self.active_count += 1
+            METRICS.observe("admission_wait_seconds", 0, limiter=self.name)
+            return
+        if len(self.waiters) >= self.max_queue:
+            raise self.reject("queue_full")
+
+        start_time = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        if timeout is None:
+            timeout = self.max_wait
+        else:
+            timeout = min(timeout, self.max_wait)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # slot was handed over meanwhile, so pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                raise self.reject("timeout")
+            raise
+        METRICS.observe(
+            "admission_wait_seconds", time.monotonic() - start_time, limiter=self.name
+        )
+
+    def release(self, hold_time: float = None):
+        if hold_time is not None:
+            self.ewma_hold_time += 0.2 * (hold_time - self.ewma_hold_time)
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # hand over the slot, so active count is unchanged
+                waiter.set_result(None)
+                return
+        self.active_count -= 1
+
+
+class Admission:
+    """
+    Slots of a request in its limiters and in the fair scheduler,
+    released once (idempotent).
+    """
+
+    def __init__(
+        self, limiters: list[ConcurrencyLimiter], ticket: SchedulerTicket = None
+    ):
+        self.limiters = limiters
+        self.ticket = ticket or SchedulerTicket()
+        self.start_time = time.monotonic()
+        self.is_released = False
+
+    def release(self):
+        if self.is_released:
+            return
+        self.is_released = True
+        self.ticket.release()
+        hold_time = time.monotonic() - self.start_time
+        for limiter in reversed(self.limiters):
+            limiter.release(hold_time)
+
+
+class AdmissionControl:
+    """
+    Concurrency limits of each API key, model and backend, from config:
+
+        "admission_control": {
+            "keys": {"default": 0, "<api_key>": 16},
+            "models": {"default": 0, "<model>": 4},
+            "backends": {"hf_inference": 64, "hf_chat": 8, "openai": 4},
+        }
+
+    Limit of 0 (or unset, without default) means unlimited.
+    Key and model limits are opt-in, as anonymous callers share one key,
+    and only backends are capped by default.
+    Limiters are acquired in order of key, model and backend,
+    so requests never wait for each other in a cycle.
+    Admitted requests are then dispatched by `FAIR_SCHEDULER`.
+    Batch items skip the key limit, as batch has its own parallelism.
+    """
+
+    def __init__(self):
+        configs = CONFIG["admission_control"] or {}
+        self.enabled = configs.get("enabled", True)
+        self.max_queue = int(configs.get("max_queue", 64))
+        self.max_wait = float(configs.get("max_wait", 30))
+        self.limits = {
+            kind: configs.get(kind) or {} for kind in ["keys", "models", "backends"]
+        }
+        self.limiters = {}
+        METRICS.register_collector(self.collect_metrics)
+
+    def get_key_name(self, api_key: str = None) -> str:
+        # keys are hashed, so they do not leak into metrics
+        if not api_key:
+            return "anonymous"
+        return hashlib.sha1(api_key.encode("utf-8")).hexdigest()[:8]
+
+    def get_limiter(self, kind: str, name: str, limit_name: str = None):
+        key = f"{kind}:{name}"
+        if key not in self.limiters:
+            limits = self.limits[kind]
+            limit = int(limits.get(limit_name or name, limits.get("default", 0)) or 0)
+            if limit <= 0:
+                self.limiters[key] = None
+            else:
+                self.limiters[key] = ConcurrencyLimiter(
+                    key, limit, max_queue=self.max_queue, max_wait=self.max_wait
+                )
+        return self.limiters[key]
+
+    def get_limiters(
+        self, api_key: str, model: str, backend: str, limit_key: bool = True
+    ):
+        limiters = [
+            self.get_limiter("models", model),
+            self.get_limiter("backends", backend),
+        ]
+        if limit_key:
+            limiters.insert(
+                0, self.get_limiter("keys", self.get_key_name(api_key), api_key)
+            )
+        return [limiter for limiter in limiters if limiter is not None]
+
+    async def admit(
+        self,
+        api_key: str,
+        model: str,
+        backend: str,
+        priority: str = INTERACTIVE,
+        deadline: RequestDeadline = None,
+        limit_key: bool = True,
+    ) -> Admission:
+        deadline = deadline or RequestDeadline()
+        acquired_limiters = []
+        try:
+            if self.enabled:
+                limiters = self.get_limiters(api_key, model, backend, limit_key)
+                for limiter in limiters:
+                    await limiter.acquire(timeout=deadline.remaining())
+                    acquired_limiters.append(limiter)
+            ticket = await FAIR_SCHEDULER.acquire(
+                self.get_key_name(api_key),
+                api_key,
+                priority=priority,
+                timeout=deadline.remaining(),
+            )
+        except BaseException:
+            for limiter in reversed(acquired_limiters):
+                limiter.release()
+            raise
+        return Admission(acquired_limiters, ticket)
+
+    def collect_metrics(self, metrics):
+        for name, limiter in list(self.limiters.items()):
+            if limiter is None:
+                continue
+            metrics.set("admission_queue_depth", len(limiter.waiters), limiter=name)
+            metrics.set("admission_in_flight", limiter.active_count, limiter=name)
+
+
+ADMISSION_CONTROL = AdmissionControl()
@@ -0,0 +1,174 @@
+import random
+import threading
+
+from constants.envs import CONFIG
+from constants.models import MODEL_MAP
+from networks.circuit_breaker import CIRCUIT_BREAKERS
+from networks.metrics import METRICS
+
+
+DEFAULT_BACKEND = {
+    "name": "hf_inference",
+    "url": "https://api-inference.huggingface.co/models/{model_fullname}",
+    "forward_api_key": True,
+}
+
+
+class Backend:
+    """
+    One upstream endpoint which serves text-generation streams of a model,
+    e.g., HF inference API, mirrors, self-hosted TGI (`/generate_stream`) or proxies.
+
+    * `url`: could contain `{model_fullname}`
+    * `proxy`, `use_proxy`: proxy of this endpoint, default to global proxy
+    * `api_key`: token for this endpoint
+    * `forward_api_key`: whether to send user's HF token to this endpoint
+    """
+
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        proxy: str = None,
+        use_proxy: bool = True,
+        api_key: str = None,
+        forward_api_key: bool = False,
+        initial_latency: float = 1.0,
+        ewma_alpha: float = 0.3,
+    ):
+        self.name = name
+        self.breaker_name = f"backend:{name}"
+        self.url = url
+        self.proxy = proxy
+        self.use_proxy = use_proxy
+        self.api_key = api_key
+        self.forward_api_key = forward_api_key
+        self.ewma_alpha = ewma_alpha
+
+        self.ewma_latency = initial_latency
+        self.in_flight = 0
+        self.requests_count = 0
+        self.failures_count = 0
+        self.lock = threading.Lock()
+
+    def get_url(self, model_fullname: str) -> str:
+        return self.url.format(model_fullname=model_fullname)
+
+    def get_api_key(self, user_api_key: str = None):
+        if self.api_key:
+            return self.api_key
+        if self.forward_api_key:
+            return user_api_key
+        return None
+
+    def get_score(self) -> float:
+        # expected wait of a new request: latency scaled by streams in progress
+        return self.ewma_latency * (self.in_flight + 1)
+
+    def acquire(self):
+        with self.lock:
+            self.in_flight += 1
+            self.requests_count += 1
+
+    def release(self, latency: float = None, ok: bool = True, penalty: float = 10):
+        with self.lock:
+            self.in_flight = max(self.in_flight - 1, 0)
+            if not ok:
+                self.failures_count += 1
+                latency = max(latency or 0, penalty)
+            if latency is not None:
+                self.ewma_latency += self.ewma_alpha * (latency - self.ewma_latency)
+
+
+class BackendPool:
+    """
+    Backends of a model, selected by EWMA latency and in-flight streams:
+    * `least_loaded`: the one with lowest score
+    * `p2c`: the better one of two random backends (power of two choices),
+        which avoids herding onto the same backend
+    """
+
+    def __init__(self, model: str, backends: list[Backend], strategy: str = "p2c"):
+        self.model = model
+        self.backends = backends
+        self.strategy = strategy
+
+    def select(self, exclude: list[Backend] = None) -> Backend:
+        candidates = [
+            backend for backend in self.backends if backend not in (exclude or [])
+        ]
+        if not candidates:
+            return None
+        if self.strategy == "p2c" and len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        return min(candidates, key=lambda backend: backend.get_score())
+
+
+class BackendPools:
+    """
+    Backend pool of each model in `MODEL_MAP`, from `backends.models` in config:
+
+        "backends": {"models": {"<model>": [{"name": "...", "url": "..."}, ...]}}
+
+    Models without configured backends use the public HF inference API.
+    """
+
+    def __init__(self):
+        configs = CONFIG["backends"] or {}
+        self.strategy = configs.get("strategy", "p2c")
+        self.ewma_alpha = float(configs.get("ewma_alpha", 0.3))
+        self.initial_latency = float(configs.get("initial_latency", 1))
+        self.failure_penalty = float(configs.get("failure_penalty", 10))
+        self.pools = {}
+        self.backends = {}
+        models_configs = configs.get("models", {})
+        for model in MODEL_MAP.keys():
+            backends_configs = models_configs.get(model) or [DEFAULT_BACKEND]
+            self.pools[model] = BackendPool(
+                model,
+                [self.create_backend(config) for config in backends_configs],
+                strategy=self.strategy,
+            )
+        METRICS.register_collector(self.collect_metrics)
+
+    def create_backend(self, config: dict) -> Backend:
+        # backends of same name are shared by models, e.g., one TGI proxy for all
+        name = config["name"]
+        if name not in self.backends:
+            self.backends[name] = Backend(
+                initial_latency=self.initial_latency,
+                ewma_alpha=self.ewma_alpha,
+                **config,
+            )
+        return self.backends[name]
+
+    def get(self, model: str) -> BackendPool:
+        return self.pools[model]
+
+    def select(self, model: str, exclude: list[Backend] = None) -> Backend:
+        # skip backends whose circuit breakers are open
+        pool = self.get(model)
+        exclude = list(exclude or []) + [
+            backend
+            for backend in pool.backends
+            if not CIRCUIT_BREAKERS.is_available(backend.breaker_name)
+        ]
+        return pool.select(exclude=exclude)
+
+    def release(self, backend: Backend, latency: float = None, ok: bool = True):
+        backend.release(latency=latency, ok=ok, penalty=self.failure_penalty)
+
+    def collect_metrics(self, metrics):
+        for name, backend in self.backends.items():
+            with backend.lock:
+                stats = {
+                    "backend_in_flight": backend.in_flight,
+                    "backend_ewma_latency_seconds": backend.ewma_latency,
+                    "backend_requests": backend.requests_count,
+                    "backend_failures": backend.failures_count,
+                }
+            for key, value in stats.items():
+                metrics.set(key, value, backend=name)
+
+
+BACKEND_POOLS = BackendPools()
@@ -0,0 +1,258 @@
+import math
+import threading
+import time
+
+from collections import deque
+
+from fastapi import status
+
+from constants.envs import CONFIG
+from networks.exceptions import HfApiException
+from networks.metrics import METRICS
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def is_upstream_failure(status_code: int) -> bool:
+    # client errors (e.g., invalid token, bad request) are not upstream failures
+    return status_code == 429 or status_code >= 500
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one upstream, e.g., a model or a backend.
+
+    * closed: calls pass, and outcomes in recent `window` seconds are kept.
+        Trips to open when error rate or slow-call rate exceeds its threshold.
+    * open: calls are rejected at once, until `open_duration` has passed.
+    * half-open: one probe call passes (another one after `probe_timeout`),
+        success closes the breaker, and failure re-opens it with doubled duration.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window: float = 60,
+        min_requests: int = 5,
+        error_rate: float = 0.5,
+        slow_call_latency: float = 30,
+        slow_call_rate: float = 0.8,
+        open_duration: float = 10,
+        max_open_duration: float = 120,
+        probe_timeout: float = 30,
+    ):
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_call_latency = slow_call_latency
+        self.slow_call_rate = slow_call_rate
+        self.base_open_duration = open_duration
+        self.max_open_duration = max_open_duration
+        self.probe_timeout = probe_timeout
+
+        self.state = CLOSED
+        # (time, ok, is_slow)
+        self.outcomes = deque()
+        self.open_duration = open_duration
+        self.opened_at = None
+        self.probe_started_at = None
+        self.trips_count = 0
+        self.lock = threading.Lock()
+
+    def discard_old_outcomes(self, now: float):
+        while self.outcomes and now - self.outcomes[0][0] > self.window:
+            self.outcomes.popleft()
+
+    def update_state(self, now: float):
+        if self.state == OPEN and now - self.opened_at >= self.open_duration:
+            self.state = HALF_OPEN
+            self.probe_started_at = None
+
+    def retry_after(self, now: float = None) -> float:
+        now = now or time.monotonic()
+        with self.lock:
+            if self.state == OPEN:
+                return max(self.opened_at + self.open_duration - now, 0)
+            if self.state == HALF_OPEN and self.probe_started_at is not None:
+                return max(self.probe_started_at + self.probe_timeout - now, 0)
+            return 0
+
+    def is_available(self, now: float = None) -> bool:
+        # whether a call would be allowed, without taking the probe
+        now = now or time.monotonic()
+        with self.lock:
+            self.update_state(now)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN:
+                return (
+                    self.probe_started_at is None
+                    or now - self.probe_started_at > self.probe_timeout
+                )
+            return False
+
+    def allow(self, now: float = None) -> bool:
+        now = now or time.monotonic()
+        with self.lock:
+            self.update_state(now)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and (
+                self.probe_started_at is None
+                or now - self.probe_started_at > self.probe_timeout
+            ):
+                self.probe_started_at = now
+                return True
+            return False
+
+    def release(self, started_at: float):
+        # give back the probe of a call which has failed before reaching upstream
+        with self.lock:
+            if self.state == HALF_OPEN and self.probe_started_at == started_at:
+                self.probe_started_at = None
+
+    def trip(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.probe_started_at = None
+        self.outcomes.clear()
+        self.trips_count += 1
+        METRICS.inc("circuit_breaker_trips", breaker=self.name)
+
+    def record(self, ok: bool, latency: float = None, now: float = None):
+        now = now or time.monotonic()
+        is_slow = latency is not None and latency > self.slow_call_latency
+        with self.lock:
+            self.update_state(now)
+            if self.state == OPEN:
+                # outcomes of calls which started before the breaker opened
+                return
+            if self.state == HALF_OPEN:
+                if ok and not is_slow:
+                    self.state = CLOSED
+                    self.open_duration = self.base_open_duration
+                    self.outcomes.clear()
+                else:
+                    self.open_duration = min(
+                        self.open_duration * 2, self.max_open_duration
+                    )
+                    self.trip(now)
+                return
+
+            self.outcomes.append((now, ok, is_slow))
+            self.discard_old_outcomes(now)
+            requests_count = len(self.outcomes)
+            if requests_count < self.min_requests:
+                return
+            failures_count = sum(1 for _, ok, _ in self.outcomes if not ok)
+            slow_count = sum(1 for _, _, is_slow in self.outcomes if is_slow)
+            if (
+                failures_count / requests_count >= self.error_rate
+                or slow_count / requests_count >= self.slow_call_rate
+            ):
+                self.trip(now)
+
+    def get_status(self, now: float = None) -> dict:
+        now = now or time.monotonic()
+        retry_after = self.retry_after(now)
+        with self.lock:
+            self.update_state(now)
+            self.discard_old_outcomes(now)
+            requests_count = len(self.outcomes)
+            failures_count = sum(1 for _, ok, _ in self.outcomes if not ok)
+            slow_count = sum(1 for _, _, is_slow in self.outcomes if is_slow)
+            return {
+                "state": self.state,
+                "retry_after": round(retry_after, 3),
+                "requests": requests_count,
+                "failures": failures_count,
+                "slow_calls": slow_count,
+                "trips": self.trips_count,
+            }
+
+
+class CircuitBreakers:
+    """
+    Circuit breakers of models (`model:<model>`) and backends (`backend:<name>`),
+    created on first use with settings of `circuit_breakers` in config.
+    """
+
+    def __init__(self):
+        configs = dict(CONFIG["circuit_breakers"] or {})
+        self.enabled = configs.pop("enabled", True)
+        self.breaker_configs = configs
+        self.breakers = {}
+        self.lock = threading.Lock()
+        METRICS.register_collector(self.collect_metrics)
+
+    def get(self, name: str) -> CircuitBreaker:
+        with self.lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name, **self.breaker_configs)
+            return self.breakers[name]
+
+    def is_available(self, name: str) -> bool:
+        return not self.enabled or self.get(name).is_available()
+
+    def get_open_error(self, names: list[str]) -> HfApiException:
+        retry_after = max(self.get(name).retry_after() for name in names)
+        return HfApiException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Upstream unavailable, circuit breaker is open: {', '.join(names)}",
+            headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+        )
+
+    def check(self, *names: str) -> list[tuple]:
+        # fail fast if any of the breakers rejects the call,
+        # and take half-open probes only if all of them allow it;
+        # returns probes of (name, started_at), which are given back by `release()`
+        # if the call fails before its outcome is recorded
+        if not self.enabled:
+            return []
+        now = time.monotonic()
+        breakers = [self.get(name) for name in names]
+        rejected_names = [b.name for b in breakers if not b.is_available(now)]
+        if not rejected_names:
+            probes = [(breaker.name, now) for breaker in breakers]
+            # probe could be taken by another call since peeked
+            rejected_names = [b.name for b in breakers if not b.allow(now)]
+            if not rejected_names:
+                return probes
+            self.release(probes)
+        for name in rejected_names:
+            METRICS.inc("circuit_breaker_rejections", breaker=name)
+        raise self.get_open_error(rejected_names)
+
+    def release(self, probes: list[tuple]):
+        # no-op for breakers which are closed, or have recorded the outcome
+        if not self.enabled:
+            return
+        for name, started_at in probes:
+            self.get(name).release(started_at)
+
+    def record(self, names: list[str], ok: bool, latency: float = None):
+        if not self.enabled:
+            return
+        for name in names:
+            self.get(name).record(ok, latency=latency)
+
+    def get_status(self) -> dict:
+        with self.lock:
+            breakers = dict(self.breakers)
+        return {name: breaker.get_status() for name, breaker in breakers.items()}
+
+    def collect_metrics(self, metrics):
+        for name, breaker_status in self.get_status().items():
+            metrics.set(
+                "circuit_breaker_state",
+                STATE_VALUES[breaker_status["state"]],
+                breaker=name,
+            )
+
+
+CIRCUIT_BREAKERS = CircuitBreakers()
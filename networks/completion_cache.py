@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+from tclogger import logger
+
+from constants.envs import CONFIG
+from messagers.message_outputer import OpenaiStreamOutputer
+from networks.completion_store import COMPLETION_STORE, CompletionStore
+from networks.metrics import METRICS
+
+
+def get_completion_key(
+    model: str,
+    prompt: str,
+    temperature: float = None,
+    top_p: float = None,
+    max_tokens: int = None,
+) -> str:
+    # fingerprint of a completion request, same for identical requests
+    request_str = json.dumps(
+        [model, prompt, temperature, top_p, max_tokens], ensure_ascii=False
+    )
+    return hashlib.blake2b(
+        request_str.encode("utf-8", errors="surrogatepass"), digest_size=16
+    ).hexdigest()
+
+
+class CachedCompletion:
+    def __init__(
+        self, model: str, owned_by: str, deltas: list, created_at: float = None
+    ):
+        # deltas: list of (content, content_type), as from `chat_return_deltas`
+        self.model = model
+        self.owned_by = owned_by
+        self.deltas = deltas
+        self.created_at = created_at or time.time()
+        self.nbytes = sum(len(content.encode("utf-8")) for content, _ in deltas)
+
+    def to_dict(self) -> dict:
+        return {"model": self.model, "owned_by": self.owned_by, "deltas": self.deltas}
+
+    def get_content(self) -> str:
+        return "".join(
+            content
+            for content, content_type in self.deltas
+            if content_type == "Completions"
+        )
+
+
+class CompletionCache:
+    """
+    LRU cache of completions in memory, keyed by `get_completion_key()`.
+
+    Entries expire after `ttl` seconds, and least recently used ones are evicted
+    once there are more than `max_entries` entries or `max_bytes` of contents.
+    Completions are also written to `store` on disk if given,
+    which serves misses of memory, e.g., after restarts.
+    Async callers use `aget()`, which looks up the store off the event loop.
+    """
+
+    def __init__(self, store: CompletionStore = None):
+        configs = CONFIG["completion_cache"] or {}
+        self.enabled = configs.get("enabled", True)
+        self.max_entries = int(configs.get("max_entries", 1024))
+        self.max_bytes = int(configs.get("max_bytes", 64 * 1024 * 1024))
+        self.ttl = float(configs.get("ttl", 3600))
+        self.max_temperature = float(configs.get("max_temperature", 0.1))
+        self.replay_interval = float(configs.get("replay_interval_ms", 0)) / 1000
+        self.store = store
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        METRICS.register_collector(self.collect_metrics)
+
+    def is_cacheable(
+        self, temperature: float = None, completion_cache: bool = None
+    ) -> bool:
+        # only near-deterministic completions, unless client chooses explicitly
+        if not self.enabled:
+            return False
+        if completion_cache is not None:
+            return completion_cache
+        return (temperature or 0) <= self.max_temperature
+
+    def pop(self, key: str):
+        completion = self.entries.pop(key)
+        self.total_bytes -= completion.nbytes
+        return completion
+
+    def get_entry(self, key: str) -> CachedCompletion:
+        # completion in memory, without looking up the store
+        with self.lock:
+            completion = self.entries.get(key)
+            if completion and time.time() - completion.created_at > self.ttl:
+                self.pop(key)
+                completion = None
+            if completion:
+                self.entries.move_to_end(key)
+        return completion
+
+    def count_lookup(self, completion: CachedCompletion, model: str = None):
+        if completion:
+            METRICS.inc("completion_cache_hits", model=model)
+            METRICS.inc("completion_cache_bytes_saved", completion.nbytes, model=model)
+        else:
+            METRICS.inc("completion_cache_misses", model=model)
+
+    def get(self, key: str, model: str = None) -> CachedCompletion:
+        completion = self.get_entry(key) or self.load(key)
+        self.count_lookup(completion, model)
+        return completion
+
+    async def aget(self, key: str, model: str = None) -> CachedCompletion:
+        # misses of memory read and decompress records of the store in a thread,
+        # so that the event loop is not blocked by disk
+        completion = self.get_entry(key)
+        if not completion and self.store is not None and self.store.is_open():
+            completion = await asyncio.to_thread(self.load, key)
+        self.count_lookup(completion, model)
+        return completion
+
+    def load(self, key: str) -> CachedCompletion:
+        if self.store is None:
+            return None
+        data = self.store.get(key)
+        if not data:
+            return None
+        completion = CachedCompletion(
+            data["model"],
+            data["owned_by"],
+            [tuple(delta) for delta in data["deltas"]],
+            created_at=data["created_at"],
+        )
+        self.set(key, completion, persist=False)
+        return completion
+
+    def set(self, key: str, completion: CachedCompletion, persist: bool = True):
+        if persist and self.store is not None:
+            # encoded and written by the writer thread of store
+            self.store.put(key, completion.to_dict(), completion.created_at)
+        if completion.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.pop(key)
+            self.entries[key] = completion
+            self.total_bytes += completion.nbytes
+            while (
+                len(self.entries) > self.max_entries
+                or self.total_bytes > self.max_bytes
+            ):
+                self.pop(next(iter(self.entries)))
+                METRICS.inc("completion_cache_evictions")
+
+    def collect_metrics(self, metrics):
+        with self.lock:
+            metrics.set("completion_cache_entries", len(self.entries))
+            metrics.set("completion_cache_bytes", self.total_bytes)
+
+
+class CompletionRecorder:
+    """
+    Record deltas of an upstream stream on the way to the client,
+    and cache the completion once the stream has finished.
+
+    Streams which are abandoned by client, cut by deadline or empty are not cached,
+    nor streams which end without the finish marker of upstream (`is_finished`
+    of `streamer`), e.g., on errors in the middle of stream.
+    """
+
+    def __init__(
+        self,
+        cache: CompletionCache,
+        key: str,
+        model: str,
+        owned_by: str,
+        deadline=None,
+        streamer=None,
+    ):
+        self.cache = cache
+        self.key = key
+        self.model = model
+        self.owned_by = owned_by
+        self.deadline = deadline
+        self.streamer = streamer
+        self.deltas = []
+
+    def add(self, content: str, content_type: str):
+        self.deltas.append((content, content_type))
+
+    def save(self):
+        if self.deadline is not None and self.deadline.is_stream_expired():
+            return
+        if self.streamer is not None and not self.streamer.is_finished:
+            return
+        completion = CachedCompletion(self.model, self.owned_by, self.deltas)
+        if not completion.get_content().strip():
+            return
+        self.cache.set(self.key, completion)
+
+    def record(self, deltas):
+        for content, content_type in deltas:
+            self.add(content, content_type)
+            yield content, content_type
+        self.save()
+
+    async def arecord(self, deltas):
+        async for content, content_type in deltas:
+            self.add(content, content_type)
+            yield content, content_type
+        self.save()
+
+    def record_dict(self, data: dict):
+        content = data["choices"][0]["message"]["content"]
+        self.deltas = [(content, "Completions"), ("", "Finished")]
+        self.save()
+
+
+class CachedStreamer:
+    """
+    Replay a cached completion, with the same interface as upstream streamers.
+    Deltas are paced by `replay_interval_ms` in config, if set.
+    """
+
+    def __init__(self, completion: CachedCompletion, replay_interval: float = 0):
+        self.model = completion.model
+        self.completion = completion
+        self.replay_interval = replay_interval
+        self.message_outputer = OpenaiStreamOutputer(
+            owned_by=completion.owned_by, model=completion.model
+        )
+
+    async def chat_return_deltas(self, stream_response: CachedCompletion):
+        for content, content_type in stream_response.deltas:
+            if self.replay_interval > 0:
+                await asyncio.sleep(self.replay_interval)
+            yield content, content_type
+
+    async def chat_return_generator(
+        self, stream_response: CachedCompletion, coalescer=None
+    ):
+        logger.success(f"> Replay cached completion: {self.model}")
+        async for output in self.message_outputer.aoutput_deltas(
+            self.chat_return_deltas(stream_response), coalescer=coalescer
+        ):
+            yield output
+
+    async def chat_return_dict(self, stream_response: CachedCompletion):
+        final_output = self.message_outputer.default_data.copy()
+        final_output["choices"] = [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {
+                    "role": "assistant",
+                    "content": stream_response.get_content().strip(),
+                },
+            }
+        ]
+        return final_output
+
+    def close_response(self, stream_response: CachedCompletion):
+        pass
+
+
+COMPLETION_CACHE = CompletionCache(store=COMPLETION_STORE)
@@ -0,0 +1,433 @@
+import fcntl
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from pathlib import Path
+
+from tclogger import logger
+
+from constants.envs import CONFIG
+from networks.metrics import METRICS
+
+
+# index: header of (magic, slots count, used slots count, live bytes),
+#   then open-addressing slots of (key, offset + 1, length),
+#   where offset 0 marks an empty slot
+INDEX_MAGIC = b"HFCI"
+INDEX_HEADER = struct.Struct("<4sIQQ")
+INDEX_SLOT = struct.Struct("<16sQI")
+# segment: records of header (key, created_at, payload length, crc32) + payload
+RECORD_HEADER = struct.Struct("<16sdII")
+
+
+class CompletionIndex:
+    """
+    Hash index from completion key (16 bytes) to record in segment,
+    stored in a memory-mapped file, so it is loaded without reading records,
+    and counters in its header are kept up to date without scanning slots.
+    """
+
+    def __init__(self, path: Path, slots_count: int = 65536):
+        self.path = Path(path)
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            with open(self.path, "wb") as wf:
+                wf.write(INDEX_HEADER.pack(INDEX_MAGIC, slots_count, 0, 0))
+                wf.truncate(INDEX_HEADER.size + slots_count * INDEX_SLOT.size)
+        self.file = open(self.path, "r+b")
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+        magic, self.slots_count, self.used_count, self.live_bytes = (
+            INDEX_HEADER.unpack_from(self.mmap, 0)
+        )
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"Invalid completion index: {self.path}")
+
+    def get_slot_offset(self, slot: int) -> int:
+        return INDEX_HEADER.size + slot * INDEX_SLOT.size
+
+    def probe(self, key: bytes):
+        # yields (slot_offset, key, offset, length) from the home slot of key
+        slot = int.from_bytes(key[:8], "little") % self.slots_count
+        for _ in range(self.slots_count):
+            slot_offset = self.get_slot_offset(slot)
+            yield (slot_offset, *INDEX_SLOT.unpack_from(self.mmap, slot_offset))
+            slot = (slot + 1) % self.slots_count
+
+    def get(self, key: bytes):
+        for _, slot_key, offset, length in self.probe(key):
+            if offset == 0:
+                return None
+            if slot_key == key:
+                return offset - 1, length
+        return None
+
+    def set(self, key: bytes, offset: int, length: int):
+        for slot_offset, slot_key, old_offset, old_length in self.probe(key):
+            if old_offset == 0 or slot_key == key:
+                INDEX_SLOT.pack_into(self.mmap, slot_offset, key, offset + 1, length)
+                if old_offset == 0:
+                    self.used_count += 1
+                self.live_bytes += length - old_length
+                INDEX_HEADER.pack_into(
+                    self.mmap,
+                    0,
+                    INDEX_MAGIC,
+                    self.slots_count,
+                    self.used_count,
+                    self.live_bytes,
+                )
+                return
+        raise ValueError("Completion index is full")
+
+    def items(self):
+        for slot in range(self.slots_count):
+            slot_key, offset, length = INDEX_SLOT.unpack_from(
+                self.mmap, self.get_slot_offset(slot)
+            )
+            if offset:
+                yield slot_key, offset - 1, length
+
+    def load_factor(self) -> float:
+        return self.used_count / self.slots_count
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+
+class CompletionStore:
+    """
+    Persistent completions on disk, which survive restarts and redeploys:
+
+    * `segment.dat`: append-only records of zlib-compressed completions
+    * `index.dat`: memory-mapped hash index from completion key to record
+
+    Reads are lock-free (`os.pread` + index lookup), and records are verified
+    by key and crc32, so partly written or replaced records are just misses.
+    Writes are appended under a lock, by the writer thread for `put()`.
+    The background compaction rewrites live and unexpired records into new files,
+    dropping oldest ones, and it also runs before an append which would go over
+    `max_bytes`, so the segment never grows beyond it.
+
+    Files are opened by `start()` (from the app lifespan), not on import,
+    under `~/.cache/hf-llm-api/completion_store` unless `path` is configured.
+    The store is single-process: it takes an exclusive lock of the directory,
+    and is disabled in other processes, or if the directory is not writable.
+    """
+
+    def __init__(self, path: str = None):
+        configs = CONFIG["completion_store"] or {}
+        self.enabled = configs.get("enabled", True)
+        self.path = Path(path or configs.get("path") or self.get_default_path())
+        if not self.path.is_absolute():
+            self.path = Path(__file__).parents[1] / self.path
+        self.max_bytes = int(configs.get("max_bytes", 256 * 1024 * 1024))
+        self.index_slots = int(configs.get("index_slots", 65536))
+        self.compact_ratio = float(configs.get("compact_ratio", 0.5))
+        self.compact_interval = float(configs.get("compact_interval", 600))
+        self.ttl = float((CONFIG["completion_cache"] or {}).get("ttl", 3600))
+
+        self.index = None
+        self.segment_fd = None
+        self.files = (None, None)
+        self.segment_size = 0
+        # files replaced by compaction, closed on the next one
+        self.retired_files = []
+        # (key, offset, length) of records appended during compaction
+        self.appended_records = None
+        self.lock_fd = None
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.compact_event = threading.Event()
+        self.compact_thread = None
+        self.write_queue = queue.Queue(maxsize=int(configs.get("max_pending", 1024)))
+        self.writer_thread = None
+        METRICS.register_collector(self.collect_metrics)
+
+    @staticmethod
+    def get_default_path() -> Path:
+        cache_path = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+        return Path(cache_path) / "hf-llm-api" / "completion_store"
+
+    def is_open(self) -> bool:
+        return self.index is not None
+
+    def open(self) -> bool:
+        start_time = time.perf_counter()
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.lock_fd = os.open(self.path / "lock", os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.open_files()
+        except (OSError, ValueError) as e:
+            logger.warn(f"× Completion store disabled: {self.path}: {e}")
+            self.close()
+            self.enabled = False
+            return False
+        elapsed_time = time.perf_counter() - start_time
+        logger.note(
+            f"> Completion store: {self.index.used_count} entries, "
+            f"{self.segment_size} bytes, loaded in {elapsed_time*1000:.1f}ms"
+        )
+        return True
+
+    def open_files(self):
+        self.index = CompletionIndex(self.path / "index.dat", self.index_slots)
+        self.segment_fd = os.open(
+            self.path / "segment.dat", os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644
+        )
+        self.files = (self.index, self.segment_fd)
+        self.segment_size = os.fstat(self.segment_fd).st_size
+
+    def close(self):
+        with self.lock:
+            for fd, index in self.retired_files + [(self.segment_fd, self.index)]:
+                if fd is not None:
+                    os.close(fd)
+                if index is not None:
+                    index.close()
+            self.retired_files = []
+            self.index, self.segment_fd = None, None
+            self.files = (None, None)
+            if self.lock_fd is not None:
+                # closing the fd releases the lock of directory
+                os.close(self.lock_fd)
+                self.lock_fd = None
+
+    def encode(self, key: bytes, completion: dict, created_at: float) -> bytes:
+        payload = zlib.compress(
+            json.dumps(completion, ensure_ascii=False).encode("utf-8")
+        )
+        header = RECORD_HEADER.pack(key, created_at, len(payload), zlib.crc32(payload))
+        return header + payload
+
+    def read_record(self, fd: int, key: bytes, offset: int, length: int):
+        # returns (created_at, completion), or None if record is invalid
+        record = os.pread(fd, length, offset)
+        if len(record) != length or length < RECORD_HEADER.size:
+            return None
+        record_key, created_at, payload_length, crc = RECORD_HEADER.unpack_from(record)
+        payload = record[RECORD_HEADER.size :]
+        if (
+            record_key != key
+            or payload_length != len(payload)
+            or zlib.crc32(payload) != crc
+        ):
+            return None
+        return created_at, json.loads(zlib.decompress(payload))
+
+    def get(self, key: str) -> dict:
+        # completion dict of {"model", "owned_by", "deltas", "created_at"}
+        # both from the same generation of files
+        index, fd = self.files
+        if index is None:
+            return None
+        key_bytes = bytes.fromhex(key)
+        try:
+            location = index.get(key_bytes)
+            if location is None:
+                return None
+            result = self.read_record(fd, key_bytes, *location)
+        except (OSError, ValueError) as e:
+            # files could be swapped by compaction meanwhile
+            logger.warn(f"× Completion store read failed: {e}")
+            return None
+        if result is None:
+            return None
+        created_at, completion = result
+        if time.time() - created_at > self.ttl:
+            return None
+        completion["created_at"] = created_at
+        METRICS.inc("completion_store_reads")
+        return completion
+
+    def append(self, key_bytes: bytes, record: bytes) -> bool:
+        # False if the record does not fit in `max_bytes`, or the index is too full
+        with self.lock:
+            if self.index is None:
+                return False
+            if self.segment_size + len(record) > self.max_bytes:
+                return False
+            if self.index.load_factor() >= 0.7:
+                # probes get too long, until compaction swaps in the larger index
+                return False
+            offset = self.segment_size
+            os.write(self.segment_fd, record)
+            self.segment_size += len(record)
+            self.index.set(key_bytes, offset, len(record))
+            if self.appended_records is not None:
+                self.appended_records.append((key_bytes, offset, len(record)))
+            return True
+
+    def set(self, key: str, completion: dict, created_at: float = None):
+        if not self.is_open():
+            return
+        key_bytes = bytes.fromhex(key)
+        record = self.encode(key_bytes, completion, created_at or time.time())
+        is_written = self.append(key_bytes, record)
+        if not is_written and len(record) <= self.max_bytes * 0.2:
+            # drop oldest records now, rather than going over the size cap
+            self.compact()
+            is_written = self.append(key_bytes, record)
+        if self.is_open() and self.index.load_factor() >= 0.5:
+            # grow the index now, instead of on the next compaction interval
+            self.compact_event.set()
+        if not is_written:
+            METRICS.inc("completion_store_dropped_writes")
+            return
+        METRICS.inc("completion_store_writes")
+
+    def put(self, key: str, completion: dict, created_at: float = None):
+        # written by the writer thread, so callers never block on disk
+        if self.writer_thread is None:
+            return
+        try:
+            self.write_queue.put_nowait((key, completion, created_at))
+        except queue.Full:
+            METRICS.inc("completion_store_dropped_writes")
+
+    def run_writer(self):
+        while (write := self.write_queue.get()) is not None:
+            try:
+                self.set(*write)
+            except Exception as e:
+                logger.warn(f"× Completion store write failed: {e}")
+
+    def needs_compaction(self) -> bool:
+        if not self.segment_size:
+            return False
+        dead_ratio = 1 - self.index.live_bytes / self.segment_size
+        return (
+            self.segment_size > self.max_bytes
+            or dead_ratio >= self.compact_ratio
+            or self.index.load_factor() >= 0.5
+        )
+
+    def compact(self):
+        with self.compact_lock:
+            if self.is_open():
+                self.compact_files()
+
+    def compact_files(self):
+        # collect live records, newest first, bounded by ttl and size cap
+        start_time = time.perf_counter()
+        now = time.time()
+        with self.lock:
+            locations = list(self.index.items())
+            fd = self.segment_fd
+            self.appended_records = []
+        records = []
+        for key_bytes, offset, length in locations:
+            header = os.pread(fd, RECORD_HEADER.size, offset)
+            if len(header) != RECORD_HEADER.size:
+                continue
+            record_key, created_at, _, _ = RECORD_HEADER.unpack(header)
+            if record_key == key_bytes and now - created_at <= self.ttl:
+                records.append((created_at, key_bytes, offset, length))
+        records.sort(reverse=True)
+        kept_bytes = 0
+        kept_records = []
+        for record in records:
+            if kept_bytes + record[3] > self.max_bytes * 0.8:
+                break
+            kept_bytes += record[3]
+            kept_records.append(record)
+
+        slots_count = self.index_slots
+        while len(kept_records) >= slots_count * 0.35:
+            slots_count *= 2
+        new_segment_path = self.path / "segment.dat.tmp"
+        new_index_path = self.path / "index.dat.tmp"
+        new_index_path.unlink(missing_ok=True)
+        new_index = CompletionIndex(new_index_path, slots_count)
+        with open(new_segment_path, "wb") as wf:
+            new_offset = 0
+            # oldest first, so that appended newer records keep the order
+            for _, key_bytes, offset, length in reversed(kept_records):
+                wf.write(os.pread(fd, length, offset))
+                new_index.set(key_bytes, new_offset, length)
+                new_offset += length
+
+        with self.lock:
+            # records appended meanwhile are copied as well, without scanning slots
+            new_fd = os.open(new_segment_path, os.O_RDWR | os.O_APPEND)
+            for key_bytes, offset, length in self.appended_records:
+                os.write(new_fd, os.pread(fd, length, offset))
+                new_index.set(key_bytes, new_offset, length)
+                new_offset += length
+            self.appended_records = None
+            new_index.flush()
+            os.replace(new_segment_path, self.path / "segment.dat")
+            os.replace(new_index_path, self.path / "index.dat")
+            new_index.path = self.path / "index.dat"
+            for retired_fd, retired_index in self.retired_files:
+                os.close(retired_fd)
+                retired_index.close()
+            self.retired_files = [(self.segment_fd, self.index)]
+            self.index, self.segment_fd = new_index, new_fd
+            self.files = (new_index, new_fd)
+            self.segment_size = new_offset
+
+        METRICS.inc("completion_store_compactions")
+        logger.note(
+            f"> Completion store compacted: {len(locations)} -> "
+            f"{new_index.used_count} entries, {new_offset} bytes, "
+            f"in {time.perf_counter() - start_time:.2f}s"
+        )
+
+    def run(self):
+        while True:
+            self.compact_event.wait(self.compact_interval)
+            self.compact_event.clear()
+            if self.stop_event.is_set():
+                return
+            try:
+                if self.needs_compaction():
+                    self.compact()
+            except Exception as e:
+                logger.warn(f"× Completion store compaction: {e}")
+
+    def start(self):
+        if not self.enabled or self.compact_thread:
+            return
+        if not self.open():
+            return
+        self.stop_event.clear()
+        self.compact_thread = threading.Thread(target=self.run, daemon=True)
+        self.compact_thread.start()
+        self.writer_thread = threading.Thread(target=self.run_writer, daemon=True)
+        self.writer_thread.start()
+
+    def stop(self):
+        if not self.compact_thread:
+            return
+        # pending writes are flushed before files are closed
+        self.write_queue.put(None)
+        self.writer_thread.join()
+        self.writer_thread = None
+        self.stop_event.set()
+        self.compact_event.set()
+        self.compact_thread.join()
+        self.compact_thread = None
+        with self.lock:
+            self.index.flush()
+        self.close()
+
+    def collect_metrics(self, metrics):
+        if not self.is_open():
+            return
+        metrics.set("completion_store_entries", self.index.used_count)
+        metrics.set("completion_store_bytes", self.segment_size)
+        metrics.set("completion_store_live_bytes", self.index.live_bytes)
+
+
+COMPLETION_STORE = CompletionStore()
@@ -0,0 +1,225 @@
+import threading
+import time
+
+from http.cookiejar import DefaultCookiePolicy
+
+import httpx
+import requests
+
+from curl_cffi import requests as cffi_requests
+from requests.adapters import HTTPAdapter
+from tclogger import logger
+
+from constants.envs import CONFIG, PROXIES
+from networks.metrics import METRICS
+
+
+# Upstream hosts with their own connection pools
+UPSTREAM_HOSTS = {
+    "hf_inference": "https://api-inference.huggingface.co",
+    "hf_chat": "https://huggingface.co/chat",
+    "openai": "https://chat.openai.com/backend-anon",
+}
+
+
+class BlockAllCookiesPolicy(DefaultCookiePolicy):
+    # Pooled sessions are shared by all users, so they must not keep cookies,
+    # while `response.cookies` are still available to the caller
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class ConnectionPools:
+    """
+    Long-lived keep-alive connections to each upstream host, with:
+    * `httpx.AsyncClient`: async streams (optionally over HTTP/2)
+    * `requests.Session`: blocking calls
+    * `curl_cffi` sessions: calls which need browser impersonation
+
+    Connections idle longer than `idle_timeout` are dropped on next checkout.
+    """
+
+    def __init__(self, pool_size: int = None, idle_timeout: float = None, http2=None):
+        configs = CONFIG["connection_pools"] or {}
+        self.pool_size = int(pool_size or configs.get("pool_size", 100))
+        self.idle_timeout = float(idle_timeout or configs.get("idle_timeout", 60))
+        if http2 is None:
+            http2 = configs.get("http2", False)
+        self.http2 = http2 and self.is_http2_available()
+
+        self.async_clients = {}
+        self.sessions = {}
+        self.sessions_last_used = {}
+        self.cffi_local = threading.local()
+        self.lock = threading.Lock()
+
+        # (host) -> {"requests": int, "connections": int}
+        self.stats = {host: {"requests": 0, "connections": 0} for host in UPSTREAM_HOSTS}
+        # connection counters of urllib3 pools in closed sessions
+        self.retired_session_stats = {
+            host: {"requests": 0, "connections": 0} for host in UPSTREAM_HOSTS
+        }
+        METRICS.register_collector(self.collect_metrics)
+
+    def is_http2_available(self):
+        try:
+            import h2
+        except ImportError:
+            logger.warn("× HTTP/2 requires `h2` package, fallback to HTTP/1.1")
+            return False
+        return True
+
+    def add_stats(self, host: str, requests_count: int = 0, connections_count: int = 0):
+        with self.lock:
+            stats = self.stats.setdefault(host, {"requests": 0, "connections": 0})
+            stats["requests"] += requests_count
+            stats["connections"] += connections_count
+
+    # ====================== httpx (async) ====================== #
+    def get_async_client(
+        self, host: str, proxy: str = None, use_proxy: bool = True
+    ) -> httpx.AsyncClient:
+        # `proxy` overrides the global proxy, and `use_proxy=False` connects directly
+        client = self.async_clients.get(host)
+        if client is None or client.is_closed:
+
+            async def on_request(request: httpx.Request):
+                self.add_stats(host, requests_count=1)
+                request.extensions["trace"] = on_trace
+
+            async def on_trace(event_name: str, info: dict):
+                if event_name == "connection.connect_tcp.complete":
+                    self.add_stats(host, connections_count=1)
+
+            if not use_proxy:
+                proxy = None
+            elif not proxy and PROXIES:
+                proxy = PROXIES["https"]
+            client = httpx.AsyncClient(
+                proxy=proxy,
+                http2=self.http2,
+                timeout=httpx.Timeout(10.0, read=None),
+                limits=httpx.Limits(
+                    max_connections=None,
+                    max_keepalive_connections=self.pool_size,
+                    keepalive_expiry=self.idle_timeout,
+                ),
+                event_hooks={"request": [on_request]},
+            )
+            self.async_clients[host] = client
+        return client
+
+    # ====================== requests (sync) ====================== #
+    def get_pools_stats(self, session: requests.Session) -> dict:
+        stats = {"requests": 0, "connections": 0}
+        # the same adapter is mounted for both "http://" and "https://"
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    stats["requests"] += pool.num_requests
+                    stats["connections"] += pool.num_connections
+        return stats
+
+    def create_session(self) -> requests.Session:
+        session = requests.Session()
+        session.cookies.set_policy(BlockAllCookiesPolicy())
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.proxies = PROXIES or {}
+        return session
+
+    def retire_session(self, host: str, session: requests.Session):
+        retired_stats = self.retired_session_stats.setdefault(
+            host, {"requests": 0, "connections": 0}
+        )
+        for key, value in self.get_pools_stats(session).items():
+            retired_stats[key] += value
+        session.close()
+
+    def get_session(self, host: str) -> requests.Session:
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(host)
+            last_used = self.sessions_last_used.get(host, now)
+            if session is not None and now - last_used > self.idle_timeout:
+                self.retire_session(host, session)
+                session = None
+            if session is None:
+                session = self.create_session()
+                self.sessions[host] = session
+            self.sessions_last_used[host] = now
+        return session
+
+    # ====================== curl_cffi (sync) ====================== #
+    def get_cffi_session(self, host: str) -> cffi_requests.Session:
+        # curl handles and cookies of a session are not shared across threads
+        now = time.monotonic()
+        if not hasattr(self.cffi_local, "sessions"):
+            self.cffi_local.sessions = {}
+        session, last_used, seen_connections = self.cffi_local.sessions.get(
+            host, (None, now, set())
+        )
+        if session is not None and now - last_used > self.idle_timeout:
+            session.close()
+            session = None
+        if session is None:
+            session = cffi_requests.Session()
+            seen_connections = set()
+        self.cffi_local.sessions[host] = (session, now, seen_connections)
+        return session
+
+    def cffi_request(self, host: str, method: str, url: str, **kwargs):
+        session = self.get_cffi_session(host)
+        session.cookies.clear()
+        _, _, seen_connections = self.cffi_local.sessions[host]
+        res = session.request(method, url, proxies=PROXIES, **kwargs)
+
+        # a new connection always comes with a new local port
+        connection = (res.local_ip, res.local_port, res.primary_ip, res.primary_port)
+        is_new_connection = connection not in seen_connections
+        if is_new_connection:
+            if len(seen_connections) > 1024:
+                seen_connections.clear()
+            seen_connections.add(connection)
+        self.add_stats(host, requests_count=1, connections_count=int(is_new_connection))
+        return res
+
+    # ====================== metrics ====================== #
+    def collect_metrics(self, metrics):
+        with self.lock:
+            hosts_stats = {host: dict(stats) for host, stats in self.stats.items()}
+            for host, stats in hosts_stats.items():
+                sessions_stats = [self.retired_session_stats.get(host, {})]
+                if host in self.sessions:
+                    sessions_stats.append(self.get_pools_stats(self.sessions[host]))
+                for session_stats in sessions_stats:
+                    for key in ["requests", "connections"]:
+                        stats[key] += session_stats.get(key, 0)
+        for host, stats in hosts_stats.items():
+            requests_count = stats["requests"]
+            connections_count = stats["connections"]
+            if requests_count:
+                reuse_ratio = max(1 - connections_count / requests_count, 0)
+            else:
+                reuse_ratio = 0
+            metrics.set("upstream_requests", requests_count, host=host)
+            metrics.set("upstream_connections", connections_count, host=host)
+            metrics.set("upstream_connection_reuse_ratio", reuse_ratio, host=host)
+
+    async def aclose(self):
+        for client in self.async_clients.values():
+            await client.aclose()
+        self.async_clients = {}
+        with self.lock:
+            for host, session in self.sessions.items():
+                self.retire_session(host, session)
+            self.sessions = {}
+
+
+CONNECTION_POOLS = ConnectionPools()
@@ -1,4 +1,5 @@
 import http
+import math
 
 from typing import Optional
 
@@ -10,12 +11,14 @@ class HfApiException(Exception):
         self,
         status_code: int,
         detail: Optional[str] = None,
+        headers: Optional[dict] = None,
     ) -> None:
         if detail is None:
             self.detail = http.HTTPStatus(status_code).phrase
         else:
             self.detail = detail
         self.status_code = status_code
+        self.headers = headers
 
     def __repr__(self) -> str:
         class_name = self.__class__.__name__
@@ -25,6 +28,21 @@ class HfApiException(Exception):
         return self.__repr__()
 
 
+class ModelLoadingException(HfApiException):
+    # HF inference API returns 503 with `estimated_time` while model is cold
+    def __init__(
+        self, model: str, estimated_time: float = None, detail: Optional[str] = None
+    ) -> None:
+        retry_after = max(math.ceil(estimated_time or 1), 1)
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=detail or f"Model {model} is currently loading",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.model = model
+        self.estimated_time = estimated_time
+
+
 INVALID_API_KEY_ERROR = HfApiException(
     status_code=status.HTTP_403_FORBIDDEN,
     detail="Invalid API Key",
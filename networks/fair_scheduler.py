@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+from fastapi import status
+
+from constants.envs import CONFIG
+from networks.exceptions import HfApiException
+from networks.metrics import METRICS
+
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+
+class SchedulerTicket:
+    # slot of a dispatched request, released once (idempotent)
+    def __init__(self, scheduler=None, priority: str = None):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.is_released = scheduler is None
+
+    def release(self):
+        if self.is_released:
+            return
+        self.is_released = True
+        self.scheduler.release()
+
+
+class FairScheduler:
+    """
+    Dispatch requests to the shared upstream budget of `capacity` slots,
+    with weighted fair queuing across flows of (priority class, API key).
+
+    Each request gets a virtual finish tag of `max(V, last finish of its flow)
+    + 1 / weight`, and waiting requests are dispatched in order of the tag,
+    so a flow with many queued requests only gets its weighted share,
+    and requests of light or interactive flows overtake bulk backlogs.
+
+    Weight of a flow is the weight of its class times the weight of its key.
+    Class is `x-priority` header if given, else the class of the key in config,
+    else `interactive` for streams and `bulk` for non-streams.
+    """
+
+    def __init__(self):
+        configs = CONFIG["fair_scheduler"] or {}
+        self.enabled = configs.get("enabled", True)
+        self.capacity = int(configs.get("capacity", 32))
+        self.max_wait = float(configs.get("max_wait", 60))
+        self.class_weights = configs.get("classes") or {INTERACTIVE: 4, BULK: 1}
+        self.key_configs = configs.get("keys") or {}
+
+        self.active_count = 0
+        self.virtual_time = 0.0
+        # flow -> finish tag of its last request
+        self.last_finish_tags = {}
+        # (finish tag, sequence, waiter, priority, start tag)
+        self.queue = []
+        self.sequence = itertools.count()
+        METRICS.register_collector(self.collect_metrics)
+
+    def get_key_config(self, api_key: str = None) -> dict:
+        return self.key_configs.get(api_key) or self.key_configs.get("default") or {}
+
+    def get_priority(
+        self, api_key: str = None, stream: bool = True, priority: str = None
+    ) -> str:
+        if priority in self.class_weights:
+            return priority
+        priority = self.get_key_config(api_key).get("priority")
+        if priority in self.class_weights:
+            return priority
+        return INTERACTIVE if stream else BULK
+
+    def get_weight(self, api_key: str, priority: str) -> float:
+        key_weight = float(self.get_key_config(api_key).get("weight", 1))
+        return max(float(self.class_weights.get(priority, 1)) * key_weight, 1e-3)
+
+    def reject(self, priority: str) -> HfApiException:
+        METRICS.inc("scheduler_rejections", priority=priority)
+        retry_after = max(math.ceil(len(self.queue) / max(self.capacity, 1)), 1)
+        return HfApiException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Upstream is saturated, request is not scheduled in time",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    async def acquire(
+        self,
+        flow_name: str,
+        api_key: str = None,
+        priority: str = INTERACTIVE,
+        timeout: float = None,
+    ) -> SchedulerTicket:
+        # flow_name: identity of the key, e.g., hashed API key
+        if not self.enabled:
+            return SchedulerTicket()
+        flow = (priority, flow_name)
+        start_tag = max(self.virtual_time, self.last_finish_tags.get(flow, 0))
+        finish_tag = start_tag + 1 / self.get_weight(api_key, priority)
+        self.last_finish_tags[flow] = finish_tag
+        METRICS.inc("scheduler_requests", priority=priority)
+
+        if self.active_count < self.capacity and not self.queue:
+            self.active_count += 1
+            self.virtual_time = start_tag
+            METRICS.observe("scheduler_wait_seconds", 0, priority=priority)
+            return SchedulerTicket(self, priority)
+
+        start_time = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self.queue, (finish_tag, next(self.sequence), waiter, priority, start_tag)
+        )
+        if timeout is None:
+            timeout = self.max_wait
+        else:
+            timeout = min(timeout, self.max_wait)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # slot was handed over meanwhile, so pass it on
+                self.release()
+            else:
+                waiter.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                raise self.reject(priority)
+            raise
+        METRICS.observe(
+            "scheduler_wait_seconds", time.monotonic() - start_time, priority=priority
+        )
+        return SchedulerTicket(self, priority)
+
+    def release(self):
+        # hand over the slot to the waiter with the smallest finish tag
+        while self.queue:
+            _, _, waiter, _, start_tag = heapq.heappop(self.queue)
+            if not waiter.done():
+                self.virtual_time = max(self.virtual_time, start_tag)
+                waiter.set_result(None)
+                return
+        self.active_count -= 1
+        # flows which are idle now start from current virtual time anyway
+        self.last_finish_tags = {
+            flow: finish_tag
+            for flow, finish_tag in self.last_finish_tags.items()
+            if finish_tag > self.virtual_time
+        }
+
+    def collect_metrics(self, metrics):
+        depths = {priority: 0 for priority in self.class_weights}
+        for _, _, waiter, priority, _ in self.queue:
+            if not waiter.done():
+                depths[priority] = depths.get(priority, 0) + 1
+        for priority, depth in depths.items():
+            metrics.set("scheduler_queue_depth", depth, priority=priority)
+        metrics.set("scheduler_in_flight", self.active_count)
+
+
+FAIR_SCHEDULER = FairScheduler()
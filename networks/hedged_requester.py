@@ -0,0 +1,229 @@
+import anyio
+import asyncio
+import threading
+import time
+
+from collections import deque
+
+import httpx
+
+from tclogger import logger
+
+from constants.envs import CONFIG
+from networks.metrics import METRICS
+
+
+class TTFTTracker:
+    """
+    Rolling window of time-to-first-token of each model,
+    which is used to pick the hedging delay, e.g., p90 TTFT.
+    """
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def observe(self, model: str, ttft: float):
+        with self.lock:
+            samples = self.samples.setdefault(model, deque(maxlen=self.window))
+            samples.append(ttft)
+        METRICS.observe("upstream_ttft_seconds", ttft, model=model)
+
+    def count(self, model: str) -> int:
+        with self.lock:
+            return len(self.samples.get(model, ()))
+
+    def quantile(self, model: str, q: float = 0.9):
+        with self.lock:
+            samples = sorted(self.samples.get(model, ()))
+        if not samples:
+            return None
+        index = min(int(q * len(samples)), len(samples) - 1)
+        return samples[index]
+
+
+class PrefetchedResponse:
+    """
+    Upstream stream response whose first token line has been read,
+    and which replays that line before the rest of the stream.
+    """
+
+    def __init__(
+        self,
+        response: httpx.Response,
+        lines=None,
+        first_lines: list = None,
+        ttft: float = None,
+    ):
+        self.response = response
+        self.lines = lines
+        self.first_lines = first_lines or []
+        self.ttft = ttft
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+    @property
+    def has_first_token(self) -> bool:
+        return self.status_code == 200 and self.lines is not None
+
+    async def aiter_lines(self):
+        if self.lines is None:
+            async for line in self.response.aiter_lines():
+                yield line
+            return
+        for line in self.first_lines:
+            yield line
+        async for line in self.lines:
+            yield line
+
+    async def aclose(self):
+        if self.lines is not None:
+            await self.lines.aclose()
+        await self.response.aclose()
+
+
+class HedgedRequester:
+    """
+    Send stream request to upstream, and if no token comes within a delay,
+    send an identical hedge request (optionally with another token or endpoint).
+    The first stream which yields a token wins, and the other one is cancelled.
+
+    Delay is `hedging.delay` in config if set,
+    otherwise the rolling `hedging.quantile` TTFT of the model,
+    bounded by `min_delay` and `max_delay`.
+    """
+
+    def __init__(self):
+        configs = CONFIG["hedging"] or {}
+        self.enabled = configs.get("enabled", False)
+        self.delay = float(configs.get("delay", 0) or 0)
+        self.quantile = float(configs.get("quantile", 0.9))
+        self.min_samples = int(configs.get("min_samples", 20))
+        self.default_delay = float(configs.get("default_delay", 2))
+        self.min_delay = float(configs.get("min_delay", 0.3))
+        self.max_delay = float(configs.get("max_delay", 10))
+        self.endpoint = configs.get("endpoint", "")
+        self.ttft_tracker = TTFTTracker(window=int(configs.get("window", 200)))
+
+        # (model) -> {"requests": int, "hedges": int}
+        self.stats = {}
+        self.lock = threading.Lock()
+        METRICS.register_collector(self.collect_metrics)
+
+    def get_delay(self, model: str) -> float:
+        if self.delay > 0:
+            return self.delay
+        if self.ttft_tracker.count(model) < self.min_samples:
+            return self.default_delay
+        delay = self.ttft_tracker.quantile(model, self.quantile)
+        return min(max(delay, self.min_delay), self.max_delay)
+
+    def add_stats(self, model: str, requests_count: int = 0, hedges_count: int = 0):
+        with self.lock:
+            stats = self.stats.setdefault(model, {"requests": 0, "hedges": 0})
+            stats["requests"] += requests_count
+            stats["hedges"] += hedges_count
+
+    async def send_attempt(self, client: httpx.AsyncClient, request: httpx.Request):
+        # returns once the first token line arrives, or upstream fails
+        start_time = time.monotonic()
+        response = await client.send(request, stream=True)
+        try:
+            if response.status_code != 200:
+                return PrefetchedResponse(response)
+            lines = response.aiter_lines()
+            first_lines = []
+            async for line in lines:
+                first_lines.append(line)
+                if line:
+                    break
+            return PrefetchedResponse(
+                response, lines, first_lines, ttft=time.monotonic() - start_time
+            )
+        except BaseException:
+            with anyio.CancelScope(shield=True):
+                await response.aclose()
+            raise
+
+    async def discard(self, task: asyncio.Task):
+        # cancel loser attempt, and close its response if already returned
+        with anyio.CancelScope(shield=True):
+            if not task.done():
+                task.cancel()
+            try:
+                result = await task
+            except BaseException:
+                return
+            await result.aclose()
+
+    async def send(
+        self,
+        model: str,
+        client: httpx.AsyncClient,
+        request: httpx.Request,
+        hedge_request: httpx.Request = None,
+        hedge_client: httpx.AsyncClient = None,
+    ) -> PrefetchedResponse:
+        primary_task = asyncio.create_task(self.send_attempt(client, request))
+        tasks = {primary_task: "primary"}
+        pending = {primary_task}
+        delay = self.get_delay(model) if hedge_request is not None else None
+        self.add_stats(model, requests_count=1)
+
+        winner_task = None
+        failed_tasks = []
+        try:
+            while pending and winner_task is None:
+                is_hedge_pending = hedge_request is not None and len(tasks) == 1
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=delay if is_hedge_pending else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    logger.note(f"> Hedge request after {delay:.2f}s: {model}")
+                    hedge_task = asyncio.create_task(
+                        self.send_attempt(hedge_client or client, hedge_request)
+                    )
+                    tasks[hedge_task] = "hedge"
+                    pending.add(hedge_task)
+                    self.add_stats(model, hedges_count=1)
+                    METRICS.inc("hedged_requests", model=model)
+                    continue
+                for task in done:
+                    if task.exception() is None and task.result().has_first_token:
+                        winner_task = task
+                        break
+                    failed_tasks.append(task)
+        finally:
+            for task in tasks:
+                if task is not winner_task and task not in failed_tasks:
+                    await self.discard(task)
+
+        if winner_task is not None:
+            for task in failed_tasks:
+                await self.discard(task)
+            response = winner_task.result()
+            self.ttft_tracker.observe(model, response.ttft)
+            if len(tasks) > 1:
+                METRICS.inc("hedge_wins", model=model, winner=tasks[winner_task])
+            return response
+
+        # all attempts failed: report the last one, as without hedging
+        for task in failed_tasks[:-1]:
+            await self.discard(task)
+        return failed_tasks[-1].result()
+
+    def collect_metrics(self, metrics):
+        with self.lock:
+            stats = {model: dict(model_stats) for model, model_stats in self.stats.items()}
+        for model, model_stats in stats.items():
+            hedge_rate = model_stats["hedges"] / max(model_stats["requests"], 1)
+            metrics.set("hedge_rate", hedge_rate, model=model)
+            metrics.set("hedge_delay_seconds", self.get_delay(model), model=model)
+
+
+HEDGED_REQUESTER = HedgedRequester()
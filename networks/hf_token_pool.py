@@ -0,0 +1,189 @@
+import math
+import threading
+import time
+
+from tclogger import logger
+
+from constants.envs import CONFIG, SECRETS
+from networks.metrics import METRICS
+
+
+def parse_rate_limit_headers(headers) -> dict:
+    """
+    Parse rate limit state of a token from upstream response headers:
+        * `x-ratelimit-limit`, `x-ratelimit-remaining`, `x-ratelimit-reset`
+            (also with `-requests` suffix)
+        * `ratelimit: "api";r=<remaining>;t=<reset seconds>` (IETF draft)
+        * `retry-after: <seconds>`
+
+    Returns dict with some of `limit`, `remaining` and `reset` (seconds).
+    """
+    state = {}
+    if not headers:
+        return state
+    for key in ["limit", "remaining", "reset"]:
+        for name in [f"x-ratelimit-{key}", f"x-ratelimit-{key}-requests"]:
+            value = headers.get(name)
+            if value is None:
+                continue
+            try:
+                state[key] = float(value.rstrip("s"))
+            except ValueError:
+                pass
+            break
+    for item in (headers.get("ratelimit") or "").split(";"):
+        name, _, value = item.strip().partition("=")
+        try:
+            if name == "r":
+                state["remaining"] = float(value)
+            elif name == "t":
+                state["reset"] = float(value)
+        except ValueError:
+            pass
+    try:
+        state["retry_after"] = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        pass
+    if state.get("reset", 0) > 1e9:
+        # epoch seconds, rather than seconds from now
+        state["reset"] = max(state["reset"] - time.time(), 0)
+    return state
+
+
+class HfToken:
+    """
+    HF token in the pool, with its rate limit state learned from responses.
+
+    Remaining requests are unknown until upstream reports them,
+    and such tokens are assumed to have full headroom.
+    """
+
+    def __init__(self, token: str, default_limit: int = 1000):
+        self.token = token
+        self.name = f"{token[:3]}***{token[-4:]}"
+        self.limit = default_limit
+        self.remaining = None
+        self.reset_at = 0.0
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.requests_count = 0
+        self.rate_limited_count = 0
+
+    def is_cooling(self, now: float = None) -> bool:
+        return (now or time.monotonic()) < self.cooldown_until
+
+    def get_headroom(self, now: float = None) -> float:
+        now = now or time.monotonic()
+        remaining = self.remaining
+        if remaining is None or now >= self.reset_at:
+            # quota window has been reset
+            remaining = self.limit
+        return remaining - self.in_flight
+
+
+class HfTokenPool:
+    """
+    Pool of HF tokens from `HF_TOKENS` in `secrets.json` (list, or comma separated),
+    used for requests to HF backends, when user gives no `hf_` token.
+
+    Each request gets the token with the most remaining headroom.
+    Tokens which got 429 cool down for `Retry-After` (or reset time of its quota,
+    or `cooldown` in config), doubled on each consecutive 429, up to `max_cooldown`.
+    """
+
+    def __init__(self, tokens: list[str] = None):
+        configs = CONFIG["hf_token_pool"] or {}
+        self.enabled = configs.get("enabled", True)
+        self.cooldown = float(configs.get("cooldown", 60))
+        self.max_cooldown = float(configs.get("max_cooldown", 600))
+        self.default_limit = int(configs.get("default_limit", 1000))
+        if tokens is None:
+            tokens = SECRETS["HF_TOKENS"] or []
+        if isinstance(tokens, str):
+            tokens = [token.strip() for token in tokens.split(",")]
+        self.tokens = [
+            HfToken(token, default_limit=self.default_limit)
+            for token in dict.fromkeys(tokens)
+            if token
+        ]
+        self.consecutive_limits = {}
+        self.lock = threading.Lock()
+        METRICS.register_collector(self.collect_metrics)
+
+    def select(self) -> HfToken:
+        # None if pool is empty, or all tokens are cooling down
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            candidates = [token for token in self.tokens if not token.is_cooling(now)]
+            if not candidates:
+                if self.tokens:
+                    METRICS.inc("hf_token_pool_exhausted")
+                return None
+            return max(candidates, key=lambda token: token.get_headroom(now))
+
+    def acquire(self, token: HfToken):
+        with self.lock:
+            token.in_flight += 1
+            token.requests_count += 1
+        METRICS.inc("hf_token_requests", token=token.name)
+
+    def release(self, token: HfToken):
+        with self.lock:
+            token.in_flight = max(token.in_flight - 1, 0)
+
+    def record(self, token: HfToken, status_code: int, headers=None):
+        state = parse_rate_limit_headers(headers)
+        now = time.monotonic()
+        with self.lock:
+            if "limit" in state:
+                token.limit = state["limit"]
+            if "remaining" in state:
+                token.remaining = state["remaining"]
+                token.reset_at = now + state.get("reset", self.cooldown)
+            elif token.remaining is not None and now < token.reset_at:
+                token.remaining = max(token.remaining - 1, 0)
+
+            if status_code != 429:
+                self.consecutive_limits.pop(token.token, None)
+                return
+            count = self.consecutive_limits.get(token.token, 0) + 1
+            self.consecutive_limits[token.token] = count
+            cooldown = state.get("retry_after") or state.get("reset")
+            if not cooldown:
+                cooldown = self.cooldown * 2 ** (count - 1)
+            cooldown = min(cooldown, self.max_cooldown)
+            token.remaining = 0
+            token.reset_at = now + cooldown
+            token.cooldown_until = now + cooldown
+            token.rate_limited_count += 1
+        METRICS.inc("hf_token_rate_limited", token=token.name)
+        logger.warn(
+            f"× HF token rate limited: {token.name}, cool down {cooldown:.0f}s"
+        )
+
+    def get_status(self) -> list[dict]:
+        now = time.monotonic()
+        with self.lock:
+            return [
+                {
+                    "token": token.name,
+                    "headroom": token.get_headroom(now),
+                    "cooldown": max(math.ceil(token.cooldown_until - now), 0),
+                    "in_flight": token.in_flight,
+                    "requests": token.requests_count,
+                    "rate_limited": token.rate_limited_count,
+                }
+                for token in self.tokens
+            ]
+
+    def collect_metrics(self, metrics):
+        for status in self.get_status():
+            labels = {"token": status["token"]}
+            metrics.set("hf_token_headroom", status["headroom"], **labels)
+            metrics.set("hf_token_cooldown_seconds", status["cooldown"], **labels)
+            metrics.set("hf_token_in_flight", status["in_flight"], **labels)
+
+
+HF_TOKEN_POOL = HfTokenPool()
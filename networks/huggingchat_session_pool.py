@@ -0,0 +1,171 @@
+import hashlib
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from tclogger import logger
+
+from constants.envs import CONFIG
+from networks.circuit_breaker import CIRCUIT_BREAKERS
+from networks.metrics import METRICS
+
+
+class HuggingchatSession:
+    def __init__(self, hf_chat_id: str, conversation_id: str, message_id: str):
+        self.hf_chat_id = hf_chat_id
+        self.conversation_id = conversation_id
+        self.message_id = message_id
+        self.created_at = time.monotonic()
+
+
+class HuggingchatSessionPool:
+    """
+    Pre-warmed HuggingChat sessions (hf-chat cookie, conversation ID, message ID),
+    keyed by model and system prompt hash.
+
+    A conversation carries its system prompt and is used only once,
+    so sessions are pre-created for the (model, system prompt) pairs requested
+    within `ttl`, and a request checks one out to go straight to the stream.
+    """
+
+    def __init__(
+        self,
+        size: int = None,
+        ttl: float = None,
+        refill_concurrency: int = None,
+        refill_interval: float = None,
+    ):
+        configs = CONFIG["huggingchat_session_pool"] or {}
+        self.enabled = configs.get("enabled", True)
+        self.size = int(size or configs.get("size", 2))
+        self.ttl = float(ttl or configs.get("ttl", 600))
+        self.refill_concurrency = int(
+            refill_concurrency or configs.get("refill_concurrency", 4)
+        )
+        self.refill_interval = float(
+            refill_interval or configs.get("refill_interval", 1)
+        )
+
+        # (model, system_prompt_hash) -> deque[HuggingchatSession]
+        self.sessions = {}
+        # (model, system_prompt_hash) -> (system_prompt, last_requested_at)
+        self.demands = {}
+        # (model, system_prompt_hash) -> int
+        self.refilling_counts = {}
+        # bumped by `stop()`, so refills of a stopped pool leave the counts alone
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.executor = None
+        self.refill_thread = None
+        self.stop_event = threading.Event()
+        METRICS.register_collector(self.collect_metrics)
+
+    def get_key(self, model: str, system_prompt: str):
+        system_prompt_hash = hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()
+        return (model, system_prompt_hash)
+
+    def is_expired(self, session: HuggingchatSession, now: float = None):
+        now = now or time.monotonic()
+        return now - session.created_at > self.ttl
+
+    def checkout(self, model: str, system_prompt: str = ""):
+        if not self.enabled:
+            return None
+        key = self.get_key(model, system_prompt)
+        now = time.monotonic()
+        session = None
+        with self.lock:
+            self.demands[key] = (system_prompt, now)
+            sessions = self.sessions.get(key)
+            while sessions:
+                candidate = sessions.popleft()
+                if not self.is_expired(candidate, now):
+                    session = candidate
+                    break
+        if session:
+            METRICS.inc("huggingchat_session_pool_hits", model=model)
+        else:
+            METRICS.inc("huggingchat_session_pool_misses", model=model)
+        return session
+
+    def create_session(self, model: str, system_prompt: str):
+        from networks.huggingchat_streamer import HuggingchatRequester
+
+        requester = HuggingchatRequester(model=model)
+        return HuggingchatSession(*requester.prepare_session(system_prompt))
+
+    def refill_one(self, key: tuple, system_prompt: str, generation: int):
+        try:
+            session = self.create_session(key[0], system_prompt)
+            CIRCUIT_BREAKERS.record(["backend:hf_chat"], ok=True)
+            with self.lock:
+                if key in self.demands:
+                    self.sessions.setdefault(key, deque()).append(session)
+        except Exception as e:
+            CIRCUIT_BREAKERS.record(["backend:hf_chat"], ok=False)
+            METRICS.inc("huggingchat_session_pool_refill_errors", model=key[0])
+            logger.warn(f"× Failed to pre-warm HuggingChat session: {e}")
+        finally:
+            with self.lock:
+                if generation == self.generation:
+                    self.refilling_counts[key] -= 1
+
+    def refill(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.executor is None:
+                return
+            for key, (system_prompt, last_requested_at) in list(self.demands.items()):
+                sessions = self.sessions.setdefault(key, deque())
+                while sessions and self.is_expired(sessions[0], now):
+                    sessions.popleft()
+                # stop pre-warming for pairs which are no longer requested
+                if now - last_requested_at > self.ttl:
+                    self.demands.pop(key)
+                    self.sessions.pop(key)
+                    continue
+                refilling_count = self.refilling_counts.get(key, 0)
+                for _ in range(self.size - len(sessions) - refilling_count):
+                    self.refilling_counts[key] = self.refilling_counts.get(key, 0) + 1
+                    self.executor.submit(
+                        self.refill_one, key, system_prompt, self.generation
+                    )
+
+    def run(self):
+        while not self.stop_event.wait(self.refill_interval):
+            try:
+                self.refill()
+            except Exception as e:
+                logger.warn(f"× HuggingChat session pool: {e}")
+
+    def start(self):
+        if not self.enabled or self.refill_thread:
+            return
+        self.stop_event.clear()
+        self.executor = ThreadPoolExecutor(max_workers=self.refill_concurrency)
+        self.refill_thread = threading.Thread(target=self.run, daemon=True)
+        self.refill_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+        self.refill_thread = None
+        with self.lock:
+            # cancelled refills never decrement, and running ones are ignored
+            self.generation += 1
+            self.refilling_counts = {}
+
+    def collect_metrics(self, metrics):
+        with self.lock:
+            ready_counts = {}
+            for (model, _), sessions in self.sessions.items():
+                ready_counts[model] = ready_counts.get(model, 0) + len(sessions)
+        for model, ready_count in ready_counts.items():
+            metrics.set("huggingchat_session_pool_ready", ready_count, model=model)
+
+
+HUGGINGCHAT_SESSION_POOL = HuggingchatSessionPool()
@@ -1,27 +1,31 @@
 import copy
 import json
 import re
+import time
 
 import requests
-from curl_cffi import requests as cffi_requests
 
 from tclogger import logger
 
 from constants.models import MODEL_MAP
-from constants.envs import PROXIES
 from constants.headers import HUGGINGCHAT_POST_HEADERS, HUGGINGCHAT_SETTINGS_POST_DATA
 from messagers.message_outputer import OpenaiStreamOutputer
 from messagers.message_composer import MessageComposer
 from messagers.token_checker import TokenChecker
+from networks.circuit_breaker import CIRCUIT_BREAKERS
+from networks.connection_pools import CONNECTION_POOLS
+from networks.huggingchat_session_pool import HUGGINGCHAT_SESSION_POOL
+from networks.request_deadline import RequestDeadline
 
 
 class HuggingchatRequester:
-    def __init__(self, model: str):
+    def __init__(self, model: str, deadline: RequestDeadline = None):
         if model in MODEL_MAP.keys():
             self.model = model
         else:
             self.model = "nous-mixtral-8x7b"
         self.model_fullname = MODEL_MAP[self.model]
+        self.deadline = deadline or RequestDeadline()
 
     def get_hf_chat_id(self):
         request_url = "https://huggingface.co/chat/settings"
@@ -32,12 +36,13 @@ class HuggingchatRequester:
         request_body.update(extra_body)
         logger.note(f"> hf-chat ID:", end=" ")
 
-        res = cffi_requests.post(
+        res = CONNECTION_POOLS.cffi_request(
+            "hf_chat",
+            "POST",
             request_url,
             headers=HUGGINGCHAT_POST_HEADERS,
             json=request_body,
-            proxies=PROXIES,
-            timeout=10,
+            timeout=self.deadline.get_timeout(10),
             impersonate="chrome",
         )
         self.hf_chat_id = res.cookies.get("hf-chat")
@@ -50,7 +55,7 @@ class HuggingchatRequester:
 
     def get_conversation_id(self, system_prompt: str = ""):
         request_url = "https://huggingface.co/chat/conversation"
-        request_headers = HUGGINGCHAT_POST_HEADERS
+        request_headers = copy.deepcopy(HUGGINGCHAT_POST_HEADERS)
         extra_headers = {
             "Cookie": f"hf-chat={self.hf_chat_id}",
         }
@@ -61,12 +66,11 @@ class HuggingchatRequester:
         }
         logger.note(f"> Conversation ID:", end=" ")
 
-        res = requests.post(
+        res = CONNECTION_POOLS.get_session("hf_chat").post(
             request_url,
             headers=request_headers,
             json=request_body,
-            proxies=PROXIES,
-            timeout=10,
+            timeout=self.deadline.get_timeout(10),
         )
         if res.status_code == 200:
             conversation_id = res.json()["conversationId"]
@@ -79,7 +83,7 @@ class HuggingchatRequester:
 
     def get_last_message_id(self):
         request_url = f"https://huggingface.co/chat/conversation/{self.conversation_id}/__data.json?x-sveltekit-invalidated=11"
-        request_headers = HUGGINGCHAT_POST_HEADERS
+        request_headers = copy.deepcopy(HUGGINGCHAT_POST_HEADERS)
         extra_headers = {
             "Cookie": f"hf-chat={self.hf_chat_id}",
         }
@@ -87,11 +91,10 @@ class HuggingchatRequester:
         logger.note(f"> Message ID:", end=" ")
 
         message_id = None
-        res = requests.post(
+        res = CONNECTION_POOLS.get_session("hf_chat").post(
             request_url,
             headers=request_headers,
-            proxies=PROXIES,
-            timeout=10,
+            timeout=self.deadline.get_timeout(10),
         )
         if res.status_code == 200:
             data = res.json()["nodes"][1]["data"]
@@ -109,6 +112,13 @@ class HuggingchatRequester:
 
         return message_id
 
+    def prepare_session(self, system_prompt: str = ""):
+        # 3 round trips before the stream starts, which are pre-warmed by pool
+        self.get_hf_chat_id()
+        self.get_conversation_id(system_prompt=system_prompt)
+        self.message_id = self.get_last_message_id()
+        return self.hf_chat_id, self.conversation_id, self.message_id
+
     def log_request(self, url, method="GET"):
         logger.note(f"> {method}:", end=" ")
         logger.mesg(f"{url}", end=" ")
@@ -166,12 +176,34 @@ class HuggingchatRequester:
             messages
         )
 
-        checker = TokenChecker(input_str=system_prompt + input_prompt, model=self.model)
+        checker = TokenChecker(model=self.model, messages=messages)
         checker.check_token_limit()
 
-        self.get_hf_chat_id()
-        self.get_conversation_id(system_prompt=system_prompt)
-        message_id = self.get_last_message_id()
+        # any failure of setup calls or stream is from upstream, as no user token is used
+        breaker_names = [f"model:{self.model}", "backend:hf_chat"]
+        start_time = time.monotonic()
+        try:
+            res = self.post_conversation(system_prompt, input_prompt)
+        except Exception:
+            CIRCUIT_BREAKERS.record(breaker_names, ok=False)
+            raise
+        CIRCUIT_BREAKERS.record(
+            breaker_names,
+            ok=res.status_code == 200,
+            latency=time.monotonic() - start_time,
+        )
+        self.log_response(res, stream=True, iter_lines=iter_lines, verbose=verbose)
+        return res
+
+    def post_conversation(self, system_prompt: str, input_prompt: str):
+        session = HUGGINGCHAT_SESSION_POOL.checkout(self.model, system_prompt)
+        if session:
+            self.hf_chat_id = session.hf_chat_id
+            self.conversation_id = session.conversation_id
+            message_id = session.message_id
+        else:
+            self.prepare_session(system_prompt=system_prompt)
+            message_id = self.message_id
 
         request_url = f"https://huggingface.co/chat/conversation/{self.conversation_id}"
         request_headers = copy.deepcopy(HUGGINGCHAT_POST_HEADERS)
@@ -191,40 +223,51 @@ class HuggingchatRequester:
         }
         self.log_request(request_url, method="POST")
 
-        res = requests.post(
+        res = CONNECTION_POOLS.get_session("hf_chat").post(
             request_url,
             headers=request_headers,
             json=request_body,
-            proxies=PROXIES,
             stream=True,
+            timeout=self.deadline.get_stream_timeout(),
         )
-        self.log_response(res, stream=True, iter_lines=iter_lines, verbose=verbose)
         return res
 
 
 class HuggingchatStreamer:
-    def __init__(self, model: str):
+    def __init__(self, model: str, deadline: RequestDeadline = None):
         if model in MODEL_MAP.keys():
             self.model = model
         else:
             self.model = "nous-mixtral-8x7b"
         self.model_fullname = MODEL_MAP[self.model]
         self.message_outputer = OpenaiStreamOutputer(model=self.model)
+        self.deadline = deadline or RequestDeadline()
+        # whether upstream has sent its finish marker, rather than stopped early
+        self.is_finished = False
 
     def chat_response(self, messages: list[dict], verbose=False):
-        requester = HuggingchatRequester(model=self.model)
-        return requester.chat_completions(
-            messages=messages, iter_lines=False, verbose=verbose
-        )
+        probes = CIRCUIT_BREAKERS.check(f"model:{self.model}", "backend:hf_chat")
+        requester = HuggingchatRequester(model=self.model, deadline=self.deadline)
+        try:
+            return requester.chat_completions(
+                messages=messages, iter_lines=False, verbose=verbose
+            )
+        except Exception:
+            # e.g., prompt exceeds token limit, before upstream is called
+            CIRCUIT_BREAKERS.release(probes)
+            raise
 
-    def chat_return_generator(self, stream_response: requests.Response, verbose=False):
-        is_finished = False
+    def chat_return_deltas(self, stream_response: requests.Response, verbose=False):
+        self.is_finished = False
         for line in stream_response.iter_lines():
             line = line.decode("utf-8")
             line = re.sub(r"^data:\s*", "", line)
             line = line.strip()
             if not line:
                 continue
+            if self.deadline.is_stream_expired():
+                logger.warn("\n× Request deadline exceeded, stop streaming")
+                break
 
             content = ""
             content_type = "Completions"
@@ -245,20 +288,29 @@ class HuggingchatStreamer:
                     full_content = data.get("text")
                     if verbose:
                         logger.success("\n[Finished]")
-                    is_finished = True
+                    self.is_finished = True
                     break
                 else:
                     continue
             except Exception as e:
                 logger.warn(e)
 
-            output = self.message_outputer.output(
-                content=content, content_type=content_type
-            )
-            yield output
+            yield content, content_type
+
+        if not self.is_finished:
+            yield "", "Finished"
+
+    def close_response(self, stream_response: requests.Response):
+        # also unblocks the worker thread which is reading from the stream
+        stream_response.close()
 
-        if not is_finished:
-            yield self.message_outputer.output(content="", content_type="Finished")
+    def chat_return_generator(
+        self, stream_response: requests.Response, verbose=False, coalescer=None
+    ):
+        yield from self.message_outputer.output_deltas(
+            self.chat_return_deltas(stream_response, verbose=verbose),
+            coalescer=coalescer,
+        )
 
     def chat_return_dict(self, stream_response: requests.Response):
         final_output = self.message_outputer.default_data.copy()
@@ -269,16 +321,11 @@ class HuggingchatStreamer:
                 "message": {"role": "assistant", "content": ""},
             }
         ]
-        final_content = ""
-        for item in self.chat_return_generator(stream_response):
-            try:
-                data = json.loads(item)
-                delta = data["choices"][0]["delta"]
-                delta_content = delta.get("content", "")
-                if delta_content:
-                    final_content += delta_content
-            except Exception as e:
-                logger.warn(e)
+        final_content = "".join(
+            content
+            for content, content_type in self.chat_return_deltas(stream_response)
+            if content_type == "Completions" and content
+        )
         final_output["choices"][0]["message"]["content"] = final_content.strip()
         return final_output
 
@@ -1,25 +1,48 @@
+import anyio
+import asyncio
+import httpx
 import json
+import os
 import re
 import requests
+import time
 
 from tclogger import logger
+from constants.envs import SECRETS
 from constants.models import MODEL_MAP, STOP_SEQUENCES_MAP
-from constants.envs import PROXIES
 from messagers.message_outputer import OpenaiStreamOutputer
 from messagers.token_checker import TokenChecker
+from networks.backend_pool import BACKEND_POOLS, Backend
+from networks.circuit_breaker import CIRCUIT_BREAKERS, is_upstream_failure
+from networks.connection_pools import CONNECTION_POOLS
+from networks.exceptions import ModelLoadingException
+from networks.hedged_requester import HEDGED_REQUESTER, PrefetchedResponse
+from networks.hf_token_pool import HF_TOKEN_POOL
+from networks.model_loading_scheduler import (
+    MODEL_LOADING_SCHEDULER,
+    parse_loading_error,
+)
+from networks.request_deadline import RequestDeadline
 
 
 class HuggingfaceStreamer:
-    def __init__(self, model: str):
+    def __init__(self, model: str, deadline: RequestDeadline = None):
         if model in MODEL_MAP.keys():
             self.model = model
         else:
             self.model = "nous-mixtral-8x7b"
         self.model_fullname = MODEL_MAP[self.model]
         self.message_outputer = OpenaiStreamOutputer(model=self.model)
+        self.deadline = deadline or RequestDeadline()
+        # whether upstream has sent its finish marker, rather than stopped early
+        self.is_finished = False
+        self.breaker_name = f"model:{self.model}"
+        # half-open probes taken by this request, see `CircuitBreakers.check()`
+        self.breaker_probes = []
 
     def parse_line(self, line):
-        line = line.decode("utf-8")
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
         line = re.sub(r"data:\s*", "", line)
         data = json.loads(line)
         content = ""
@@ -29,9 +52,75 @@ class HuggingfaceStreamer:
             logger.err(data)
         return content
 
-    def chat_response(
+    def get_request_headers(self, backend: Backend, api_key: str = None):
+        request_headers = {
+            "Content-Type": "application/json",
+        }
+        api_key = backend.get_api_key(api_key)
+        if api_key:
+            logger.note(
+                f"Using API Key: {api_key[:3]}{(len(api_key)-7)*'*'}{api_key[-4:]}"
+            )
+            request_headers["Authorization"] = f"Bearer {api_key}"
+        return request_headers
+
+    def select_hf_token(self, backend: Backend, api_key: str = None):
+        # token from pool, only for HF backends and if user gives no token
+        self.hf_token = None
+        if api_key or backend.api_key or not backend.forward_api_key:
+            return api_key
+        self.hf_token = HF_TOKEN_POOL.select()
+        if self.hf_token:
+            return self.hf_token.token
+        return None
+
+    def record_hf_token(self, status_code: int, headers=None, request_headers=None):
+        if not getattr(self, "hf_token", None):
+            return
+        # hedge request could be sent with another token
+        authorization = (request_headers or {}).get("Authorization")
+        if authorization and authorization != f"Bearer {self.hf_token.token}":
+            return
+        HF_TOKEN_POOL.record(self.hf_token, status_code, headers)
+
+    def acquire_backend(self):
+        self.backend.acquire()
+        if getattr(self, "hf_token", None):
+            HF_TOKEN_POOL.acquire(self.hf_token)
+        self.backend_latency = None
+        self.is_backend_ok = True
+        self.is_backend_released = False
+
+    def select_backend(self):
+        # fail fast if all backends of the model are broken
+        self.backend = BACKEND_POOLS.select(self.model)
+        if self.backend is None:
+            backends = BACKEND_POOLS.get(self.model).backends
+            raise CIRCUIT_BREAKERS.get_open_error(
+                [backend.breaker_name for backend in backends]
+            )
+        self.breaker_probes += CIRCUIT_BREAKERS.check(self.backend.breaker_name)
+
+    def record_upstream(self, ok: bool, latency: float = None):
+        CIRCUIT_BREAKERS.record(
+            [self.breaker_name, self.backend.breaker_name], ok, latency=latency
+        )
+
+    def release_backend(self):
+        # release once, when the stream is closed or the request fails
+        if getattr(self, "is_backend_released", True):
+            return
+        self.is_backend_released = True
+        BACKEND_POOLS.release(
+            self.backend, latency=self.backend_latency, ok=self.is_backend_ok
+        )
+        if getattr(self, "hf_token", None):
+            HF_TOKEN_POOL.release(self.hf_token)
+
+    def build_request(
         self,
         prompt: str = None,
+        messages: list[dict] = None,
         temperature: float = 0.5,
         top_p: float = 0.95,
         max_new_tokens: int = None,
@@ -40,18 +129,13 @@ class HuggingfaceStreamer:
     ):
         # https://huggingface.co/docs/api-inference/detailed_parameters?code=curl
         # curl --proxy http://<server>:<port> https://api-inference.huggingface.co/models/<org>/<model_name> -X POST -d '{"inputs":"who are you?","parameters":{"max_new_token":64}}' -H 'Content-Type: application/json' -H 'Authorization: Bearer <HF_TOKEN>'
-        self.request_url = (
-            f"https://api-inference.huggingface.co/models/{self.model_fullname}"
+        self.api_key = api_key
+        self.select_backend()
+        self.request_url = self.backend.get_url(self.model_fullname)
+        self.request_api_key = self.select_hf_token(self.backend, api_key)
+        self.request_headers = self.get_request_headers(
+            self.backend, self.request_api_key
         )
-        self.request_headers = {
-            "Content-Type": "application/json",
-        }
-
-        if api_key:
-            logger.note(
-                f"Using API Key: {api_key[:3]}{(len(api_key)-7)*'*'}{api_key[-4:]}"
-            )
-            self.request_headers["Authorization"] = f"Bearer {api_key}"
 
         if temperature is None or temperature < 0:
             temperature = 0.0
@@ -61,7 +145,7 @@ class HuggingfaceStreamer:
         top_p = max(top_p, 0.01)
         top_p = min(top_p, 0.99)
 
-        checker = TokenChecker(input_str=prompt, model=self.model)
+        checker = TokenChecker(input_str=prompt, model=self.model, messages=messages)
 
         if max_new_tokens is None or max_new_tokens <= 0:
             max_new_tokens = checker.get_token_redundancy()
@@ -95,19 +179,48 @@ class HuggingfaceStreamer:
         #         self.STOP_SEQUENCES[self.model]
         #     ]
 
+    def chat_response(self, **kwargs):
+        self.breaker_probes = CIRCUIT_BREAKERS.check(self.breaker_name)
+        try:
+            self.build_request(**kwargs)
+        except Exception:
+            # e.g., prompt exceeds token limit, before upstream is called
+            CIRCUIT_BREAKERS.release(self.breaker_probes)
+            raise
         logger.back(self.request_url)
-        stream_response = requests.post(
-            self.request_url,
-            headers=self.request_headers,
-            json=self.request_body,
-            proxies=PROXIES,
-            stream=True,
-        )
+        if not self.backend.use_proxy:
+            proxies = {"http": None, "https": None}
+        elif self.backend.proxy:
+            proxies = {"http": self.backend.proxy, "https": self.backend.proxy}
+        else:
+            proxies = None
+        self.acquire_backend()
+        start_time = time.monotonic()
+        try:
+            stream_response = CONNECTION_POOLS.get_session(self.backend.name).post(
+                self.request_url,
+                headers=self.request_headers,
+                json=self.request_body,
+                stream=True,
+                proxies=proxies,
+                timeout=self.deadline.get_stream_timeout(),
+            )
+        except Exception:
+            self.is_backend_ok = False
+            self.record_upstream(ok=False)
+            self.release_backend()
+            raise
+        self.backend_latency = time.monotonic() - start_time
         status_code = stream_response.status_code
+        self.record_upstream(
+            ok=not is_upstream_failure(status_code), latency=self.backend_latency
+        )
+        self.record_hf_token(status_code, stream_response.headers)
         if status_code == 200:
             logger.success(status_code)
         else:
             logger.err(status_code)
+            self.is_backend_ok = False
 
         return stream_response
 
@@ -127,17 +240,23 @@ class HuggingfaceStreamer:
         logger.back(final_output)
 
         final_content = ""
-        for line in stream_response.iter_lines():
-            if not line:
-                continue
-            content = self.parse_line(line)
+        try:
+            for line in stream_response.iter_lines():
+                if not line:
+                    continue
+                if self.deadline.is_stream_expired():
+                    logger.warn("\n× Request deadline exceeded, stop streaming")
+                    break
+                content = self.parse_line(line)
 
-            if content.strip() == self.stop_sequences:
-                logger.success("\n[Finished]")
-                break
-            else:
-                logger.back(content, end="")
-                final_content += content
+                if content.strip() == self.stop_sequences:
+                    logger.success("\n[Finished]")
+                    break
+                else:
+                    logger.back(content, end="")
+                    final_content += content
+        finally:
+            self.close_response(stream_response)
 
         if self.model in STOP_SEQUENCES_MAP.keys():
             final_content = final_content.replace(self.stop_sequences, "")
@@ -146,32 +265,269 @@ class HuggingfaceStreamer:
         final_output["choices"][0]["message"]["content"] = final_content
         return final_output
 
-    def chat_return_generator(self, stream_response):
-        is_finished = False
+    def line_to_delta(self, line, line_count: int):
+        content = self.parse_line(line)
+
+        if content.strip().endswith(self.stop_sequences):
+            content_type = "Finished"
+            logger.success("\n[Finished]")
+        else:
+            content_type = "Completions"
+            if line_count == 1:
+                content = content.lstrip()
+
+        logger.back(content, end="")
+        return content, content_type
+
+    def chat_return_deltas(self, stream_response):
+        self.is_finished = False
         line_count = 0
-        for line in stream_response.iter_lines():
-            if line:
-                line_count += 1
-            else:
-                continue
+        try:
+            for line in stream_response.iter_lines():
+                if line:
+                    line_count += 1
+                else:
+                    continue
+                if self.deadline.is_stream_expired():
+                    logger.warn("\n× Request deadline exceeded, stop streaming")
+                    break
+
+                content, content_type = self.line_to_delta(line, line_count)
+                if content_type == "Finished":
+                    self.is_finished = True
+
+                yield content, content_type
+        finally:
+            self.close_response(stream_response)
+
+        if not self.is_finished:
+            yield "", "Finished"
+
+    def close_response(self, stream_response):
+        # also unblocks the worker thread which is reading from the stream
+        stream_response.close()
+        self.release_backend()
+
+    def chat_return_generator(self, stream_response, coalescer=None):
+        yield from self.message_outputer.output_deltas(
+            self.chat_return_deltas(stream_response), coalescer=coalescer
+        )
+
+
+class AsyncHuggingfaceStreamer(HuggingfaceStreamer):
+    """
+    Stream from HF inference API on the event loop, with the pooled `httpx.AsyncClient`,
+    so that long-lived streams do not hold a worker thread each.
 
-            content = self.parse_line(line)
+    Response is returned once the first token arrives,
+    and with hedging, a slow first token triggers a second request.
+    """
 
-            if content.strip().endswith(self.stop_sequences):
-                content_type = "Finished"
-                logger.success("\n[Finished]")
-                is_finished = True
+    def get_async_client(self, backend: Backend) -> httpx.AsyncClient:
+        return CONNECTION_POOLS.get_async_client(
+            backend.name, proxy=backend.proxy, use_proxy=backend.use_proxy
+        )
+
+    def build_hedge_request(self, client: httpx.AsyncClient):
+        # hedge to: the hedging endpoint, or another backend of the model,
+        #   or the mirror endpoint, or the same backend
+        self.hedge_backend = None
+        endpoint = HEDGED_REQUESTER.endpoint
+        if not endpoint:
+            self.hedge_backend = BACKEND_POOLS.select(self.model, exclude=[self.backend])
+        if self.hedge_backend:
+            client = self.get_async_client(self.hedge_backend)
+            request_url = self.hedge_backend.get_url(self.model_fullname)
+            request_headers = self.get_request_headers(
+                self.hedge_backend, self.request_api_key
+            )
+        else:
+            endpoint = endpoint or os.environ.get("HF_ENDPOINT")
+            if endpoint:
+                request_url = f"{endpoint.rstrip('/')}/models/{self.model_fullname}"
             else:
-                content_type = "Completions"
-                if line_count == 1:
-                    content = content.lstrip()
+                request_url = self.request_url
+            request_headers = dict(self.request_headers)
+        # with the hedge token if user gives no key, and only to HF backends
+        hedge_api_key = SECRETS["HF_HEDGE_TOKEN"]
+        is_hf_backend = (self.hedge_backend or self.backend).forward_api_key
+        if not self.api_key and hedge_api_key and is_hf_backend:
+            request_headers["Authorization"] = f"Bearer {hedge_api_key}"
+        request = client.build_request(
+            "POST",
+            request_url,
+            headers=request_headers,
+            json=self.request_body,
+            timeout=self.request_timeout,
+        )
+        return client, request
 
-            logger.back(content, end="")
+    def switch_to_hedge_backend(self, elapsed_time: float):
+        # primary backend lost to hedge backend, so it is charged with the elapsed time;
+        # only the backend slot moves, as the hf token is still held by the request
+        BACKEND_POOLS.release(self.backend, latency=elapsed_time, ok=self.is_backend_ok)
+        self.backend = self.hedge_backend
+        self.backend.acquire()
+        self.backend_latency = None
+        self.is_backend_ok = True
 
-            output = self.message_outputer.output(
-                content=content, content_type=content_type
+    async def chat_response(self, hedge: bool = None, **kwargs):
+        self.breaker_probes = CIRCUIT_BREAKERS.check(self.breaker_name)
+        try:
+            await self.prepare_request(hedge=hedge, **kwargs)
+            return await self.send_request()
+        except BaseException:
+            # probes are given back, unless the outcome of upstream is recorded,
+            # e.g., failed by token limit, cancelled, or model is loading
+            CIRCUIT_BREAKERS.release(self.breaker_probes)
+            raise
+
+    async def prepare_request(self, hedge: bool = None, **kwargs):
+        # token counting may load tokenizers, so keep it off the event loop
+        await asyncio.to_thread(self.build_request, **kwargs)
+        logger.back(self.request_url)
+        self.primary_backend = self.backend
+        self.client = self.get_async_client(self.backend)
+        connect_timeout, read_timeout = self.deadline.get_stream_timeout()
+        self.request_timeout = httpx.Timeout(connect_timeout, read=read_timeout)
+        self.request = self.client.build_request(
+            "POST",
+            self.request_url,
+            headers=self.request_headers,
+            json=self.request_body,
+            timeout=self.request_timeout,
+        )
+        if hedge is None:
+            hedge = HEDGED_REQUESTER.enabled
+        if hedge:
+            self.hedge_client, self.hedge_request = self.build_hedge_request(
+                self.client
             )
+        else:
+            self.hedge_client, self.hedge_request = None, None
+
+    async def check_model_loading(self, stream_response: PrefetchedResponse):
+        # cold model is not an upstream failure, so raise before it is recorded
+        if stream_response.status_code != 503:
+            return
+        try:
+            content = await stream_response.response.aread()
+        except Exception:
+            return
+        is_loading, estimated_time = parse_loading_error(content)
+        if not is_loading:
+            return
+        logger.warn(f"Model is loading, estimated time: {estimated_time}s")
+        self.release_backend()
+        await stream_response.aclose()
+        raise ModelLoadingException(self.model, estimated_time)
+
+    async def send_request(self):
+        # could be sent again by `retry_loading`
+        self.backend = self.primary_backend
+        self.acquire_backend()
+        start_time = time.monotonic()
+        try:
+            stream_response = await HEDGED_REQUESTER.send(
+                self.model,
+                self.client,
+                self.request,
+                hedge_request=self.hedge_request,
+                hedge_client=self.hedge_client,
+            )
+        except BaseException as e:
+            # cancelled by client disconnect is not an upstream failure
+            if isinstance(e, Exception):
+                self.record_upstream(ok=False)
+            self.is_backend_ok = False
+            self.release_backend()
+            raise
+        is_hedge_winner = stream_response.response.request is self.hedge_request
+        if is_hedge_winner and self.hedge_backend:
+            self.switch_to_hedge_backend(time.monotonic() - start_time)
+        await self.check_model_loading(stream_response)
+        self.backend_latency = stream_response.ttft
+        status_code = stream_response.status_code
+        self.record_upstream(
+            ok=not is_upstream_failure(status_code),
+            latency=self.backend_latency or time.monotonic() - start_time,
+        )
+        self.record_hf_token(
+            status_code,
+            stream_response.response.headers,
+            stream_response.response.request.headers,
+        )
+        if status_code == 200:
+            logger.success(status_code)
+        else:
+            logger.err(status_code)
+            self.is_backend_ok = False
+
+        self.stream_response = stream_response
+        return stream_response
+
+    async def retry_loading(self, error: ModelLoadingException):
+        # wait for the cold model, sharing the probe with other requests of it
+        return await MODEL_LOADING_SCHEDULER.retry(
+            self.model, self.send_request, self.deadline, error.estimated_time
+        )
+
+    async def chat_return_deltas(self, stream_response: httpx.Response):
+        self.is_finished = False
+        line_count = 0
+        try:
+            async for line in stream_response.aiter_lines():
+                if line:
+                    line_count += 1
+                else:
+                    continue
+                if self.deadline.is_stream_expired():
+                    logger.warn("\n× Request deadline exceeded, stop streaming")
+                    break
+
+                content, content_type = self.line_to_delta(line, line_count)
+                if content_type == "Finished":
+                    self.is_finished = True
+
+                yield content, content_type
+        finally:
+            await self.close_response(stream_response)
+
+        if not self.is_finished:
+            yield "", "Finished"
+
+    async def close_response(self, stream_response: httpx.Response = None):
+        # response could be got later, e.g., after waiting for model loading
+        if stream_response is None:
+            stream_response = getattr(self, "stream_response", None)
+        # closing must not be interrupted when the client has disconnected
+        with anyio.CancelScope(shield=True):
+            if stream_response is not None:
+                await stream_response.aclose()
+        self.release_backend()
+
+    async def chat_return_generator(self, stream_response, coalescer=None):
+        async for output in self.message_outputer.aoutput_deltas(
+            self.chat_return_deltas(stream_response), coalescer=coalescer
+        ):
             yield output
 
-        if not is_finished:
-            yield self.message_outputer.output(content="", content_type="Finished")
+    async def chat_return_dict(self, stream_response: httpx.Response):
+        final_output = self.message_outputer.default_data.copy()
+        final_output["choices"] = [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": ""},
+            }
+        ]
+        contents = []
+        async for content, content_type in self.chat_return_deltas(stream_response):
+            contents.append(content)
+            if content_type == "Finished":
+                break
+        final_content = "".join(contents)
+        if self.model in STOP_SEQUENCES_MAP.keys():
+            final_content = final_content.replace(self.stop_sequences, "")
+        final_output["choices"][0]["message"]["content"] = final_content.strip()
+        return final_output
@@ -0,0 +1,97 @@
+import bisect
+import threading
+
+from collections import defaultdict
+
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)  # fmt: skip
+
+
+def format_metric_key(name: str, labels: dict = None) -> str:
+    # name{label1="value1",label2="value2"}, same as Prometheus
+    if not labels:
+        return name
+    labels_str = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{labels_str}}}"
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict:
+        cumulative_counts = {}
+        cumulative_count = 0
+        for bucket, bucket_count in zip(self.buckets, self.bucket_counts):
+            cumulative_count += bucket_count
+            cumulative_counts[str(bucket)] = cumulative_count
+        cumulative_counts["+Inf"] = self.count
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative_counts}
+
+
+class Metrics:
+    """
+    In-process counters, gauges and histograms, exported by `/metrics`.
+
+    Collectors are called on each snapshot, to refresh gauges
+    from states which are owned by other components (e.g., pools, queues).
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = format_metric_key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def set(self, name: str, value: float, **labels):
+        key = format_metric_key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, value: float, buckets: tuple = None, **labels):
+        key = format_metric_key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets or DEFAULT_BUCKETS)
+            self.histograms[key].observe(value)
+
+    def get(self, name: str, **labels) -> float:
+        key = format_metric_key(name, labels)
+        with self.lock:
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+    def register_collector(self, collector):
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        for collector in self.collectors:
+            collector(self)
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {
+                    key: histogram.to_dict()
+                    for key, histogram in self.histograms.items()
+                },
+            }
+
+
+METRICS = Metrics()
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import random
+import time
+
+from tclogger import logger
+
+from constants.envs import CONFIG
+from networks.exceptions import ModelLoadingException
+from networks.metrics import METRICS
+from networks.request_deadline import RequestDeadline
+
+
+def parse_loading_error(content: bytes):
+    # {"error": "Model xxx is currently loading", "estimated_time": 20.0}
+    # returns (is_loading, estimated_time)
+    try:
+        data = json.loads(content)
+    except Exception:
+        return False, None
+    if not isinstance(data, dict):
+        return False, None
+    estimated_time = data.get("estimated_time")
+    is_loading = estimated_time is not None or "loading" in str(data.get("error", ""))
+    return is_loading, estimated_time
+
+
+class ModelLoadingState:
+    def __init__(self):
+        # probe of upstream, shared by all waiters of the model
+        self.probe_task = None
+        self.estimated_time = None
+
+
+class ModelLoadingScheduler:
+    """
+    Retry requests of cold models, which HF inference API answers
+    with 503 and `estimated_time` while loading.
+
+    Waiters of the same model share one probe task: the first waiter starts it
+    with its own request after a jittered backoff (bounded by its deadline),
+    and takes the stream of it, while other waiters await the probe (shielded,
+    so their deadlines do not cancel it), and resend at once when it succeeds.
+    """
+
+    def __init__(self):
+        configs = CONFIG["model_loading"] or {}
+        self.enabled = configs.get("enabled", True)
+        self.max_retries = int(configs.get("max_retries", 10))
+        self.min_backoff = float(configs.get("min_backoff", 1))
+        self.max_backoff = float(configs.get("max_backoff", 30))
+        self.jitter = float(configs.get("jitter", 0.3))
+        self.states = {}
+
+    def get_state(self, model: str) -> ModelLoadingState:
+        if model not in self.states:
+            self.states[model] = ModelLoadingState()
+        return self.states[model]
+
+    def get_backoff(self, attempt: int, estimated_time: float = None) -> float:
+        if estimated_time:
+            backoff = estimated_time
+        else:
+            backoff = self.min_backoff * 2**attempt
+        backoff = min(max(backoff, self.min_backoff), self.max_backoff)
+        return backoff * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def probe(self, model: str, send, backoff: float):
+        logger.note(f"> Model loading, retry in {backoff:.1f}s: {model}")
+        await asyncio.sleep(backoff)
+        METRICS.inc("model_loading_probes", model=model)
+        return await send()
+
+    def join_probe(self, model: str, send, deadline: RequestDeadline, attempt: int):
+        # returns (probe_task, is_owner), the probe is started by the first waiter
+        state = self.get_state(model)
+        if state.probe_task is not None and not state.probe_task.done():
+            return state.probe_task, False
+        backoff = self.get_backoff(attempt, state.estimated_time)
+        remaining = deadline.remaining()
+        if remaining is not None and backoff >= remaining:
+            raise ModelLoadingException(
+                model, state.estimated_time, "Model is still loading,"
+                " and would not be ready before request deadline",
+            )
+        state.probe_task = asyncio.create_task(self.probe(model, send, backoff))
+        return state.probe_task, True
+
+    async def retry(
+        self,
+        model: str,
+        send,
+        deadline: RequestDeadline,
+        estimated_time: float = None,
+    ):
+        state = self.get_state(model)
+        state.estimated_time = estimated_time
+        wait_start_time = time.monotonic()
+        METRICS.inc("model_loading_waits", model=model)
+
+        for attempt in range(self.max_retries):
+            probe_task, is_owner = self.join_probe(model, send, deadline, attempt)
+            try:
+                async with asyncio.timeout(deadline.remaining()):
+                    if is_owner:
+                        # probe is the request of owner, so its stream is taken
+                        response = await probe_task
+                    else:
+                        await asyncio.shield(probe_task)
+            except ModelLoadingException as e:
+                state.estimated_time = e.estimated_time
+                continue
+            except TimeoutError:
+                raise ModelLoadingException(
+                    model, state.estimated_time, "Request deadline exceeded"
+                    " while waiting for model loading",
+                )
+            except asyncio.CancelledError:
+                # probe is cancelled with its owner, then another one is started
+                if is_owner or asyncio.current_task().cancelling():
+                    raise
+                continue
+            except Exception:
+                # probe of other waiter failed, then this waiter probes itself
+                if is_owner:
+                    raise
+                continue
+            if not is_owner:
+                # model is loaded, so resend the request of this waiter
+                try:
+                    response = await send()
+                except ModelLoadingException as e:
+                    state.estimated_time = e.estimated_time
+                    continue
+            METRICS.observe(
+                "model_loading_wait_seconds",
+                time.monotonic() - wait_start_time,
+                model=model,
+            )
+            return response
+
+        raise ModelLoadingException(
+            model, state.estimated_time, "Model is still loading after retries"
+        )
+
+
+MODEL_LOADING_SCHEDULER = ModelLoadingScheduler()
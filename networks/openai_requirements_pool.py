@@ -0,0 +1,137 @@
+import threading
+import time
+
+from collections import deque
+
+from tclogger import logger
+
+from constants.envs import CONFIG
+from networks.circuit_breaker import CIRCUIT_BREAKERS
+from networks.metrics import METRICS
+
+
+class OpenaiRequirementsPool:
+    """
+    Bounded queue of prepared `OpenaiRequester`s, each with a fresh device ID,
+    chat-requirements token and solved proof token.
+
+    Producers start on first demand and keep the queue full,
+    so that a request only dequeues one instead of waiting for
+    `sentinel/chat-requirements` and the proof-of-work.
+    Prepared requesters older than `max_age` are discarded.
+    """
+
+    def __init__(
+        self, size: int = None, max_age: float = None, refill_concurrency: int = None
+    ):
+        configs = CONFIG["openai_requirements_pool"] or {}
+        self.enabled = configs.get("enabled", True)
+        self.size = int(size or configs.get("size", 4))
+        self.max_age = float(max_age or configs.get("max_age", 120))
+        self.refill_concurrency = int(
+            refill_concurrency or configs.get("refill_concurrency", 2)
+        )
+        self.requesters = deque()
+        self.produced_times = deque()
+        self.producing_count = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.producer_threads = []
+        self.stop_event = threading.Event()
+        METRICS.register_collector(self.collect_metrics)
+
+    def is_expired(self, requester, now: float = None):
+        now = now or time.monotonic()
+        return now - requester.prepared_at > self.max_age
+
+    def discard_expired(self, now: float = None):
+        now = now or time.monotonic()
+        while self.requesters and self.is_expired(self.requesters[0], now):
+            self.requesters.popleft()
+            METRICS.inc("openai_requirements_pool_expired")
+
+    def checkout(self):
+        if not self.enabled:
+            return None
+        self.start()
+        now = time.monotonic()
+        with self.condition:
+            self.discard_expired(now)
+            requester = self.requesters.popleft() if self.requesters else None
+            self.condition.notify()
+        if requester:
+            METRICS.inc("openai_requirements_pool_hits")
+            METRICS.observe(
+                "openai_requirements_pool_checkout_age", now - requester.prepared_at
+            )
+        else:
+            METRICS.inc("openai_requirements_pool_misses")
+        return requester
+
+    def produce(self):
+        from networks.openai_streamer import OpenaiRequester
+
+        return OpenaiRequester().prepare()
+
+    def run_producer(self):
+        while not self.stop_event.is_set():
+            with self.condition:
+                self.discard_expired()
+                # wait until queue has room, or the oldest one expires
+                while (
+                    len(self.requesters) + self.producing_count >= self.size
+                    and not self.stop_event.is_set()
+                ):
+                    self.condition.wait(timeout=1)
+                    self.discard_expired()
+                if self.stop_event.is_set():
+                    break
+                self.producing_count += 1
+            try:
+                requester = self.produce()
+                CIRCUIT_BREAKERS.record(["backend:openai"], ok=True)
+                with self.condition:
+                    self.requesters.append(requester)
+                    self.produced_times.append(time.monotonic())
+            except Exception as e:
+                CIRCUIT_BREAKERS.record(["backend:openai"], ok=False)
+                METRICS.inc("openai_requirements_pool_refill_errors")
+                logger.warn(f"× Failed to prepare OpenAI requirements: {e}")
+                self.stop_event.wait(1)
+            finally:
+                with self.condition:
+                    self.producing_count -= 1
+
+    def start(self):
+        if not self.enabled or self.producer_threads:
+            return
+        with self.lock:
+            if self.producer_threads:
+                return
+            self.stop_event.clear()
+            for _ in range(self.refill_concurrency):
+                thread = threading.Thread(target=self.run_producer, daemon=True)
+                self.producer_threads.append(thread)
+                thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify_all()
+            self.producer_threads = []
+
+    def collect_metrics(self, metrics):
+        now = time.monotonic()
+        with self.lock:
+            self.discard_expired(now)
+            while self.produced_times and now - self.produced_times[0] > 60:
+                self.produced_times.popleft()
+            depth = len(self.requesters)
+            oldest_age = now - self.requesters[0].prepared_at if depth else 0
+            refill_rate = len(self.produced_times)
+        metrics.set("openai_requirements_pool_depth", depth)
+        metrics.set("openai_requirements_pool_oldest_age", oldest_age)
+        metrics.set("openai_requirements_pool_refill_rate_per_minute", refill_rate)
+
+
+OPENAI_REQUIREMENTS_POOL = OpenaiRequirementsPool()
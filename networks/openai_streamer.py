@@ -2,21 +2,27 @@ import copy
 import json
 import re
 import tiktoken
+import time
 import uuid
 
 from curl_cffi import requests
 from tclogger import logger
 
-from constants.envs import PROXIES
 from constants.headers import OPENAI_GET_HEADERS, OPENAI_POST_DATA
 from constants.models import TOKEN_LIMIT_MAP, TOKEN_RESERVED
 
 from messagers.message_outputer import OpenaiStreamOutputer
+from messagers.token_checker import TOKEN_COUNT_CACHE
+from networks.circuit_breaker import CIRCUIT_BREAKERS
+from networks.connection_pools import CONNECTION_POOLS
+from networks.openai_requirements_pool import OPENAI_REQUIREMENTS_POOL
 from networks.proof_worker import ProofWorker
+from networks.request_deadline import RequestDeadline
 
 
 class OpenaiRequester:
-    def __init__(self):
+    def __init__(self, deadline: RequestDeadline = None):
+        self.deadline = deadline or RequestDeadline()
         self.init_requests_params()
 
     def init_requests_params(self):
@@ -87,22 +93,24 @@ class OpenaiRequester:
 
     def get_models(self):
         self.log_request(self.api_models)
-        res = requests.get(
+        res = CONNECTION_POOLS.cffi_request(
+            "openai",
+            "GET",
             self.api_models,
             headers=self.requests_headers,
-            proxies=PROXIES,
-            timeout=10,
+            timeout=self.deadline.get_timeout(10),
             impersonate="chrome120",
         )
         self.log_response(res)
 
     def auth(self):
         self.log_request(self.api_chat_requirements, method="POST")
-        res = requests.post(
+        res = CONNECTION_POOLS.cffi_request(
+            "openai",
+            "POST",
             self.api_chat_requirements,
             headers=self.requests_headers,
-            proxies=PROXIES,
-            timeout=10,
+            timeout=self.deadline.get_timeout(10),
             impersonate="chrome120",
         )
         data = res.json()
@@ -128,14 +136,26 @@ class OpenaiRequester:
         ]
         return new_messages
 
-    def chat_completions(self, messages: list[dict], iter_lines=False, verbose=False):
-        proof_token = ProofWorker().calc_proof_token(
+    def solve_proof(self):
+        self.proof_token = ProofWorker().calc_proof_token(
             self.chat_requirements_seed, self.chat_requirements_difficulty
         )
+        return self.proof_token
+
+    def prepare(self):
+        # requirements and proof token can be prepared before the request comes
+        self.auth()
+        self.solve_proof()
+        self.prepared_at = time.monotonic()
+        return self
+
+    def chat_completions(self, messages: list[dict], iter_lines=False, verbose=False):
+        if not getattr(self, "proof_token", None):
+            self.solve_proof()
         extra_headers = {
             "Accept": "text/event-stream",
             "Openai-Sentinel-Chat-Requirements-Token": self.chat_requirements_token,
-            "Openai-Sentinel-Proof-Token": proof_token,
+            "Openai-Sentinel-Proof-Token": self.proof_token,
         }
         requests_headers = copy.deepcopy(self.requests_headers)
         requests_headers.update(extra_headers)
@@ -148,13 +168,13 @@ class OpenaiRequester:
         post_data.update(extra_data)
 
         self.log_request(self.api_conversation, method="POST")
-        s = requests.Session()
-        res = s.post(
+        res = CONNECTION_POOLS.cffi_request(
+            "openai",
+            "POST",
             self.api_conversation,
             headers=requests_headers,
             json=post_data,
-            proxies=PROXIES,
-            timeout=10,
+            timeout=self.deadline.get_stream_timeout(),
             impersonate="chrome120",
             stream=True,
         )
@@ -163,16 +183,25 @@ class OpenaiRequester:
 
 
 class OpenaiStreamer:
-    def __init__(self):
+    def __init__(self, deadline: RequestDeadline = None):
         self.model = "gpt-3.5-turbo"
         self.message_outputer = OpenaiStreamOutputer(
             owned_by="openai", model="gpt-3.5-turbo"
         )
         self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        self.deadline = deadline or RequestDeadline()
+        # whether upstream has sent its finish marker, rather than stopped early
+        self.is_finished = False
+
+    def encode_content(self, content: str):
+        return len(self.tokenizer.encode(content))
 
     def count_tokens(self, messages: list[dict]):
         token_count = sum(
-            len(self.tokenizer.encode(message["content"])) for message in messages
+            TOKEN_COUNT_CACHE.get_or_count(
+                self.model, message["content"], self.encode_content
+            )
+            for message in messages
         )
         logger.note(f"Prompt Token Count: {token_count}")
         return token_count
@@ -188,18 +217,39 @@ class OpenaiStreamer:
         return True
 
     def chat_response(self, messages: list[dict], iter_lines=False, verbose=False):
-        self.check_token_limit(messages)
-        logger.enter_quiet(not verbose)
-        requester = OpenaiRequester()
-        requester.auth()
-        logger.exit_quiet(not verbose)
-        return requester.chat_completions(
-            messages=messages, iter_lines=iter_lines, verbose=verbose
+        breaker_names = [f"model:{self.model}", "backend:openai"]
+        probes = CIRCUIT_BREAKERS.check(*breaker_names)
+        try:
+            self.check_token_limit(messages)
+        except Exception:
+            CIRCUIT_BREAKERS.release(probes)
+            raise
+        start_time = time.monotonic()
+        try:
+            requester = OPENAI_REQUIREMENTS_POOL.checkout()
+            if requester:
+                requester.deadline = self.deadline
+            else:
+                logger.enter_quiet(not verbose)
+                requester = OpenaiRequester(deadline=self.deadline)
+                requester.auth()
+                logger.exit_quiet(not verbose)
+            res = requester.chat_completions(
+                messages=messages, iter_lines=iter_lines, verbose=verbose
+            )
+        except Exception:
+            CIRCUIT_BREAKERS.record(breaker_names, ok=False)
+            raise
+        CIRCUIT_BREAKERS.record(
+            breaker_names,
+            ok=res.status_code == 200,
+            latency=time.monotonic() - start_time,
         )
+        return res
 
-    def chat_return_generator(self, stream_response: requests.Response, verbose=False):
+    def chat_return_deltas(self, stream_response: requests.Response, verbose=False):
         content_offset = 0
-        is_finished = False
+        self.is_finished = False
 
         for line in stream_response.iter_lines():
             line = line.decode("utf-8")
@@ -208,12 +258,15 @@ class OpenaiStreamer:
 
             if not line:
                 continue
+            if self.deadline.is_stream_expired():
+                logger.warn("\n× Request deadline exceeded, stop streaming")
+                break
 
             if re.match(r"^\[DONE\]", line):
                 content_type = "Finished"
                 delta_content = ""
                 logger.success("\n[Finished]")
-                is_finished = True
+                self.is_finished = True
             else:
                 content_type = "Completions"
                 delta_content = ""
@@ -234,13 +287,22 @@ class OpenaiStreamer:
                 except Exception as e:
                     logger.warn(e)
 
-            output = self.message_outputer.output(
-                content=delta_content, content_type=content_type
-            )
-            yield output
+            yield delta_content, content_type
+
+        if not self.is_finished:
+            yield "", "Finished"
 
-        if not is_finished:
-            yield self.message_outputer.output(content="", content_type="Finished")
+    def close_response(self, stream_response: requests.Response):
+        # also unblocks the worker thread which is reading from the stream
+        stream_response.close()
+
+    def chat_return_generator(
+        self, stream_response: requests.Response, verbose=False, coalescer=None
+    ):
+        yield from self.message_outputer.output_deltas(
+            self.chat_return_deltas(stream_response, verbose=verbose),
+            coalescer=coalescer,
+        )
 
     def chat_return_dict(self, stream_response: requests.Response):
         final_output = self.message_outputer.default_data.copy()
@@ -251,16 +313,11 @@ class OpenaiStreamer:
                 "message": {"role": "assistant", "content": ""},
             }
         ]
-        final_content = ""
-        for item in self.chat_return_generator(stream_response):
-            try:
-                data = json.loads(item)
-                delta = data["choices"][0]["delta"]
-                delta_content = delta.get("content", "")
-                if delta_content:
-                    final_content += delta_content
-            except Exception as e:
-                logger.warn(e)
+        final_content = "".join(
+            content
+            for content, content_type in self.chat_return_deltas(stream_response)
+            if content_type == "Completions" and content
+        )
         final_output["choices"][0]["message"]["content"] = final_content.strip()
         return final_output
 
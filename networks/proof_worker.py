@@ -1,20 +1,159 @@
 import base64
 from hashlib import sha3_512
 import json
+import multiprocessing
 import random
+import threading
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime, timedelta, timezone
 
+from constants.envs import CONFIG
 from constants.headers import OPENAI_GET_HEADERS
 
 
+NONCE_PLACEHOLDER = "__NONCE__"
+HEX_CHARS = "0123456789abcdef"
+# chunks of concurrent solves poll their own stop flag, every `STOP_POLL_ATTEMPTS`
+STOP_SLOTS = 64
+STOP_POLL_ATTEMPTS = 500
+# set in pool processes by `init_proof_process()`
+process_stop_flags = None
+
+
+class ProofSolver:
+    """
+    Solve proof-of-work of a config and seed, with invariant parts precomputed:
+    * json of config is split into (prefix, nonce digits, suffix) bytes
+    * base64 of the prefix (aligned to 3 bytes) is fed to the seed hasher once,
+        and base64 of the suffix is precomputed for each alignment
+    * each nonce only encodes a few bytes around its digits,
+        copies the seed hasher, and compares the raw digest bytes
+    """
+
+    def __init__(self, config: list, seed: str, difficulty: str):
+        config = list(config)
+        config[3] = NONCE_PLACEHOLDER
+        json_prefix, json_suffix = json.dumps(config).split(
+            json.dumps(NONCE_PLACEHOLDER)
+        )
+        prefix = json_prefix.encode()
+        self.suffix = json_suffix.encode()
+
+        aligned_len = len(prefix) // 3 * 3
+        self.prefix_b64 = base64.b64encode(prefix[:aligned_len])
+        self.prefix_tail = prefix[aligned_len:]
+        self.suffix_b64s = [base64.b64encode(self.suffix[k:]) for k in range(3)]
+        self.seed_hasher = sha3_512(seed.encode() + self.prefix_b64)
+
+        # hash.hex()[:diff_len] <= difficulty
+        self.difficulty = difficulty
+        self.diff_len = len(difficulty) // 2
+        if all(char in HEX_CHARS for char in difficulty[: self.diff_len]):
+            self.target_bytes_len = (self.diff_len + 1) // 2
+            self.target_shift = 4 * (2 * self.target_bytes_len - self.diff_len)
+            self.target = int(difficulty[: self.diff_len] or "0", 16)
+            if self.target_shift == 0:
+                self.target_bytes = self.target.to_bytes(self.target_bytes_len, "big")
+            else:
+                self.target_bytes = None
+        else:
+            self.target_bytes_len = None
+
+    def is_solved(self, digest: bytes) -> bool:
+        if self.target_bytes_len is None:
+            return digest.hex()[: self.diff_len] <= self.difficulty
+        elif self.target_bytes is not None:
+            return digest[: self.target_bytes_len] <= self.target_bytes
+        else:
+            prefix_value = int.from_bytes(digest[: self.target_bytes_len], "big")
+            return prefix_value >> self.target_shift <= self.target
+
+    def encode_middle(self, nonce: int):
+        middle = self.prefix_tail + str(nonce).encode()
+        k = -len(middle) % 3
+        return base64.b64encode(middle + self.suffix[:k]), k
+
+    def solve_range(self, start: int, end: int):
+        seed_hasher = self.seed_hasher
+        suffix_b64s = self.suffix_b64s
+        for nonce in range(start, end):
+            middle_b64, k = self.encode_middle(nonce)
+            hasher = seed_hasher.copy()
+            hasher.update(middle_b64)
+            hasher.update(suffix_b64s[k])
+            if self.is_solved(hasher.digest()):
+                return (self.prefix_b64 + middle_b64 + suffix_b64s[k]).decode()
+        return None
+
+
+def init_proof_process(stop_flags):
+    global process_stop_flags
+    process_stop_flags = stop_flags
+
+
+def solve_proof_range(
+    config: list, seed: str, difficulty: str, start: int, end: int, slot: int = None
+):
+    # chunk stops early, once other chunk of the same solve has found the nonce
+    solver = ProofSolver(config, seed, difficulty)
+    stop_flags = process_stop_flags
+    for batch_start in range(start, end, STOP_POLL_ATTEMPTS):
+        if slot is not None and stop_flags is not None and stop_flags[slot]:
+            return None
+        batch_end = min(batch_start + STOP_POLL_ATTEMPTS, end)
+        base = solver.solve_range(batch_start, batch_end)
+        if base:
+            return base
+    return None
+
+
 class ProofWorker:
+    """
+    Processes are spawned, rather than forked from the threaded server,
+    and kept in a process-wide pool of `processes` (2 by default).
+    """
+
+    executor: ProcessPoolExecutor = None
+    executor_lock = threading.Lock()
+    stop_flags = None
+    next_slot = 0
+
     def __init__(self, difficulty=None, required=False, seed=None):
         self.difficulty = difficulty
         self.required = required
         self.seed = seed
         self.proof_token_prefix = "gAAAAABwQ8Lk5FbGpA2NcR9dShT6gYjU7VxZ4D"
 
+        configs = CONFIG["proof_worker"] or {}
+        self.max_attempts = int(configs.get("max_attempts", 100000))
+        # easy difficulties are solved inline, before fanning out to processes
+        self.inline_attempts = int(configs.get("inline_attempts", 5000))
+        self.chunk_size = int(configs.get("chunk_size", 5000))
+        self.processes = int(configs.get("processes") or 2)
+
+    @classmethod
+    def get_executor(cls, processes: int) -> ProcessPoolExecutor:
+        with cls.executor_lock:
+            if cls.executor is None:
+                mp_context = multiprocessing.get_context("spawn")
+                cls.stop_flags = mp_context.Array("b", STOP_SLOTS, lock=False)
+                cls.executor = ProcessPoolExecutor(
+                    max_workers=processes,
+                    mp_context=mp_context,
+                    initializer=init_proof_process,
+                    initargs=(cls.stop_flags,),
+                )
+            return cls.executor
+
+    @classmethod
+    def take_stop_slot(cls) -> int:
+        with cls.executor_lock:
+            slot = cls.next_slot
+            cls.next_slot = (slot + 1) % STOP_SLOTS
+            cls.stop_flags[slot] = 0
+            return slot
+
     def get_parse_time(self):
         now = datetime.now()
         tz = timezone(timedelta(hours=8))
@@ -35,18 +174,49 @@ class ProofWorker:
             OPENAI_GET_HEADERS["User-Agent"],
         ]
 
+    def solve_in_processes(self, config: list, seed: str, difficulty: str):
+        # split nonces into chunks, the first solved chunk wins,
+        # pending chunks are cancelled, and running ones stop by the stop flag
+        executor = self.get_executor(self.processes)
+        slot = self.take_stop_slot()
+        chunk_starts = range(self.inline_attempts, self.max_attempts, self.chunk_size)
+        futures = {
+            executor.submit(
+                solve_proof_range,
+                config,
+                seed,
+                difficulty,
+                start,
+                min(start + self.chunk_size, self.max_attempts),
+                slot,
+            )
+            for start in chunk_starts
+        }
+        base = None
+        try:
+            while futures and base is None:
+                done_futures, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    base = future.result()
+                    if base:
+                        break
+        finally:
+            self.stop_flags[slot] = 1
+            for future in futures:
+                future.cancel()
+        return base
+
     def calc_proof_token(self, seed: str, difficulty: str):
         config = self.get_config()
-        diff_len = len(difficulty) // 2
-        for i in range(100000):
-            config[3] = i
-            json_str = json.dumps(config)
-            base = base64.b64encode(json_str.encode()).decode()
-            hasher = sha3_512()
-            hasher.update((seed + base).encode())
-            hash = hasher.digest().hex()
-            if hash[:diff_len] <= difficulty:
-                return "gAAAAAB" + base
+        solver = ProofSolver(config, seed, difficulty)
+        base = solver.solve_range(0, min(self.inline_attempts, self.max_attempts))
+        if base is None and self.max_attempts > self.inline_attempts:
+            if self.processes > 1:
+                base = self.solve_in_processes(config, seed, difficulty)
+            else:
+                base = solver.solve_range(self.inline_attempts, self.max_attempts)
+        if base:
+            return "gAAAAAB" + base
         self.proof_token = (
             self.proof_token_prefix + base64.b64encode(seed.encode()).decode()
         )
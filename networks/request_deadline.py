@@ -0,0 +1,78 @@
+import time
+
+from fastapi import status
+
+from constants.envs import CONFIG
+from networks.exceptions import HfApiException
+from networks.metrics import METRICS
+
+
+class RequestDeadline:
+    """
+    End-to-end deadline of a chat request, shared by setup calls and the stream.
+
+    Timeout comes from `X-Request-Timeout` header (in seconds),
+    or `deadlines.timeout` in config, and is capped by `deadlines.max_timeout`.
+    Each upstream call takes the smaller one of its own timeout and the remaining time.
+    Without timeout, the deadline never expires, which is used by background pools.
+    """
+
+    def __init__(self, timeout: float = None):
+        configs = CONFIG["deadlines"] or {}
+        self.connect_timeout = float(configs.get("connect_timeout", 10))
+        self.read_timeout = float(configs.get("read_timeout", 60))
+        self.timeout = timeout
+        if timeout is None:
+            self.expires_at = None
+        else:
+            self.expires_at = time.monotonic() + float(timeout)
+
+    @classmethod
+    def from_request(cls, timeout: float = None):
+        configs = CONFIG["deadlines"] or {}
+        if timeout is None or timeout <= 0:
+            timeout = configs.get("timeout", 300)
+        max_timeout = configs.get("max_timeout", 600)
+        if max_timeout:
+            timeout = min(timeout, max_timeout)
+        return cls(timeout=timeout)
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0)
+
+    def is_expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self, stage: str = "setup"):
+        if self.is_expired():
+            METRICS.inc("deadline_exceeded", stage=stage)
+            raise HfApiException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail=f"Request deadline exceeded ({self.timeout}s) in {stage}",
+            )
+
+    def get_timeout(self, timeout: float = None, stage: str = "setup") -> float:
+        # timeout of a single upstream call, bounded by the remaining time
+        self.check(stage)
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def get_stream_timeout(self, stage: str = "setup") -> tuple:
+        # (connect, read) timeouts: read timeout bounds the gap between two chunks
+        return (
+            self.get_timeout(self.connect_timeout, stage),
+            self.get_timeout(self.read_timeout, stage),
+        )
+
+    def is_stream_expired(self) -> bool:
+        # streams are ended gracefully instead of raising, as headers are sent
+        if not self.is_expired():
+            return False
+        METRICS.inc("deadline_exceeded", stage="stream")
+        return True
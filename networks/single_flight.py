@@ -0,0 +1,237 @@
+import anyio
+import asyncio
+import inspect
+
+from tclogger import logger
+
+from constants.envs import CONFIG
+from networks.exceptions import HfApiException
+from networks.metrics import METRICS
+from networks.request_deadline import RequestDeadline
+
+
+class Flight:
+    """
+    One upstream stream shared by identical in-flight requests.
+
+    Deltas of upstream are driven by a background task into a broadcast buffer,
+    and each request reads the buffered deltas and then the live tail.
+    Upstream is closed once the stream finishes or all requests have detached.
+    """
+
+    def __init__(self, key: str, model: str):
+        self.key = key
+        self.model = model
+        self.deltas = []
+        self.is_done = False
+        self.error = None
+        self.subscribers_count = 0
+        self.started = asyncio.Event()
+        self.updated = asyncio.Event()
+        self.task = None
+        self.message_outputer = None
+
+    def notify(self):
+        updated, self.updated = self.updated, asyncio.Event()
+        self.started.set()
+        updated.set()
+
+    def publish(self, delta: tuple):
+        self.deltas.append(delta)
+        self.notify()
+
+    def finish(self):
+        self.is_done = True
+        self.notify()
+
+    def fail(self, error: BaseException):
+        if self.is_done:
+            return
+        if not isinstance(error, Exception):
+            # e.g., leader request is cancelled by client disconnect
+            error = HfApiException(502, "Upstream of the shared request was abandoned")
+        self.error = error
+        self.is_done = True
+        self.notify()
+
+    async def drive(self, streamer, stream_response, deltas):
+        try:
+            if inspect.isasyncgen(deltas):
+                async for delta in deltas:
+                    self.publish(delta)
+            else:
+                while True:
+                    delta = await anyio.to_thread.run_sync(
+                        next, deltas, None, abandon_on_cancel=True
+                    )
+                    if delta is None:
+                        break
+                    self.publish(delta)
+            self.finish()
+        except Exception as e:
+            logger.warn(f"× Shared stream failed: {e}")
+            self.fail(e)
+        except BaseException as e:
+            self.fail(e)
+            raise
+        finally:
+            with anyio.CancelScope(shield=True):
+                closed = streamer.close_response(stream_response)
+                if inspect.isawaitable(closed):
+                    await closed
+
+    def start(self, streamer, stream_response, deltas):
+        self.message_outputer = streamer.message_outputer
+        self.task = asyncio.create_task(self.drive(streamer, stream_response, deltas))
+
+    def attach(self):
+        self.subscribers_count += 1
+
+    def detach(self):
+        # stop upstream generation once nobody reads it
+        self.subscribers_count -= 1
+        if self.subscribers_count <= 0 and self.task and not self.task.done():
+            self.task.cancel()
+
+    async def wait_started(self, timeout: float = None):
+        # until the first delta, or failure of the leader request
+        await asyncio.wait_for(self.started.wait(), timeout=timeout)
+        if self.error and not self.deltas:
+            raise self.error
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            while index < len(self.deltas):
+                yield self.deltas[index]
+                index += 1
+            if self.error:
+                raise self.error
+            if self.is_done:
+                return
+            await self.updated.wait()
+
+
+class FlightStreamer:
+    """
+    Read a shared flight, with the same interface as upstream streamers.
+
+    Shared upstream stream is driven without deadline of any request,
+    and each reader stops at its own `deadline`.
+    """
+
+    def __init__(self, flight: Flight, deadline: RequestDeadline = None):
+        self.model = flight.model
+        self.flight = flight
+        self.deadline = deadline or RequestDeadline()
+        self.is_attached = True
+        flight.attach()
+
+    @property
+    def message_outputer(self):
+        # set by the leader, once its upstream stream has started
+        return self.flight.message_outputer
+
+    async def chat_return_deltas(self, stream_response: Flight):
+        deltas = stream_response.subscribe()
+        try:
+            while True:
+                if self.deadline.is_stream_expired():
+                    logger.warn("\n× Request deadline exceeded, stop streaming")
+                    yield "", "Finished"
+                    break
+                try:
+                    delta = await asyncio.wait_for(
+                        anext(deltas), timeout=self.deadline.remaining()
+                    )
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    continue
+                yield delta
+        finally:
+            await deltas.aclose()
+            self.close_response(stream_response)
+
+    async def chat_return_generator(self, stream_response: Flight, coalescer=None):
+        async for output in self.message_outputer.aoutput_deltas(
+            self.chat_return_deltas(stream_response), coalescer=coalescer
+        ):
+            yield output
+
+    async def chat_return_dict(self, stream_response: Flight):
+        final_output = self.message_outputer.default_data.copy()
+        contents = []
+        async for content, content_type in self.chat_return_deltas(stream_response):
+            if content_type == "Completions":
+                contents.append(content)
+        final_output["choices"] = [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "".join(contents).strip()},
+            }
+        ]
+        return final_output
+
+    def close_response(self, stream_response: Flight):
+        if self.is_attached:
+            self.is_attached = False
+            stream_response.detach()
+
+
+class SingleFlight:
+    """
+    Registry of in-flight upstream streams, keyed by `get_completion_key()`.
+
+    The first request of a key leads: its upstream stream becomes a flight,
+    and identical requests which arrive meanwhile follow it, instead of
+    starting their own generation. Only for temperature near 0 by default,
+    as followers get the same sampled answer as the leader.
+    Requests could opt in or out, but never when `enabled` is false in config.
+    """
+
+    def __init__(self):
+        configs = CONFIG["single_flight"] or {}
+        self.enabled = configs.get("enabled", True)
+        self.max_temperature = float(configs.get("max_temperature", 0.1))
+        self.flights = {}
+        METRICS.register_collector(self.collect_metrics)
+
+    def is_enabled(self, temperature: float = None, single_flight: bool = None) -> bool:
+        # config wins, then explicit per-request choice, also for sampling
+        if not self.enabled:
+            return False
+        if single_flight is not None:
+            return single_flight
+        return (temperature or 0) <= self.max_temperature
+
+    def join(self, key: str, model: str):
+        # returns (flight, is_leader)
+        flight = self.flights.get(key)
+        if flight is not None and not flight.is_done:
+            METRICS.inc("single_flight_followers", model=model)
+            return flight, False
+        flight = Flight(key, model)
+        self.flights[key] = flight
+        METRICS.inc("single_flight_leaders", model=model)
+        return flight, True
+
+    def leave(self, flight: Flight):
+        # new requests will not join the flight, while its readers still read
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def start(self, flight: Flight, streamer, stream_response, deltas):
+        flight.start(streamer, stream_response, deltas)
+        flight.task.add_done_callback(lambda _: self.leave(flight))
+
+    def fail(self, flight: Flight, error: BaseException):
+        flight.fail(error)
+        self.leave(flight)
+
+    def collect_metrics(self, metrics):
+        metrics.set("single_flight_in_flight", len(self.flights))
+
+
+SINGLE_FLIGHT = SingleFlight()
@@ -0,0 +1,245 @@
+import anyio
+import math
+import threading
+import time
+
+from fastapi import status
+from tclogger import logger
+
+from constants.envs import CONFIG
+from messagers.token_checker import TokenChecker
+from networks.admission_control import ADMISSION_CONTROL
+from networks.exceptions import HfApiException
+from networks.metrics import METRICS
+
+
+class TokenBucket:
+    """
+    Token bucket of `tokens_per_minute`, refilled continuously.
+
+    Tokens could go below 0, when completions are longer than expected,
+    and then following requests wait until the debt is paid back.
+    """
+
+    def __init__(self, name: str, tokens_per_minute: int):
+        self.name = name
+        self.limit = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.tokens = float(tokens_per_minute)
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed_time = now - self.updated_at
+        self.tokens = min(self.limit, self.tokens + elapsed_time * self.rate)
+        self.updated_at = now
+
+    def get_wait_time(self, tokens: int) -> float:
+        self.refill()
+        # requests larger than the bucket pass once it is full, instead of never
+        tokens = min(tokens, self.limit)
+        return max(tokens - self.tokens, 0) / self.rate
+
+    def consume(self, tokens: int):
+        self.refill()
+        self.tokens -= tokens
+
+    def refund(self, tokens: int):
+        self.refill()
+        self.tokens = min(self.limit, self.tokens + tokens)
+
+    def get_remaining(self) -> int:
+        self.refill()
+        return max(int(self.tokens), 0)
+
+    def get_reset_time(self) -> float:
+        # seconds until the bucket is full again
+        self.refill()
+        return (self.limit - self.tokens) / self.rate
+
+
+class TokenReservation:
+    """
+    Prompt tokens reserved in buckets of a request, before it is sent upstream.
+
+    Completion tokens are counted from deltas on the way to the client,
+    and settled once (idempotent) when the stream ends, or is abandoned.
+    Prompt tokens are refunded by `cancel()`, if the request is not sent upstream.
+    """
+
+    def __init__(
+        self, limiter, buckets: list[TokenBucket], model: str, prompt_tokens: int
+    ):
+        self.limiter = limiter
+        self.buckets = buckets
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = 0
+        self.contents = []
+        self.is_settled = False
+
+    def count_tokens(self, content: str) -> int:
+        if not content:
+            return 0
+        try:
+            return TokenChecker(model=self.model).encode_content(content)
+        except Exception as e:
+            # rough estimate, if tokenizer is not available
+            logger.warn(f"× Completion tokens are estimated: {e}")
+            return math.ceil(len(content) / 4)
+
+    def settle(self, completion_tokens: int = None):
+        if self.is_settled:
+            return
+        self.is_settled = True
+        if completion_tokens is None:
+            completion_tokens = self.count_tokens("".join(self.contents))
+        self.completion_tokens = completion_tokens
+        self.limiter.consume(self.buckets, completion_tokens)
+        METRICS.inc(
+            "token_rate_limit_tokens",
+            completion_tokens,
+            model=self.model,
+            kind="completion",
+        )
+
+    def cancel(self):
+        if self.is_settled:
+            return
+        self.is_settled = True
+        self.limiter.refund(self.buckets, self.prompt_tokens)
+        METRICS.inc("token_rate_limit_refunds", self.prompt_tokens, model=self.model)
+
+    def add(self, content: str, content_type: str):
+        if content_type == "Completions":
+            self.contents.append(content)
+
+    def meter(self, deltas):
+        try:
+            for content, content_type in deltas:
+                self.add(content, content_type)
+                yield content, content_type
+        finally:
+            self.settle()
+
+    async def ameter(self, deltas):
+        try:
+            async for content, content_type in deltas:
+                self.add(content, content_type)
+                yield content, content_type
+        finally:
+            # counting could load tokenizer, so keep it off the event loop
+            with anyio.CancelScope(shield=True):
+                await anyio.to_thread.run_sync(self.settle)
+
+    def settle_dict(self, data: dict):
+        self.contents = [data["choices"][0]["message"]["content"]]
+        self.settle()
+
+
+class TokenRateLimiter:
+    """
+    Tokens per minute of each API key and model, from config:
+
+        "token_rate_limit": {
+            "keys": {"default": 100000, "<api_key>": 500000},
+            "models": {"default": 0, "<model>": 200000},
+        }
+
+    Limit of 0 (or unset, without default) means unlimited.
+    Prompt tokens are reserved in all buckets of a request up front,
+    or the request is rejected with 429, and `Retry-After` of the longest wait.
+    Completion tokens are settled when the stream ends.
+    """
+
+    def __init__(self):
+        configs = CONFIG["token_rate_limit"] or {}
+        self.enabled = configs.get("enabled", True)
+        self.limits = {kind: configs.get(kind) or {} for kind in ["keys", "models"]}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        METRICS.register_collector(self.collect_metrics)
+
+    def get_bucket(self, kind: str, name: str, limit_name: str = None):
+        key = f"{kind}:{name}"
+        if key not in self.buckets:
+            limits = self.limits[kind]
+            limit = int(limits.get(limit_name or name, limits.get("default", 0)) or 0)
+            self.buckets[key] = TokenBucket(key, limit) if limit > 0 else None
+        return self.buckets[key]
+
+    def get_buckets(self, api_key: str, model: str) -> list[TokenBucket]:
+        if not self.enabled:
+            return []
+        key_name = ADMISSION_CONTROL.get_key_name(api_key)
+        buckets = [
+            self.get_bucket("keys", key_name, api_key),
+            self.get_bucket("models", model),
+        ]
+        return [bucket for bucket in buckets if bucket is not None]
+
+    def is_limited(self, api_key: str, model: str) -> bool:
+        return bool(self.get_buckets(api_key, model))
+
+    def get_headers(self, api_key: str = None, model: str = None, buckets=None):
+        # state of the bucket with the least remaining tokens
+        if buckets is None:
+            buckets = self.get_buckets(api_key, model)
+        if not buckets:
+            return {}
+        with self.lock:
+            bucket = min(buckets, key=lambda bucket: bucket.get_remaining())
+            return {
+                "x-ratelimit-limit-tokens": str(bucket.limit),
+                "x-ratelimit-remaining-tokens": str(bucket.get_remaining()),
+                "x-ratelimit-reset-tokens": f"{math.ceil(bucket.get_reset_time())}s",
+            }
+
+    def reject(self, buckets: list[TokenBucket], wait_time: float) -> HfApiException:
+        for bucket in buckets:
+            METRICS.inc("token_rate_limit_rejections", bucket=bucket.name)
+        headers = self.get_headers(buckets=buckets)
+        headers["Retry-After"] = str(max(math.ceil(wait_time), 1))
+        return HfApiException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Token rate limit exceeded: {', '.join(b.name for b in buckets)}",
+            headers=headers,
+        )
+
+    def reserve(self, api_key: str, model: str, prompt_tokens: int) -> TokenReservation:
+        buckets = self.get_buckets(api_key, model)
+        with self.lock:
+            wait_times = {
+                bucket: bucket.get_wait_time(prompt_tokens) for bucket in buckets
+            }
+            exceeded_buckets = [b for b, wait_time in wait_times.items() if wait_time]
+            if not exceeded_buckets:
+                for bucket in buckets:
+                    bucket.consume(prompt_tokens)
+        if exceeded_buckets:
+            raise self.reject(exceeded_buckets, max(wait_times.values()))
+        METRICS.inc(
+            "token_rate_limit_tokens", prompt_tokens, model=model, kind="prompt"
+        )
+        return TokenReservation(self, buckets, model, prompt_tokens)
+
+    def consume(self, buckets: list[TokenBucket], tokens: int):
+        with self.lock:
+            for bucket in buckets:
+                bucket.consume(tokens)
+
+    def refund(self, buckets: list[TokenBucket], tokens: int):
+        with self.lock:
+            for bucket in buckets:
+                bucket.refund(tokens)
+
+    def collect_metrics(self, metrics):
+        with self.lock:
+            for name, bucket in list(self.buckets.items()):
+                if bucket is None:
+                    continue
+                remaining = bucket.get_remaining()
+                metrics.set("token_rate_limit_remaining", remaining, bucket=name)
+
+
+TOKEN_RATE_LIMITER = TokenRateLimiter()
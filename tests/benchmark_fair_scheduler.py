@@ -0,0 +1,88 @@
+import anyio
+import asyncio
+import statistics
+import time
+
+from tclogger import logger
+
+from mocks.stream_chat_mocker import stream_chat_mock
+from networks.fair_scheduler import BULK, INTERACTIVE, FairScheduler
+
+
+async def request_mock(
+    scheduler: FairScheduler, flow_name: str, priority: str, fair: bool = True
+) -> float:
+    # returns time to first token, including the wait in scheduler
+    start_time = time.perf_counter()
+    if fair:
+        ticket = await scheduler.acquire(flow_name, priority=priority)
+    else:
+        # one shared flow of equal weights is plain FIFO
+        ticket = await scheduler.acquire("all", priority=BULK)
+    ttft = None
+    try:
+        deltas = stream_chat_mock(flow_name)
+        while True:
+            delta = await anyio.to_thread.run_sync(next, deltas, None)
+            if ttft is None:
+                ttft = time.perf_counter() - start_time
+            if delta is None or delta == "":
+                break
+    finally:
+        ticket.release()
+    return ttft
+
+
+async def run_load(fair: bool, capacity: int, bulk_count: int, interactive_count: int):
+    scheduler = FairScheduler()
+    scheduler.enabled = True
+    scheduler.capacity = capacity
+    scheduler.max_wait = 600
+    scheduler.class_weights = {INTERACTIVE: 4, BULK: 1}
+    scheduler.key_configs = {}
+
+    # bulk tenant floods the budget, then interactive users arrive
+    bulk_tasks = [
+        asyncio.create_task(request_mock(scheduler, "batch", BULK, fair))
+        for _ in range(bulk_count)
+    ]
+    await asyncio.sleep(0.2)
+    interactive_tasks = []
+    for i in range(interactive_count):
+        interactive_tasks.append(
+            asyncio.create_task(request_mock(scheduler, f"user{i}", INTERACTIVE, fair))
+        )
+        await asyncio.sleep(0.1)
+    bulk_ttfts = await asyncio.gather(*bulk_tasks)
+    interactive_ttfts = await asyncio.gather(*interactive_tasks)
+    return bulk_ttfts, interactive_ttfts
+
+
+def benchmark_fair_scheduler(
+    capacity: int = 4, bulk_count: int = 24, interactive_count: int = 4
+):
+    logger.note(
+        f"> {bulk_count} bulk and {interactive_count} interactive mock streams, "
+        f"capacity {capacity}"
+    )
+    results = {}
+    for fair in [False, True]:
+        bulk_ttfts, interactive_ttfts = asyncio.run(
+            run_load(fair, capacity, bulk_count, interactive_count)
+        )
+        results[fair] = (bulk_ttfts, interactive_ttfts)
+
+    for fair, (bulk_ttfts, interactive_ttfts) in results.items():
+        name = "fair" if fair else "fifo"
+        logger.success(
+            f"  * {name}: interactive TTFT "
+            f"mean {statistics.mean(interactive_ttfts):.2f}s, "
+            f"max {max(interactive_ttfts):.2f}s; "
+            f"bulk TTFT mean {statistics.mean(bulk_ttfts):.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_fair_scheduler()
+
+    # python -m tests.benchmark_fair_scheduler
@@ -0,0 +1,55 @@
+import time
+import tracemalloc
+
+from tclogger import logger
+
+from constants.models import MODEL_MAP
+from messagers.message_composer import MessageComposer
+
+
+def build_conversation(message_count: int = 10000, content_length: int = 200):
+    # agent-loop like history: runs of same-role messages are concatenated
+    roles = ["user", "user", "assistant", "tool", "user", "assistant", "assistant"]
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(message_count - 1):
+        role = roles[i % len(roles)]
+        content = f"[{i}] " + "x" * content_length
+        messages.append({"role": role, "content": content})
+    return messages
+
+
+def measure(func, *args, **kwargs):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed_time = time.perf_counter() - start_time
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed_time, peak_memory
+
+
+def benchmark_message_composer(message_count: int = 10000):
+    messages = build_conversation(message_count)
+    input_size = sum(len(message["content"]) for message in messages)
+    logger.note(
+        f"> Compose {message_count} messages ({input_size/1024/1024:.2f} MB content)"
+    )
+    for model in MODEL_MAP.keys():
+        composer = MessageComposer(model=model)
+        composer.merge(messages[:10])  # warm up compiled template
+        merge_time, merge_memory = measure(composer.merge, messages)
+        decompose_time, decompose_memory = measure(
+            composer.decompose_to_system_and_input_prompt, messages
+        )
+        logger.mesg(
+            f"  * {model:<18} "
+            f"merge: {merge_time*1000:7.2f} ms, {merge_memory/1024/1024:6.2f} MB | "
+            f"decompose: {decompose_time*1000:7.2f} ms, {decompose_memory/1024/1024:6.2f} MB"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_message_composer(10000)
+    benchmark_message_composer(100000)
+
+    # python -m tests.benchmark_message_composer
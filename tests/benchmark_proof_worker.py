@@ -0,0 +1,44 @@
+import time
+
+from tclogger import logger
+
+from networks.proof_worker import ProofSolver, ProofWorker
+from tests.proof_references import solve_by_json_dumps
+
+
+def measure_solves_per_second(solve, difficulty: str, rounds: int):
+    worker = ProofWorker()
+    start_time = time.perf_counter()
+    for i in range(rounds):
+        solve(worker, worker.get_config(), f"0.{i}4266558269349", difficulty)
+    elapsed_time = time.perf_counter() - start_time
+    return rounds / elapsed_time
+
+
+def benchmark_proof_worker(rounds: int = 20):
+    solvers = {
+        "json_dumps": lambda worker, config, seed, difficulty: solve_by_json_dumps(
+            config, seed, difficulty
+        ),
+        "precomputed": lambda worker, config, seed, difficulty: ProofSolver(
+            config, seed, difficulty
+        ).solve_range(0, worker.max_attempts),
+        "processes": lambda worker, config, seed, difficulty: worker.calc_proof_token(
+            seed, difficulty
+        ),
+    }
+    # warm up process pool
+    ProofWorker().solve_in_processes(ProofWorker().get_config(), "0.1", "0")
+    logger.note(f"> Proof-of-work solves per second ({rounds} rounds)")
+    for difficulty in ["0fffff", "05cdf2", "00ffff", "003a9c", "0003a9c0"]:
+        results = []
+        for name, solve in solvers.items():
+            solves_per_second = measure_solves_per_second(solve, difficulty, rounds)
+            results.append(f"{name}: {solves_per_second:8.2f}/s")
+        logger.mesg(f"  * {difficulty:<9} " + " | ".join(results))
+
+
+if __name__ == "__main__":
+    benchmark_proof_worker()
+
+    # python -m tests.benchmark_proof_worker
@@ -0,0 +1,17 @@
+import base64
+import json
+
+from hashlib import sha3_512
+
+
+def solve_by_json_dumps(config: list, seed: str, difficulty: str):
+    # reference: re-encode the whole config for each nonce
+    config = list(config)
+    diff_len = len(difficulty) // 2
+    for nonce in range(100000):
+        config[3] = nonce
+        base = base64.b64encode(json.dumps(config).encode()).decode()
+        hash = sha3_512((seed + base).encode()).digest().hex()
+        if hash[:diff_len] <= difficulty:
+            return base
+    return None
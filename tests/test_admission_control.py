@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from networks.admission_control import AdmissionControl, ConcurrencyLimiter
+from networks.exceptions import HfApiException
+
+
+def test_limiter_serves_waiters_in_fifo_order():
+    async def run():
+        limiter = ConcurrencyLimiter("test", limit=1, max_queue=10)
+        order = []
+
+        async def request(i: int):
+            await limiter.acquire()
+            order.append(i)
+            await asyncio.sleep(0.01)
+            limiter.release()
+
+        await asyncio.gather(*[request(i) for i in range(5)])
+        assert order == list(range(5))
+        assert limiter.active_count == 0 and not limiter.waiters
+
+    asyncio.run(run())
+
+
+def test_limiter_rejects_when_queue_is_full_or_wait_is_too_long():
+    async def run():
+        limiter = ConcurrencyLimiter("test", limit=1, max_queue=1, max_wait=0.05)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        with pytest.raises(HfApiException) as exc_info:
+            await limiter.acquire()
+        assert exc_info.value.status_code == 429
+        assert int(exc_info.value.headers["Retry-After"]) >= 1
+
+        with pytest.raises(HfApiException):
+            await waiter
+        assert not limiter.waiters
+        limiter.release()
+        assert limiter.active_count == 0
+
+    asyncio.run(run())
+
+
+def test_admission_releases_all_limiters():
+    async def run():
+        admission_control = AdmissionControl()
+        admission_control.limits = {
+            "keys": {"default": 1},
+            "models": {"default": 2},
+            "backends": {},
+        }
+        admission = await admission_control.admit("hf_key", "test", "hf_inference")
+        assert len(admission.limiters) == 2
+
+        # same key waits, while another key passes
+        other_admission = await admission_control.admit("hf_other", "test", "hf")
+        waiting = asyncio.create_task(
+            admission_control.admit("hf_key", "test", "hf_inference")
+        )
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        admission.release()
+        admission.release()
+        other_admission.release()
+        (await waiting).release()
+        for limiter in admission_control.limiters.values():
+            assert limiter is None or limiter.active_count == 0
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_limiter_serves_waiters_in_fifo_order()
+    test_limiter_rejects_when_queue_is_full_or_wait_is_too_long()
+    test_admission_releases_all_limiters()
+
+    # python -m tests.test_admission_control
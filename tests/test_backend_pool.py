@@ -0,0 +1,72 @@
+import asyncio
+
+import httpx
+
+from mocks.tgi_server_mocker import create_tgi_mock_app
+from networks.backend_pool import Backend, BackendPool
+from networks.hedged_requester import HedgedRequester
+
+
+def test_least_loaded_prefers_low_latency_and_idle():
+    fast = Backend("fast", "http://fast/generate_stream", initial_latency=0.1)
+    slow = Backend("slow", "http://slow/generate_stream", initial_latency=1.0)
+    pool = BackendPool("model", [fast, slow], strategy="least_loaded")
+    assert pool.select() is fast
+    # fast backend is busy with many streams
+    for _ in range(10):
+        fast.acquire()
+    assert pool.select() is slow
+    assert pool.select(exclude=[slow]) is fast
+
+
+def test_failures_are_penalized():
+    backend = Backend("backend", "http://backend", initial_latency=0.1, ewma_alpha=0.5)
+    backend.acquire()
+    backend.release(latency=0.1, ok=False, penalty=10)
+    assert backend.failures_count == 1
+    assert backend.ewma_latency > 5
+    assert backend.in_flight == 0
+
+
+def test_traffic_shifts_to_fast_mock_tgi():
+    apps = {
+        "fast": create_tgi_mock_app(ttft=0.01, token_interval=0, tokens_count=2),
+        "slow": create_tgi_mock_app(ttft=0.2, token_interval=0, tokens_count=2),
+    }
+    backends = [
+        Backend(name, f"http://{name}/generate_stream", initial_latency=0.05)
+        for name in apps
+    ]
+    pool = BackendPool("model", backends, strategy="p2c")
+    requester = HedgedRequester()
+
+    async def run():
+        clients = {
+            name: httpx.AsyncClient(transport=httpx.ASGITransport(app=app))
+            for name, app in apps.items()
+        }
+        for _ in range(20):
+            backend = pool.select()
+            backend.acquire()
+            client = clients[backend.name]
+            request = client.build_request(
+                "POST", backend.get_url("model"), json={"inputs": "hi"}
+            )
+            response = await requester.send("model", client, request)
+            lines = [line async for line in response.aiter_lines() if line]
+            await response.aclose()
+            backend.release(latency=response.ttft, ok=len(lines) == 3)
+        for client in clients.values():
+            await client.aclose()
+
+    asyncio.run(run())
+    assert apps["fast"].state.requests_count > apps["slow"].state.requests_count
+    assert backends[0].failures_count == backends[1].failures_count == 0
+
+
+if __name__ == "__main__":
+    test_least_loaded_prefers_low_latency_and_idle()
+    test_failures_are_penalized()
+    test_traffic_shifts_to_fast_mock_tgi()
+
+    # python -m tests.test_backend_pool
@@ -0,0 +1,152 @@
+import asyncio
+import json
+
+import pytest
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from apis.chat_api import ChatAPIApp
+from apis.chat_items import parse_batch_line
+from constants.envs import CONFIG
+from networks.admission_control import ADMISSION_CONTROL
+from networks.completion_cache import CachedCompletion, CachedStreamer
+
+
+def create_client() -> TestClient:
+    # upstream is replaced, which echoes the last message, or fails by model
+    chat_api = ChatAPIApp()
+
+    async def create_chat_completion(item, **kwargs):
+        if item.model == "unavailable":
+            raise HTTPException(status_code=503, detail="Upstream unavailable")
+        content = item.messages[-1]["content"]
+        return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+    chat_api.create_chat_completion = create_chat_completion
+    return TestClient(chat_api.app, headers={"Authorization": "Bearer hf_test"})
+
+
+def post_batch(client: TestClient, lines: list[str]) -> dict:
+    response = client.post("/v1/batch", content="\n".join(lines) + "\n")
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+    return {result["id"]: result for result in results}
+
+
+def test_parse_batch_line():
+    messages = [{"role": "user", "content": "Hello"}]
+    line = json.dumps({"custom_id": "q1", "body": {"messages": messages}})
+    assert parse_batch_line(line, 0) == ("q1", {"messages": messages})
+    # flat request, without custom_id
+    line = json.dumps({"model": "test", "messages": messages})
+    assert parse_batch_line(line, 3) == (
+        "request-3",
+        {"model": "test", "messages": messages},
+    )
+    with pytest.raises(ValueError):
+        parse_batch_line("not json", 0)
+    with pytest.raises(ValueError):
+        parse_batch_line("[1, 2]", 0)
+
+
+def test_item_errors_do_not_abort_batch():
+    client = create_client()
+    message = {"role": "user", "content": "Hello"}
+    lines = [
+        json.dumps({"custom_id": "ok", "body": {"messages": [message]}}),
+        "not json",
+        '["not", "object"]',
+        json.dumps({"custom_id": "invalid", "body": {"messages": "Hello"}}),
+        json.dumps({"custom_id": "failed", "model": "unavailable"}),
+        json.dumps({"messages": [message]}),
+    ]
+    results = post_batch(client, lines)
+    assert len(results) == 6
+    ok_result = results["batch_req_0"]
+    assert ok_result["custom_id"] == "ok"
+    assert ok_result["response"]["status_code"] == 200
+    assert ok_result["response"]["body"]["choices"][0]["message"]["content"] == "Hello"
+    for index in [1, 2, 3]:
+        assert results[f"batch_req_{index}"]["error"]["code"] == 400
+    assert results["batch_req_4"]["custom_id"] == "failed"
+    assert results["batch_req_4"]["error"]["code"] == 503
+    assert results["batch_req_5"]["custom_id"] == "request-5"
+    assert "response" in results["batch_req_5"]
+
+
+def test_lines_are_read_without_trailing_newline():
+    client = create_client()
+    message = {"role": "user", "content": "Hello"}
+    lines = [json.dumps({"custom_id": f"q{i}", "messages": [message]}) for i in "01"]
+    response = client.post("/v1/batch", content="\r\n\n".join(lines))
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(result["custom_id"] for result in results) == ["q0", "q1"]
+    assert all("response" in result for result in results)
+
+
+def test_batch_items_skip_key_admission():
+    # more items than the key limit, and they would be rejected after `max_wait`
+    chat_api = ChatAPIApp()
+    in_flight = {"current": 0, "max": 0}
+
+    async def request_upstream(item, composer, api_key, deadline):
+        in_flight["current"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["current"])
+        await asyncio.sleep(0.2)
+        in_flight["current"] -= 1
+        content = item.messages[-1]["content"]
+        deltas = [(content, "Completions"), ("", "Finished")]
+        completion = CachedCompletion(item.model, "huggingface", deltas)
+        return CachedStreamer(completion), completion, None
+
+    chat_api.request_upstream = request_upstream
+    client = TestClient(chat_api.app, headers={"Authorization": "Bearer hf_test"})
+    lines = [
+        json.dumps(
+            {
+                "custom_id": f"q{i}",
+                "body": {
+                    "model": "mistral-7b",
+                    "messages": [{"role": "user", "content": f"Hello {i}"}],
+                    "completion_cache": False,
+                    "single_flight": False,
+                },
+            }
+        )
+        for i in range(8)
+    ]
+    limits, max_wait = ADMISSION_CONTROL.limits["keys"], ADMISSION_CONTROL.max_wait
+    ADMISSION_CONTROL.limits["keys"], ADMISSION_CONTROL.max_wait = {"default": 2}, 0.3
+    ADMISSION_CONTROL.limiters.clear()
+    try:
+        results = post_batch(client, lines)
+    finally:
+        ADMISSION_CONTROL.limits["keys"], ADMISSION_CONTROL.max_wait = limits, max_wait
+        ADMISSION_CONTROL.limiters.clear()
+    assert len(results) == 8
+    assert all("response" in result for result in results.values()), results
+    # items run by batch parallelism, rather than by the key limit
+    assert in_flight["max"] > 2
+
+
+def test_too_many_items_are_rejected():
+    client = create_client()
+    batch_configs = CONFIG["batch"]
+    max_items = batch_configs.get("max_items")
+    batch_configs["max_items"] = 2
+    try:
+        response = client.post("/v1/batch", content="{}\n{}\n{}\n")
+    finally:
+        batch_configs["max_items"] = max_items
+    assert response.status_code == 413
+
+
+if __name__ == "__main__":
+    test_parse_batch_line()
+    test_item_errors_do_not_abort_batch()
+    test_lines_are_read_without_trailing_newline()
+    test_batch_items_skip_key_admission()
+    test_too_many_items_are_rejected()
+
+    # python -m tests.test_batch_api
@@ -0,0 +1,85 @@
+import json
+import tempfile
+
+from pathlib import Path
+
+from apis.batch_runner import BatchCheckpoint, BatchRunner, get_percentile
+
+
+def test_checkpoint_resumes_and_truncates_partial_line():
+    with tempfile.TemporaryDirectory() as path:
+        output_path = Path(path) / "results.jsonl"
+        checkpoint = BatchCheckpoint(output_path, sync_interval=1)
+        checkpoint.open()
+        checkpoint.write({"custom_id": "q0", "response": {}})
+        checkpoint.write({"custom_id": "q1", "error": {"code": 500}})
+        checkpoint.close()
+        # killed run: last line is partial
+        with open(output_path, "a", encoding="utf-8") as wf:
+            wf.write('{"custom_id": "q2", "resp')
+
+        checkpoint = BatchCheckpoint(output_path)
+        checkpoint.load()
+        assert checkpoint.finished_ids == {"q0", "q1"}
+        assert output_path.read_text().endswith("}\n")
+
+        checkpoint = BatchCheckpoint(output_path, retry_errors=True)
+        checkpoint.load()
+        assert checkpoint.finished_ids == {"q0"}
+
+
+def test_retry_run_drops_superseded_error_lines():
+    with tempfile.TemporaryDirectory() as path:
+        output_path = Path(path) / "results.jsonl"
+        checkpoint = BatchCheckpoint(output_path)
+        checkpoint.open()
+        checkpoint.write({"custom_id": "q0", "response": {}})
+        checkpoint.write({"custom_id": "q1", "error": {"code": 500}})
+        checkpoint.write({"custom_id": "q2", "error": {"code": 500}})
+        checkpoint.close()
+
+        # q1 succeeds on retry, and q2 fails again
+        checkpoint = BatchCheckpoint(output_path, retry_errors=True)
+        checkpoint.load()
+        checkpoint.open()
+        checkpoint.write({"custom_id": "q1", "response": {}})
+        checkpoint.write({"custom_id": "q2", "error": {"code": 503}})
+        checkpoint.close()
+
+        results = [json.loads(line) for line in output_path.read_text().splitlines()]
+        assert [result["custom_id"] for result in results] == ["q0", "q1", "q2"]
+        assert "response" in results[1]
+        assert results[2]["error"]["code"] == 503
+
+
+def test_runner_skips_finished_items():
+    with tempfile.TemporaryDirectory() as path:
+        input_path = Path(path) / "requests.jsonl"
+        lines = [
+            json.dumps({"custom_id": "q0", "body": {"messages": []}}),
+            "",
+            json.dumps({"messages": []}),
+            "not json",
+        ]
+        input_path.write_text("\n".join(lines) + "\n")
+        runner = BatchRunner(input_path, Path(path) / "results.jsonl")
+        runner.checkpoint.finished_ids = {"q0", "request-3"}
+        assert [index for index, _ in runner.iter_items()] == [2]
+        assert runner.stats.skipped_count == 2
+
+
+def test_get_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert get_percentile(values, 50) == 50
+    assert get_percentile(values, 99) == 99
+    assert get_percentile([3.0], 90) == 3
+    assert get_percentile([], 50) == 0
+
+
+if __name__ == "__main__":
+    test_checkpoint_resumes_and_truncates_partial_line()
+    test_retry_run_drops_superseded_error_lines()
+    test_runner_skips_finished_items()
+    test_get_percentile()
+
+    # python -m tests.test_batch_runner
@@ -0,0 +1,57 @@
+import copy
+import json
+
+from pathlib import Path
+
+from constants.models import MODEL_MAP
+from messagers.message_composer import MessageComposer
+
+
+# Expected prompts are recorded from the former hand-written templates of
+# `MessageComposer.merge()`, and the former `decompose_to_system_and_input_prompt()`.
+# Former `merge()` of Yi called `tokenizer.apply_chat_template()`, which needs the
+# tokenizer from HF hub, so its expected prompts are hand-written from the
+# `chat_template` in its `tokenizer_config.json`, rather than recorded.
+# So Yi is not covered against its real template, until they are recorded.
+parity_path = Path(__file__).parent / "chat_templates_parity.json"
+HAND_WRITTEN_MODELS = ["yi-1.5-34b"]
+
+
+def load_parity():
+    with open(parity_path, "r", encoding="utf-8") as rf:
+        return json.load(rf)
+
+
+def test_chat_templates_parity():
+    parity = load_parity()
+    conversations = parity["conversations"]
+    for model in MODEL_MAP.keys():
+        for name, messages in conversations.items():
+            messages_before = copy.deepcopy(messages)
+            merged_str = MessageComposer(model=model).merge(messages)
+            expected_str = parity["expected"][model][name]
+            source = "hand-written" if model in HAND_WRITTEN_MODELS else "recorded"
+            assert merged_str == expected_str, f"[{model}] {name} ({source})"
+            assert messages == messages_before, f"[{model}] {name} mutated messages"
+
+
+def test_decompose_parity():
+    parity = load_parity()
+    for name, messages in parity["conversations"].items():
+        messages_before = copy.deepcopy(messages)
+        composer = MessageComposer(model="nous-mixtral-8x7b")
+        system_prompt, input_prompt = composer.decompose_to_system_and_input_prompt(
+            messages
+        )
+        expected = parity["decomposed"][name]
+        assert system_prompt == expected["system_prompt"], name
+        assert input_prompt == expected["input_prompt"], name
+        assert messages == messages_before, f"{name} mutated messages"
+
+
+if __name__ == "__main__":
+    test_chat_templates_parity()
+    test_decompose_parity()
+    print("All chat templates are consistent.")
+
+    # python -m tests.test_chat_templates
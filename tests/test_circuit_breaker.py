@@ -0,0 +1,86 @@
+import pytest
+
+from networks.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from networks.circuit_breaker import CircuitBreakers
+from networks.exceptions import HfApiException
+
+
+def test_breaker_trips_by_error_rate_and_recovers():
+    breaker = CircuitBreaker("test", min_requests=4, error_rate=0.5, open_duration=1)
+    now = 1000.0
+    for ok in [True, False, True, False]:
+        assert breaker.allow(now)
+        breaker.record(ok, now=now)
+    assert breaker.state == OPEN
+    assert not breaker.allow(now + 0.5)
+    assert breaker.retry_after(now + 0.5) == pytest.approx(0.5)
+
+    # only one probe passes in half-open
+    assert breaker.allow(now + 1)
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow(now + 1)
+
+    # failed probe re-opens with doubled duration
+    breaker.record(False, now=now + 1.1)
+    assert breaker.state == OPEN
+    assert not breaker.allow(now + 2.5)
+    assert breaker.allow(now + 3.2)
+    breaker.record(True, latency=0.1, now=now + 3.3)
+    assert breaker.state == CLOSED
+
+
+def test_breaker_trips_by_slow_calls():
+    breaker = CircuitBreaker("test", min_requests=3, slow_call_latency=1)
+    for _ in range(3):
+        breaker.record(True, latency=5, now=1000.0)
+    assert breaker.state == OPEN
+
+
+def test_open_breaker_fails_fast_with_retry_after():
+    breakers = CircuitBreakers()
+    breakers.enabled = True
+    breaker = breakers.get("backend:test")
+    for _ in range(breaker.min_requests):
+        breaker.record(False)
+    with pytest.raises(HfApiException) as exc_info:
+        breakers.check("model:test", "backend:test")
+    assert exc_info.value.status_code == 503
+    assert int(exc_info.value.headers["Retry-After"]) >= 1
+    assert breakers.get_status()["backend:test"]["state"] == OPEN
+
+
+def test_probes_are_taken_only_if_all_breakers_allow():
+    breakers = CircuitBreakers()
+    breakers.enabled = True
+    model_breaker = breakers.get("model:test")
+    backend_breaker = breakers.get("backend:test")
+    for breaker in [model_breaker, backend_breaker]:
+        breaker.open_duration = 0
+        for _ in range(breaker.min_requests):
+            breaker.record(False)
+    # model breaker is half-open, while backend breaker is still open
+    backend_breaker.open_duration = 60
+    with pytest.raises(HfApiException):
+        breakers.check("model:test", "backend:test")
+    assert model_breaker.is_available()
+
+    # probes of calls which fail before upstream are given back
+    probes = breakers.check("model:test")
+    assert not model_breaker.is_available()
+    breakers.release(probes)
+    assert model_breaker.is_available()
+
+    # probes with recorded outcomes are not given back
+    probes = breakers.check("model:test")
+    model_breaker.record(True, latency=0.1)
+    breakers.release(probes)
+    assert model_breaker.state == CLOSED
+
+
+if __name__ == "__main__":
+    test_breaker_trips_by_error_rate_and_recovers()
+    test_breaker_trips_by_slow_calls()
+    test_open_breaker_fails_fast_with_retry_after()
+    test_probes_are_taken_only_if_all_breakers_allow()
+
+    # python -m tests.test_circuit_breaker
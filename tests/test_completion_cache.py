@@ -0,0 +1,88 @@
+import asyncio
+
+from networks.completion_cache import CachedCompletion, CachedStreamer
+from networks.completion_cache import CompletionCache, CompletionRecorder
+from networks.completion_cache import get_completion_key
+
+
+def create_completion(content: str) -> CachedCompletion:
+    return CachedCompletion(
+        "test", "huggingface", [(content, "Completions"), ("", "Finished")]
+    )
+
+
+def test_completion_key():
+    key = get_completion_key("test", "prompt", 0, 0.95, -1)
+    assert key == get_completion_key("test", "prompt", 0, 0.95, -1)
+    assert key != get_completion_key("test", "prompt", 0.5, 0.95, -1)
+    assert key != get_completion_key("other", "prompt", 0, 0.95, -1)
+
+
+def test_cache_evicts_lru_and_expired():
+    cache = CompletionCache()
+    cache.max_entries = 2
+    cache.set("a", create_completion("A"))
+    cache.set("b", create_completion("B"))
+    assert cache.get("a") is not None
+    cache.set("c", create_completion("C"))
+    assert cache.get("b") is None
+    assert cache.get("a").get_content() == "A"
+
+    cache.ttl = 10
+    cache.entries["a"].created_at -= 11
+    assert cache.get("a") is None
+    assert cache.total_bytes == 1
+
+
+def test_cacheable_by_temperature_or_request():
+    cache = CompletionCache()
+    assert cache.is_cacheable(0)
+    assert not cache.is_cacheable(0.7)
+    assert cache.is_cacheable(0.7, completion_cache=True)
+    assert not cache.is_cacheable(0, completion_cache=False)
+
+
+def test_recorder_and_replay():
+    cache = CompletionCache()
+    recorder = CompletionRecorder(cache, "key", "test", "huggingface")
+    deltas = [("Hello", "Completions"), (" world", "Completions"), ("", "Finished")]
+    assert list(recorder.record(deltas)) == deltas
+
+    # empty completions are not cached
+    CompletionRecorder(cache, "empty", "test", "huggingface").record_dict(
+        {"choices": [{"message": {"content": ""}}]}
+    )
+    assert cache.get("empty") is None
+
+    # streams which end without finish marker of upstream are not cached
+    class Streamer:
+        is_finished = False
+
+    recorder = CompletionRecorder(
+        cache, "partial", "test", "huggingface", streamer=Streamer()
+    )
+    list(recorder.record([("Hello", "Completions"), ("", "Finished")]))
+    assert cache.get("partial") is None
+
+    completion = cache.get("key")
+    streamer = CachedStreamer(completion)
+
+    async def replay():
+        outputs = [
+            output async for output in streamer.chat_return_generator(completion)
+        ]
+        return outputs, await streamer.chat_return_dict(completion)
+
+    outputs, data = asyncio.run(replay())
+    assert len(outputs) == 3
+    assert '"content": " world"' in outputs[1]
+    assert data["choices"][0]["message"]["content"] == "Hello world"
+
+
+if __name__ == "__main__":
+    test_completion_key()
+    test_cache_evicts_lru_and_expired()
+    test_cacheable_by_temperature_or_request()
+    test_recorder_and_replay()
+
+    # python -m tests.test_completion_cache
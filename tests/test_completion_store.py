@@ -0,0 +1,178 @@
+import asyncio
+import tempfile
+import threading
+import time
+
+from networks.completion_cache import CachedCompletion, CompletionCache
+from networks.completion_cache import get_completion_key
+from networks.completion_store import CompletionStore
+
+
+def create_completion(content: str) -> dict:
+    return {
+        "model": "test",
+        "owned_by": "huggingface",
+        "deltas": [[content, "Completions"], ["", "Finished"]],
+    }
+
+
+def test_store_survives_restart():
+    with tempfile.TemporaryDirectory() as path:
+        store = CompletionStore(path=path)
+        store.start()
+        key = get_completion_key("test", "prompt", 0, 0.95, -1)
+        store.set(key, create_completion("Hello"))
+        store.stop()
+
+        # new process: loaded from index, no upstream call
+        store = CompletionStore(path=path)
+        store.start()
+        cache = CompletionCache(store=store)
+        completion = cache.get(key)
+        assert completion.get_content() == "Hello"
+        assert cache.get(get_completion_key("test", "other", 0, 0.95, -1)) is None
+        store.stop()
+
+
+def test_store_is_single_process_and_disabled_on_errors():
+    with tempfile.TemporaryDirectory() as path:
+        store = CompletionStore(path=path)
+        assert not store.is_open()
+        store.start()
+        key = get_completion_key("test", "prompt", 0, 0.95, -1)
+        store.set(key, create_completion("Hello"))
+
+        # directory is locked by the first store
+        other_store = CompletionStore(path=path)
+        other_store.start()
+        assert not other_store.enabled
+        assert other_store.get(key) is None
+        other_store.set(key, create_completion("Other"))
+        store.stop()
+
+    unwritable_store = CompletionStore(path="/proc/completion_store")
+    unwritable_store.start()
+    assert not unwritable_store.enabled
+    unwritable_store.set(key, create_completion("Hello"))
+    assert unwritable_store.get(key) is None
+
+
+def test_store_grows_index_on_writes():
+    with tempfile.TemporaryDirectory() as path:
+        store = CompletionStore(path=path)
+        store.index_slots = 16
+        store.start()
+        keys = [get_completion_key("test", str(i), 0, 0.95, -1) for i in range(20)]
+        for key in keys[:8]:
+            store.set(key, create_completion(key))
+        # compaction is woken up by writes, rather than the interval
+        for _ in range(100):
+            if store.index.slots_count > 16:
+                break
+            time.sleep(0.05)
+        assert store.index.slots_count > 16
+        for key in keys[8:]:
+            store.set(key, create_completion(key))
+        assert all(store.get(key)["deltas"][0][0] == key for key in keys)
+        store.stop()
+
+
+def test_store_compaction_keeps_latest_and_concurrent_reads():
+    with tempfile.TemporaryDirectory() as path:
+        store = CompletionStore(path=path)
+        store.start()
+        store.index_slots = 64
+        keys = [get_completion_key("test", str(i), 0, 0.95, -1) for i in range(20)]
+        for turn in range(3):
+            for i, key in enumerate(keys):
+                store.set(key, create_completion(f"{i}-{turn}"))
+        assert store.needs_compaction()
+
+        errors = []
+
+        def read():
+            for _ in range(50):
+                for i, key in enumerate(keys):
+                    completion = store.get(key)
+                    if completion and completion["deltas"][0][0] != f"{i}-2":
+                        errors.append(completion)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        size_before = store.segment_size
+        store.compact()
+        for reader in readers:
+            reader.join()
+
+        assert not errors
+        assert store.segment_size < size_before / 2
+        assert store.index.live_bytes == store.segment_size
+        assert [store.get(key)["deltas"][0][0] for key in keys] == [
+            f"{i}-2" for i in range(20)
+        ]
+
+        # size cap drops oldest completions
+        store.max_bytes = store.segment_size
+        store.set(keys[0], create_completion("newest"))
+        store.compact()
+        assert store.get(keys[0])["deltas"][0][0] == "newest"
+        assert store.index.used_count < 20
+        store.stop()
+
+
+def test_store_size_cap_is_hard():
+    with tempfile.TemporaryDirectory() as path:
+        store = CompletionStore(path=path)
+        store.max_bytes = 4096
+        store.start()
+        keys = [get_completion_key("test", str(i), 0, 0.95, -1) for i in range(200)]
+        for i, key in enumerate(keys):
+            store.set(key, create_completion(f"{i} " * 20))
+            # oldest records are dropped on the append, not on the next compaction
+            assert store.segment_size <= store.max_bytes
+            assert store.get(key)["deltas"][0][0] == f"{i} " * 20
+        assert store.get(keys[0]) is None
+        store.stop()
+
+
+def test_cache_writes_and_reads_store_off_the_event_loop():
+    with tempfile.TemporaryDirectory() as path:
+        store = CompletionStore(path=path)
+        store.start()
+        cache = CompletionCache(store=store)
+        key = get_completion_key("test", "prompt", 0, 0.95, -1)
+        deltas = [("Hello", "Completions"), ("", "Finished")]
+        # written by the writer thread, and flushed on stop
+        cache.set(key, CachedCompletion("test", "huggingface", deltas))
+        store.stop()
+
+        store = CompletionStore(path=path)
+        store.start()
+        cache = CompletionCache(store=store)
+        loop_threads = []
+
+        def load(key: str):
+            loop_threads.append(threading.current_thread())
+            return CompletionCache.load(cache, key)
+
+        cache.load = load
+
+        async def get():
+            return await cache.aget(key), threading.current_thread()
+
+        completion, thread = asyncio.run(get())
+        store.stop()
+        assert completion.get_content() == "Hello"
+        assert loop_threads and loop_threads[0] is not thread
+
+
+if __name__ == "__main__":
+    test_store_survives_restart()
+    test_store_is_single_process_and_disabled_on_errors()
+    test_store_grows_index_on_writes()
+    test_store_compaction_keeps_latest_and_concurrent_reads()
+    test_store_size_cap_is_hard()
+    test_cache_writes_and_reads_store_off_the_event_loop()
+
+    # python -m tests.test_completion_store
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from networks.exceptions import HfApiException
+from networks.fair_scheduler import BULK, INTERACTIVE, FairScheduler
+
+
+def get_scheduler(capacity: int = 1, keys: dict = None) -> FairScheduler:
+    scheduler = FairScheduler()
+    scheduler.enabled = True
+    scheduler.capacity = capacity
+    scheduler.class_weights = {INTERACTIVE: 4, BULK: 1}
+    scheduler.key_configs = keys or {}
+    return scheduler
+
+
+async def dispatch_all(scheduler: FairScheduler, requests: list[tuple]) -> list:
+    # requests: (name, api_key, priority), queued behind one busy slot
+    order = []
+    ticket = await scheduler.acquire("busy")
+
+    async def request(name: str, api_key: str, priority: str):
+        request_ticket = await scheduler.acquire(api_key, api_key, priority)
+        order.append(name)
+        await asyncio.sleep(0.001)
+        request_ticket.release()
+
+    tasks = []
+    for request_args in requests:
+        tasks.append(asyncio.create_task(request(*request_args)))
+        await asyncio.sleep(0)
+    ticket.release()
+    await asyncio.gather(*tasks)
+    assert scheduler.active_count == 0 and not scheduler.queue
+    return order
+
+
+def test_get_priority_by_header_key_and_stream():
+    scheduler = get_scheduler(keys={"hf_batch": {"priority": BULK}})
+    assert scheduler.get_priority("hf_user", stream=True) == INTERACTIVE
+    assert scheduler.get_priority("hf_user", stream=False) == BULK
+    assert scheduler.get_priority("hf_batch", stream=True) == BULK
+    assert scheduler.get_priority("hf_batch", True, priority=INTERACTIVE) == INTERACTIVE
+    assert scheduler.get_priority("hf_user", True, priority="unknown") == INTERACTIVE
+
+
+def test_interactive_request_overtakes_bulk_backlog():
+    async def run():
+        scheduler = get_scheduler()
+        requests = [(f"bulk{i}", "hf_batch", BULK) for i in range(6)]
+        requests.append(("interactive", "hf_user", INTERACTIVE))
+        order = await dispatch_all(scheduler, requests)
+        assert order[0] == "interactive"
+        assert order[1:] == [f"bulk{i}" for i in range(6)]
+
+    asyncio.run(run())
+
+
+def test_keys_share_capacity_by_weight():
+    async def run():
+        scheduler = get_scheduler(keys={"hf_heavy": {"weight": 2}})
+        requests = [(f"heavy{i}", "hf_heavy", BULK) for i in range(8)]
+        requests += [(f"light{i}", "hf_light", BULK) for i in range(8)]
+        order = await dispatch_all(scheduler, requests)
+        # light key is not starved by the earlier backlog of heavy key
+        first_dispatches = order[:6]
+        assert sum(name.startswith("heavy") for name in first_dispatches) == 4
+        assert sum(name.startswith("light") for name in first_dispatches) == 2
+
+    asyncio.run(run())
+
+
+def test_scheduler_rejects_after_max_wait():
+    async def run():
+        scheduler = get_scheduler()
+        ticket = await scheduler.acquire("hf_key")
+        with pytest.raises(HfApiException) as exc_info:
+            await scheduler.acquire("hf_key", timeout=0.02)
+        assert exc_info.value.status_code == 429
+        assert int(exc_info.value.headers["Retry-After"]) >= 1
+        ticket.release()
+        ticket.release()
+        assert scheduler.active_count == 0
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_get_priority_by_header_key_and_stream()
+    test_interactive_request_overtakes_bulk_backlog()
+    test_keys_share_capacity_by_weight()
+    test_scheduler_rejects_after_max_wait()
+
+    # python -m tests.test_fair_scheduler
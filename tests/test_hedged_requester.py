@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import httpx
+
+from networks.hedged_requester import HedgedRequester, TTFTTracker
+
+
+class DelayedStream(httpx.AsyncByteStream):
+    def __init__(self, delay: float, text: str, closed: list):
+        self.delay = delay
+        self.text = text
+        self.closed = closed
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.delay)
+        yield ("data:" + json.dumps({"token": {"text": self.text}}) + "\n\n").encode()
+
+    async def aclose(self):
+        self.closed.append(self.text)
+
+
+def test_hedge_wins_when_primary_is_slow():
+    closed = []
+
+    def handler(request: httpx.Request):
+        if request.url.host == "primary":
+            return httpx.Response(200, stream=DelayedStream(1, "primary", closed))
+        return httpx.Response(200, stream=DelayedStream(0, "hedge", closed))
+
+    async def send():
+        requester = HedgedRequester()
+        requester.delay = 0.1
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            response = await requester.send(
+                "model",
+                client,
+                client.build_request("POST", "http://primary"),
+                hedge_request=client.build_request("POST", "http://hedge"),
+            )
+            lines = [line async for line in response.aiter_lines() if line]
+            await response.aclose()
+        return lines, requester
+
+    lines, requester = asyncio.run(send())
+    assert lines == ['data:{"token": {"text": "hedge"}}']
+    assert "primary" in closed
+    assert requester.stats["model"] == {"requests": 1, "hedges": 1}
+
+
+def test_ttft_quantile():
+    tracker = TTFTTracker(window=10)
+    for i in range(20):
+        tracker.observe("model", i / 10)
+    assert tracker.count("model") == 10
+    assert tracker.quantile("model", 0.9) == 1.9
+    assert tracker.quantile("unknown") is None
+
+
+if __name__ == "__main__":
+    test_hedge_wins_when_primary_is_slow()
+    test_ttft_quantile()
+
+    # python -m tests.test_hedged_requester
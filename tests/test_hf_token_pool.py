@@ -0,0 +1,95 @@
+import time
+
+from networks.backend_pool import Backend
+from networks.hf_token_pool import HfToken, HfTokenPool, parse_rate_limit_headers
+from networks.huggingface_streamer import AsyncHuggingfaceStreamer
+
+
+def get_pool(tokens: list[str]) -> HfTokenPool:
+    pool = HfTokenPool(tokens=tokens)
+    pool.enabled = True
+    pool.cooldown = 60
+    pool.max_cooldown = 600
+    return pool
+
+
+def test_parse_rate_limit_headers():
+    state = parse_rate_limit_headers(
+        {"x-ratelimit-limit": "100", "x-ratelimit-remaining": "7", "retry-after": "3"}
+    )
+    assert state == {"limit": 100, "remaining": 7, "retry_after": 3}
+    state = parse_rate_limit_headers({"ratelimit": '"api";r=12;t=30'})
+    assert state == {"remaining": 12, "reset": 30}
+    reset_at = time.time() + 10
+    state = parse_rate_limit_headers({"x-ratelimit-reset": str(reset_at)})
+    assert 9 < state["reset"] <= 10
+    assert parse_rate_limit_headers(None) == {}
+
+
+def test_select_token_with_most_headroom():
+    pool = get_pool(["hf_aaaa1111", "hf_bbbb2222", "hf_aaaa1111"])
+    assert len(pool.tokens) == 2
+    token_a, token_b = pool.tokens
+    pool.record(token_a, 200, {"x-ratelimit-remaining": "5", "x-ratelimit-reset": "60"})
+    assert pool.select() is token_b
+    pool.record(token_b, 200, {"x-ratelimit-remaining": "3", "x-ratelimit-reset": "60"})
+    assert pool.select() is token_a
+    # requests in flight also take headroom
+    for _ in range(3):
+        pool.acquire(token_a)
+    assert pool.select() is token_b
+    for _ in range(3):
+        pool.release(token_a)
+    assert [status["requests"] for status in pool.get_status()] == [3, 0]
+
+
+def test_rate_limited_token_cools_down():
+    pool = get_pool(["hf_aaaa1111", "hf_bbbb2222"])
+    token_a, token_b = pool.tokens
+    pool.record(token_a, 429, {"retry-after": "30"})
+    assert token_a.is_cooling()
+    assert pool.select() is token_b
+
+    pool.record(token_b, 429)
+    assert 59 < token_b.cooldown_until - time.monotonic() <= 60
+    assert pool.select() is None
+    # consecutive 429s double the cooldown
+    token_b.cooldown_until = 0
+    pool.record(token_b, 429)
+    assert 119 < token_b.cooldown_until - time.monotonic() <= 120
+
+    token_a.cooldown_until = 0
+    pool.record(token_a, 200)
+    assert pool.select() is token_a
+    assert [status["rate_limited"] for status in pool.get_status()] == [1, 2]
+
+
+def test_empty_pool_gives_no_token():
+    pool = get_pool([])
+    assert pool.select() is None
+    assert pool.get_status() == []
+
+
+def test_hedge_switch_moves_backend_but_not_token():
+    primary = Backend("primary", "http://primary/generate_stream")
+    hedge = Backend("hedge", "http://hedge/generate_stream")
+    streamer = AsyncHuggingfaceStreamer(model="mixtral-8x7b")
+    streamer.hf_token = HfToken("hf_aaaa1111")
+    streamer.backend = primary
+    streamer.acquire_backend()
+    streamer.hedge_backend = hedge
+    streamer.switch_to_hedge_backend(0.5)
+    assert (primary.in_flight, hedge.in_flight) == (0, 1)
+    assert (streamer.hf_token.in_flight, streamer.hf_token.requests_count) == (1, 1)
+    streamer.release_backend()
+    assert hedge.in_flight == 0 and streamer.hf_token.in_flight == 0
+
+
+if __name__ == "__main__":
+    test_parse_rate_limit_headers()
+    test_select_token_with_most_headroom()
+    test_rate_limited_token_cools_down()
+    test_empty_pool_gives_no_token()
+    test_hedge_switch_moves_backend_but_not_token()
+
+    # python -m tests.test_hf_token_pool
@@ -0,0 +1,55 @@
+import threading
+import time
+
+from networks.huggingchat_session_pool import HuggingchatSession
+from networks.huggingchat_session_pool import HuggingchatSessionPool
+
+
+def test_refills_of_stopped_pool_keep_counts():
+    pool = HuggingchatSessionPool(size=1, refill_interval=60)
+    pool.enabled = True
+    created, released, errors = threading.Event(), threading.Event(), []
+
+    def create_session(model: str, system_prompt: str):
+        created.set()
+        released.wait(5)
+        return HuggingchatSession("hf_chat", "conversation", "message")
+
+    def refill_one(*args):
+        try:
+            HuggingchatSessionPool.refill_one(pool, *args)
+        except Exception as e:
+            errors.append(e)
+
+    pool.create_session = create_session
+    pool.refill_one = refill_one
+    pool.start()
+    pool.checkout("model")
+    pool.refill()
+    assert created.wait(5)
+
+    # refill is still running when the pool is restarted
+    pool.stop()
+    pool.start()
+    key = pool.get_key("model", "")
+    pool.refill()
+    assert pool.refilling_counts[key] == 1
+    released.set()
+    for _ in range(100):
+        if len(pool.sessions.get(key, [])) == 2:
+            break
+        time.sleep(0.05)
+    time.sleep(0.1)
+    # refill of the stopped pool does not decrement counts of the restarted one
+    refilling_count = pool.refilling_counts.get(key)
+    pool.stop()
+
+    assert not errors
+    assert len(pool.sessions[key]) == 2
+    assert refilling_count == 0
+
+
+if __name__ == "__main__":
+    test_refills_of_stopped_pool_keep_counts()
+
+    # python -m tests.test_huggingchat_session_pool
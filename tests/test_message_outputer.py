@@ -0,0 +1,21 @@
+import json
+
+from messagers.message_outputer import OpenaiStreamOutputer
+
+
+def test_output_is_identical_to_json_dumps():
+    contents = ["", "Hello", ' "quoted" \\ \n\t\x00', "你好，世界 🌍", "\ud800", None]
+    content_types = ["Role", "Completions", "Finished", "SuggestedResponses", "Other"]
+    for owned_by, model in [("huggingface", "nous-mixtral-8x7b"), ("openai", "gpt")]:
+        outputer = OpenaiStreamOutputer(owned_by=owned_by, model=model)
+        for content_type in content_types:
+            for content in contents:
+                expected_str = json.dumps(outputer.build_data(content, content_type))
+                assert outputer.output(content, content_type) == expected_str
+
+
+if __name__ == "__main__":
+    test_output_is_identical_to_json_dumps()
+    print("All outputs are identical.")
+
+    # python -m tests.test_message_outputer
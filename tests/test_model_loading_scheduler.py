@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from networks.exceptions import ModelLoadingException
+from networks.model_loading_scheduler import ModelLoadingScheduler
+from networks.model_loading_scheduler import parse_loading_error
+from networks.request_deadline import RequestDeadline
+
+
+class LoadingUpstream:
+    # answers "loading" until `loading_sends` sends have been made
+    def __init__(self, loading_sends: int = 1):
+        self.loading_sends = loading_sends
+        self.sends_count = 0
+
+    async def send(self):
+        self.sends_count += 1
+        await asyncio.sleep(0.01)
+        if self.sends_count <= self.loading_sends:
+            raise ModelLoadingException("test", estimated_time=0.05)
+        return "stream"
+
+
+def create_scheduler() -> ModelLoadingScheduler:
+    scheduler = ModelLoadingScheduler()
+    scheduler.min_backoff = 0.05
+    scheduler.max_backoff = 0.1
+    scheduler.jitter = 0
+    return scheduler
+
+
+def test_parse_loading_error():
+    content = b'{"error":"Model x is currently loading","estimated_time":20.5}'
+    assert parse_loading_error(content) == (True, 20.5)
+    assert parse_loading_error(b'{"error":"Model x is currently loading"}') == (
+        True,
+        None,
+    )
+    assert parse_loading_error(b'{"error":"Service Unavailable"}') == (False, None)
+    assert parse_loading_error(b"<html>") == (False, None)
+
+
+def test_waiters_share_one_probe():
+    scheduler = create_scheduler()
+    upstream = LoadingUpstream(loading_sends=2)
+
+    async def wait_all():
+        return await asyncio.gather(
+            *[
+                scheduler.retry("test", upstream.send, RequestDeadline(5), 0.05)
+                for _ in range(5)
+            ]
+        )
+
+    results = asyncio.run(wait_all())
+    assert results == ["stream"] * 5
+    # 2 loading probes, then 1 successful probe, and 4 waiters resend once each
+    assert upstream.sends_count == 2 + 1 + 4
+
+
+def test_give_up_before_deadline():
+    scheduler = create_scheduler()
+    scheduler.min_backoff = scheduler.max_backoff = 1
+    upstream = LoadingUpstream(loading_sends=100)
+    with pytest.raises(ModelLoadingException) as exc_info:
+        asyncio.run(scheduler.retry("test", upstream.send, RequestDeadline(0.5), 1))
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers["Retry-After"] == "1"
+    assert upstream.sends_count == 0
+
+
+def test_probe_is_started_once_for_all_waiters():
+    scheduler = create_scheduler()
+    upstream = LoadingUpstream(loading_sends=3)
+
+    async def wait_all():
+        waiters = [
+            scheduler.retry("test", upstream.send, RequestDeadline(5), 0.05)
+            for _ in range(5)
+        ]
+        return await asyncio.gather(*waiters)
+
+    results = asyncio.run(wait_all())
+    assert results == ["stream"] * 5
+    # probes are not sent by each waiter in turn, but once per round for all
+    assert upstream.sends_count == 3 + 1 + 4
+
+
+def test_expired_and_cancelled_waiters_do_not_block_others():
+    scheduler = create_scheduler()
+    upstream = LoadingUpstream(loading_sends=1)
+
+    async def wait_all():
+        # owner of the first probe is cancelled, and another waiter expires
+        owner = asyncio.create_task(
+            scheduler.retry("test", upstream.send, RequestDeadline(5), 0.05)
+        )
+        await asyncio.sleep(0)
+        short = asyncio.create_task(
+            scheduler.retry("test", upstream.send, RequestDeadline(0.02), 0.05)
+        )
+        others = [
+            asyncio.create_task(
+                scheduler.retry("test", upstream.send, RequestDeadline(5), 0.05)
+            )
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        with pytest.raises(ModelLoadingException):
+            await short
+        return await asyncio.wait_for(asyncio.gather(*others), timeout=2)
+
+    results = asyncio.run(wait_all())
+    assert results == ["stream"] * 3
+    state = scheduler.get_state("test")
+    assert state.probe_task.done()
+
+
+if __name__ == "__main__":
+    test_parse_loading_error()
+    test_waiters_share_one_probe()
+    test_give_up_before_deadline()
+    test_probe_is_started_once_for_all_waiters()
+    test_expired_and_cancelled_waiters_do_not_block_others()
+
+    # python -m tests.test_model_loading_scheduler
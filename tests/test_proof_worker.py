@@ -0,0 +1,52 @@
+import base64
+import json
+import time
+
+from networks import proof_worker
+from networks.proof_worker import ProofSolver, ProofWorker, solve_proof_range
+from tests.proof_references import solve_by_json_dumps
+
+
+def test_proof_solver_parity():
+    worker = ProofWorker()
+    seed = "0.42665582693491433"
+    for padding in range(3):
+        config = worker.get_config()
+        config[1] += " " * padding  # shift nonce across base64 alignments
+        for difficulty in ["0fffff", "05cdf2", "003a9c", "1f", "0", "FFF"]:
+            assert ProofSolver(config, seed, difficulty).solve_range(
+                0, 100000
+            ) == solve_by_json_dumps(config, seed, difficulty)
+
+
+def test_proof_worker_in_processes():
+    worker = ProofWorker()
+    worker.inline_attempts, worker.chunk_size, worker.processes = 0, 2000, 2
+    seed, difficulty = "0.42665582693491433", "003a9c"
+    config = worker.get_config()
+    base = worker.solve_in_processes(config, seed, difficulty)
+    nonce = json.loads(base64.b64decode(base))[3]
+    assert ProofSolver(config, seed, difficulty).solve_range(nonce, nonce + 1) == base
+
+
+def test_running_chunks_stop_by_flag():
+    seed, difficulty = "0.42665582693491433", "00000000"
+    config = ProofWorker().get_config()
+    stop_flags = [0, 1]
+    proof_worker.init_proof_process(stop_flags)
+    try:
+        start_time = time.perf_counter()
+        # flag of slot 1 is set, so the chunk returns at the first poll
+        assert solve_proof_range(config, seed, difficulty, 0, 10**7, slot=1) is None
+        assert time.perf_counter() - start_time < 1
+        assert solve_proof_range(config, seed, "FFF", 0, 100, slot=0) is not None
+    finally:
+        proof_worker.init_proof_process(None)
+
+
+if __name__ == "__main__":
+    test_proof_solver_parity()
+    test_proof_worker_in_processes()
+    test_running_chunks_stop_by_flag()
+
+    # python -m tests.test_proof_worker
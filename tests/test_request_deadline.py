@@ -0,0 +1,40 @@
+import time
+
+import pytest
+
+from networks.exceptions import HfApiException
+from networks.request_deadline import RequestDeadline
+
+
+def test_deadline_bounds_timeouts():
+    deadline = RequestDeadline(timeout=0.5)
+    assert deadline.get_timeout(10) <= 0.5
+    assert deadline.get_timeout(0.1) == 0.1
+    connect_timeout, read_timeout = deadline.get_stream_timeout()
+    assert connect_timeout <= 0.5 and read_timeout <= 0.5
+
+    time.sleep(0.5)
+    assert deadline.is_stream_expired()
+    with pytest.raises(HfApiException) as exc_info:
+        deadline.get_timeout(10)
+    assert exc_info.value.status_code == 504
+
+
+def test_deadline_without_timeout():
+    deadline = RequestDeadline()
+    assert deadline.get_timeout(10) == 10
+    assert not deadline.is_expired()
+
+
+def test_deadline_from_request_is_capped():
+    deadline = RequestDeadline.from_request(1e9)
+    assert deadline.timeout <= 600
+    assert RequestDeadline.from_request(None).timeout > 0
+
+
+if __name__ == "__main__":
+    test_deadline_bounds_timeouts()
+    test_deadline_without_timeout()
+    test_deadline_from_request_is_capped()
+
+    # python -m tests.test_request_deadline
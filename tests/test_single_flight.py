@@ -0,0 +1,155 @@
+import asyncio
+
+from apis.chat_api import ChatAPIApp
+from apis.chat_items import ChatCompletionsPostItem
+from messagers.message_outputer import OpenaiStreamOutputer
+from networks.admission_control import ADMISSION_CONTROL
+from networks.request_deadline import RequestDeadline
+from networks.single_flight import FlightStreamer, SingleFlight
+
+
+class MockStreamer:
+    def __init__(self, contents: list[str], interval: float = 0.05):
+        self.model = "test"
+        self.message_outputer = OpenaiStreamOutputer(model="test")
+        self.contents = contents
+        self.interval = interval
+        self.closed = False
+
+    async def chat_return_deltas(self, stream_response=None):
+        for content in self.contents:
+            await asyncio.sleep(self.interval)
+            yield content, "Completions"
+        yield "", "Finished"
+
+    def close_response(self, stream_response=None):
+        self.closed = True
+
+
+def test_single_flight_enabled_by_temperature():
+    single_flight = SingleFlight()
+    assert single_flight.is_enabled(temperature=0)
+    assert not single_flight.is_enabled(temperature=0.7)
+    assert single_flight.is_enabled(temperature=0.7, single_flight=True)
+    assert not single_flight.is_enabled(temperature=0, single_flight=False)
+    # requests could not opt in, when disabled by config
+    single_flight.enabled = False
+    assert not single_flight.is_enabled(temperature=0)
+    assert not single_flight.is_enabled(temperature=0.7, single_flight=True)
+
+
+def test_followers_get_buffered_and_live_deltas():
+    async def run():
+        single_flight = SingleFlight()
+        streamer = MockStreamer(["a", "b", "c", "d"])
+        flight, is_leader = single_flight.join("key", "test")
+        assert is_leader
+        single_flight.start(flight, streamer, None, streamer.chat_return_deltas())
+        leader = FlightStreamer(flight)
+
+        async def follow(delay: float):
+            await asyncio.sleep(delay)
+            follower_flight, is_leader = single_flight.join("key", "test")
+            assert follower_flight is flight and not is_leader
+            follower = FlightStreamer(follower_flight)
+            await follower_flight.wait_started()
+            return await follower.chat_return_dict(follower_flight)
+
+        results = await asyncio.gather(
+            leader.chat_return_dict(flight), follow(0.01), follow(0.12)
+        )
+        contents = [result["choices"][0]["message"]["content"] for result in results]
+        assert contents == ["abcd"] * 3
+        assert streamer.closed
+        await asyncio.sleep(0)
+        # finished flight is not joined by new requests
+        assert single_flight.join("key", "test")[1]
+
+    asyncio.run(run())
+
+
+def test_upstream_is_cancelled_when_all_readers_leave():
+    async def run():
+        single_flight = SingleFlight()
+        streamer = MockStreamer(["a"] * 100, interval=0.01)
+        flight, _ = single_flight.join("key", "test")
+        single_flight.start(flight, streamer, None, streamer.chat_return_deltas())
+        readers = [FlightStreamer(flight) for _ in range(2)]
+        await flight.wait_started()
+        readers[0].close_response(flight)
+        assert not flight.task.done()
+        readers[1].close_response(flight)
+        await asyncio.sleep(0.05)
+        assert flight.task.done() and streamer.closed
+        assert len(flight.deltas) < 100
+
+    asyncio.run(run())
+
+
+def test_readers_stop_at_own_deadlines():
+    async def run():
+        single_flight = SingleFlight()
+        streamer = MockStreamer(["a", "b", "c", "d"], interval=0.05)
+        flight, _ = single_flight.join("key", "test")
+        single_flight.start(flight, streamer, None, streamer.chat_return_deltas())
+        leader = FlightStreamer(flight, deadline=RequestDeadline(timeout=0.12))
+        follower = FlightStreamer(flight, deadline=RequestDeadline(timeout=5))
+
+        async def read(reader):
+            return [delta async for delta in reader.chat_return_deltas(flight)]
+
+        leader_deltas, follower_deltas = await asyncio.gather(
+            read(leader), read(follower)
+        )
+        # leader is cut by its deadline, while the shared stream goes on
+        assert leader_deltas[-1] == ("", "Finished")
+        assert len(leader_deltas) < 5
+        assert "".join(content for content, _ in follower_deltas) == "abcd"
+
+    asyncio.run(run())
+
+
+def test_flight_holds_admission_after_leader_leaves():
+    chat_api = ChatAPIApp()
+
+    async def request_upstream(item, composer, api_key, deadline):
+        streamer = MockStreamer(["a", "b", "c", "d"])
+        streamer.deadline = deadline
+        return streamer, "stream", None
+
+    chat_api.request_upstream = request_upstream
+
+    async def run():
+        item = ChatCompletionsPostItem(
+            model="mistral-7b",
+            messages=[{"role": "user", "content": "Hello flight"}],
+            stream=True,
+            temperature=0,
+            single_flight=True,
+            completion_cache=False,
+        )
+        leader = (await chat_api.create_chat_completion(item)).body_iterator
+        follower = (await chat_api.create_chat_completion(item)).body_iterator
+        limiter = ADMISSION_CONTROL.get_limiter("backends", "hf_inference")
+        await anext(leader)
+        # client of leader disconnects, while follower still reads upstream
+        await leader.aclose()
+        active_count_after_leader = limiter.active_count
+        outputs = [output async for output in follower]
+        await asyncio.sleep(0.05)
+        return active_count_after_leader, outputs, limiter.active_count
+
+    active_count_after_leader, outputs, active_count = asyncio.run(run())
+    assert active_count_after_leader == 1
+    assert len(outputs) > 1
+    assert active_count == 0
+
+
+if __name__ == "__main__":
+    test_single_flight_enabled_by_temperature()
+    test_followers_get_buffered_and_live_deltas()
+    test_upstream_is_cancelled_when_all_readers_leave()
+    test_readers_stop_at_own_deadlines()
+    test_flight_holds_admission_after_leader_leaves()
+
+    # python -m tests.test_single_flight
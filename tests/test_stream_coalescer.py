@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from messagers.stream_coalescer import StreamCoalescer
+
+
+def test_coalesce_by_bytes():
+    coalescer = StreamCoalescer(max_bytes=6)
+    deltas = [("Hello", "Completions")]
+    deltas += [(f" w{i}", "Completions") for i in range(5)]
+    deltas += [("", "Finished")]
+    outputs = list(coalescer.coalesce(deltas))
+    # first token is never held back, and the final chunk flushes the buffer
+    assert outputs == [
+        ("Hello", "Completions"),
+        (" w0 w1", "Completions"),
+        (" w2 w3", "Completions"),
+        (" w4", "Completions"),
+        ("", "Finished"),
+    ]
+
+
+def test_coalesce_flushes_when_upstream_stalls():
+    async def deltas():
+        for content in ["Hello", " w0", " w1"]:
+            yield content, "Completions"
+        # stalled upstream
+        await asyncio.sleep(0.5)
+        yield " w2", "Completions"
+        yield "", "Finished"
+
+    async def run():
+        coalescer = StreamCoalescer(max_delay_ms=50)
+        start_time = time.monotonic()
+        return [
+            (delta, time.monotonic() - start_time)
+            async for delta in coalescer.acoalesce(deltas())
+        ]
+
+    outputs = asyncio.run(run())
+    assert [delta for delta, _ in outputs] == [
+        ("Hello", "Completions"),
+        (" w0 w1", "Completions"),
+        (" w2", "Completions"),
+        ("", "Finished"),
+    ]
+    # buffered deltas are not held until the next delta arrives
+    assert outputs[1][1] < 0.3
+
+
+def test_coalescer_disabled():
+    assert not StreamCoalescer().is_enabled()
+    assert StreamCoalescer(max_delay_ms=50).is_enabled()
+
+
+if __name__ == "__main__":
+    test_coalesce_by_bytes()
+    test_coalesce_flushes_when_upstream_stalls()
+    test_coalescer_disabled()
+
+    # python -m tests.test_stream_coalescer
@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+import pytest
+
+from apis import chat_api
+from apis.chat_api import ChatAPIApp
+from apis.chat_items import ChatCompletionsPostItem
+from networks.exceptions import HfApiException
+from networks.token_rate_limiter import TokenBucket, TokenRateLimiter
+
+
+def get_limiter(keys: dict = None, models: dict = None) -> TokenRateLimiter:
+    limiter = TokenRateLimiter()
+    limiter.enabled = True
+    limiter.limits = {"keys": keys or {}, "models": models or {}}
+    return limiter
+
+
+def get_remaining(limiter: TokenRateLimiter, api_key: str) -> int:
+    headers = limiter.get_headers(api_key, "test")
+    return int(headers["x-ratelimit-remaining-tokens"])
+
+
+def test_bucket_refills_by_tokens_per_minute():
+    bucket = TokenBucket("test", tokens_per_minute=600)
+    bucket.consume(600)
+    assert bucket.get_wait_time(10) == pytest.approx(1, abs=0.05)
+    bucket.updated_at -= 1
+    assert bucket.get_remaining() == pytest.approx(10, abs=1)
+    # requests larger than the bucket still pass once it is full
+    bucket.updated_at -= 60
+    assert bucket.get_wait_time(1000) == 0
+
+
+def test_reserve_prompt_tokens_and_reject_with_headers():
+    limiter = get_limiter(keys={"default": 1000}, models={"test": 5000})
+    reservation = limiter.reserve("hf_key", "test", prompt_tokens=800)
+    assert len(reservation.buckets) == 2
+    headers = limiter.get_headers("hf_key", "test")
+    assert headers["x-ratelimit-limit-tokens"] == "1000"
+    assert get_remaining(limiter, "hf_key") == pytest.approx(200, abs=2)
+
+    with pytest.raises(HfApiException) as exc_info:
+        limiter.reserve("hf_key", "test", prompt_tokens=400)
+    assert exc_info.value.status_code == 429
+    assert int(exc_info.value.headers["Retry-After"]) >= 1
+    assert "x-ratelimit-reset-tokens" in exc_info.value.headers
+    # rejected request reserves nothing, and other keys are not limited by it
+    assert get_remaining(limiter, "hf_key") == pytest.approx(200, abs=2)
+    limiter.reserve("hf_other", "test", prompt_tokens=400)
+    assert limiter.get_headers("hf_other", "test")["x-ratelimit-limit-tokens"] == "1000"
+
+
+def test_completion_tokens_are_settled_when_stream_ends():
+    async def run():
+        limiter = get_limiter(keys={"default": 1000})
+        reservation = limiter.reserve("hf_key", "test", prompt_tokens=100)
+        reservation.count_tokens = lambda content: len(content.split())
+
+        async def deltas():
+            for content in ["one ", "two ", "three"]:
+                yield content, "Completions"
+            yield "", "Finished"
+
+        contents = [content async for content, _ in reservation.ameter(deltas())]
+        assert "".join(contents) == "one two three"
+        assert reservation.completion_tokens == 3
+        reservation.settle(100)
+        assert get_remaining(limiter, "hf_key") == pytest.approx(897, abs=2)
+
+    asyncio.run(run())
+
+
+def test_prompt_tokens_are_refunded_when_cancelled():
+    limiter = get_limiter(keys={"default": 1000})
+    reservation = limiter.reserve("hf_key", "test", prompt_tokens=800)
+    assert get_remaining(limiter, "hf_key") == pytest.approx(200, abs=2)
+    reservation.cancel()
+    assert get_remaining(limiter, "hf_key") == 1000
+    # cancelled reservation is not settled again
+    reservation.settle(100)
+    assert get_remaining(limiter, "hf_key") == 1000
+
+
+def test_unlimited_when_no_limits():
+    limiter = get_limiter(keys={"default": 0})
+    assert not limiter.is_limited("hf_key", "test")
+    assert limiter.get_headers("hf_key", "test") == {}
+    reservation = limiter.reserve("hf_key", "test", prompt_tokens=10**9)
+    reservation.settle(10**9)
+
+
+def test_prompt_tokens_are_counted_off_the_event_loop():
+    class SlowTokenChecker:
+        # tokenizer of a cold model is loaded when the checker is created
+        def __init__(self, model: str = None, messages=None):
+            time.sleep(0.5)
+
+        def count_tokens(self):
+            return 10
+
+    async def tick(ticks: list):
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.05)
+
+    async def run():
+        ticks = []
+        ticker = asyncio.create_task(tick(ticks))
+        item = ChatCompletionsPostItem(
+            model="mistral-7b", messages=[{"role": "user", "content": "Hello"}]
+        )
+        reservation = await ChatAPIApp().reserve_tokens("hf_key", item)
+        ticker.cancel()
+        return reservation, ticks
+
+    limiter, token_checker = chat_api.TOKEN_RATE_LIMITER, chat_api.TokenChecker
+    chat_api.TOKEN_RATE_LIMITER = get_limiter(keys={"default": 1000})
+    chat_api.TokenChecker = SlowTokenChecker
+    try:
+        reservation, ticks = asyncio.run(run())
+    finally:
+        chat_api.TOKEN_RATE_LIMITER, chat_api.TokenChecker = limiter, token_checker
+    assert reservation.prompt_tokens == 10
+    # other tasks are still served while the tokenizer is loading
+    assert len(ticks) >= 5
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.3
+
+
+if __name__ == "__main__":
+    test_bucket_refills_by_tokens_per_minute()
+    test_reserve_prompt_tokens_and_reject_with_headers()
+    test_completion_tokens_are_settled_when_stream_ends()
+    test_prompt_tokens_are_refunded_when_cancelled()
+    test_unlimited_when_no_limits()
+    test_prompt_tokens_are_counted_off_the_event_loop()
+
+    # python -m tests.test_token_rate_limiter
@@ -0,0 +1,133 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+from messagers import tokenizer_registry
+from messagers.tokenizer_registry import TokenizerRegistry
+
+
+class StubTokenizer:
+    # size is estimated by `len(tokenizer) * 128`, as it has no backend tokenizer
+    def __init__(self, repo_id: str, use_fast: bool, vocab_size: int):
+        self.repo_id = repo_id
+        self.use_fast = use_fast
+        self.vocab_size = vocab_size
+
+    def __len__(self):
+        return self.vocab_size
+
+
+@contextmanager
+def stub_loader(vocab_size: int = 8192, delay: float = 0):
+    # replace HF hub loading with stub tokenizers, and record loaded repo ids
+    loads = []
+
+    class StubAutoTokenizer:
+        @staticmethod
+        def from_pretrained(repo_id: str, use_fast: bool = True):
+            loads.append((repo_id, use_fast))
+            time.sleep(delay)
+            return StubTokenizer(repo_id, use_fast, vocab_size)
+
+    auto_tokenizer = tokenizer_registry.AutoTokenizer
+    tokenizer_registry.AutoTokenizer = StubAutoTokenizer
+    try:
+        yield loads
+    finally:
+        tokenizer_registry.AutoTokenizer = auto_tokenizer
+
+
+def test_registry_shares_tokenizers():
+    registry = TokenizerRegistry(memory_budget_mb=0)
+    with stub_loader() as loads:
+        tokenizer = registry.get("mistral-7b")
+        assert registry.get("mistral-7b") is tokenizer
+        # models with the same repo id share the tokenizer
+        repo_id = registry.get_repo_id("mistral-7b")
+        assert registry.get("any-model", repo_id=repo_id) is tokenizer
+        # slow tokenizers are kept apart from fast ones
+        assert registry.get("mistral-7b", use_fast=False) is not tokenizer
+    assert loads == [(repo_id, True), (repo_id, False)]
+    assert registry.memory_usage == 2 * 8192 * 128
+
+
+def test_registry_loads_once_for_concurrent_gets():
+    registry = TokenizerRegistry(memory_budget_mb=0)
+    with stub_loader(delay=0.2) as loads:
+        tokenizers = []
+        threads = [
+            threading.Thread(
+                target=lambda: tokenizers.append(registry.get("mistral-7b"))
+            )
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert len(loads) == 1
+    assert len(tokenizers) == 8
+    assert all(tokenizer is tokenizers[0] for tokenizer in tokenizers)
+    assert registry.loading_locks == {}
+
+
+def test_registry_evicts_least_recently_used():
+    # each stub tokenizer is 1 MB, and 2 of them fit in the budget
+    registry = TokenizerRegistry(memory_budget_mb=2.5)
+    with stub_loader(vocab_size=8192) as loads:
+        a = registry.get("a", repo_id="repo/a")
+        registry.get("b", repo_id="repo/b")
+        # touch `a`, so that `b` is the least recently used
+        assert registry.get("a", repo_id="repo/a") is a
+        registry.get("c", repo_id="repo/c")
+        assert [key[0] for key in registry.tokenizers] == ["repo/a", "repo/c"]
+        assert registry.memory_usage == 2 * 1024 * 1024
+        # evicted tokenizer is loaded again
+        registry.get("b", repo_id="repo/b")
+    assert [repo_id for repo_id, _ in loads] == ["repo/a", "repo/b", "repo/c", "repo/b"]
+    assert [key[0] for key in registry.tokenizers] == ["repo/c", "repo/b"]
+
+
+def test_registry_keeps_last_tokenizer_over_budget():
+    registry = TokenizerRegistry(memory_budget_mb=0.5)
+    with stub_loader(vocab_size=8192):
+        registry.get("a", repo_id="repo/a")
+        tokenizer = registry.get("b", repo_id="repo/b")
+    # the only tokenizer is kept, even if it alone exceeds the budget
+    assert list(registry.tokenizers.values()) == [tokenizer]
+    assert registry.memory_usage == 1024 * 1024
+
+
+def test_registry_preload_skips_failures():
+    registry = TokenizerRegistry(memory_budget_mb=0)
+    with stub_loader() as loads:
+        registry.preload(["mistral-7b", "mixtral-8x7b", "mistral-7b"])
+    repo_ids = {registry.get_repo_id(m) for m in ["mistral-7b", "mixtral-8x7b"]}
+    assert sorted(repo_id for repo_id, _ in loads) == sorted(repo_ids)
+
+    class FailingAutoTokenizer:
+        @staticmethod
+        def from_pretrained(repo_id: str, use_fast: bool = True):
+            raise OSError(f"{repo_id} is not available")
+
+    auto_tokenizer = tokenizer_registry.AutoTokenizer
+    tokenizer_registry.AutoTokenizer = FailingAutoTokenizer
+    try:
+        registry = TokenizerRegistry(memory_budget_mb=0)
+        registry.preload(["mistral-7b"])
+    finally:
+        tokenizer_registry.AutoTokenizer = auto_tokenizer
+    assert len(registry.tokenizers) == 0
+    assert all(not lock.locked() for lock in registry.loading_locks.values())
+
+
+if __name__ == "__main__":
+    test_registry_shares_tokenizers()
+    test_registry_loads_once_for_concurrent_gets()
+    test_registry_evicts_least_recently_used()
+    test_registry_keeps_last_tokenizer_over_budget()
+    test_registry_preload_skips_failures()
+    print("All tokenizer registry tests passed.")
+
+    # python -m tests.test_tokenizer_registry